@@ -0,0 +1,167 @@
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6 import QtCore, QtGui
+
+from profiling import profiler
+
+
+def atomic_write(path, text):
+    """Write text to path through a temporary file and a rename, so a crash never leaves it truncated."""
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class AutosaveWriter(QtCore.QObject):
+    """Write-behind queue for caption and tag files.
+
+    Edits are coalesced per file and written on a background thread once typing has been idle for
+    idle_ms, or immediately on flush(). Text that has not reached the disk yet can be read back with
+    text(), so reopening a file before its write lands never shows stale content. written(list)
+    carries the paths of each batch once they are on disk.
+    """
+    flushed = QtCore.Signal(int, float)
+    written = QtCore.Signal(list)
+    writeFailed = QtCore.Signal(str, str)
+    _batchDone = QtCore.Signal(list)
+
+    def __init__(self, idle_ms=500, parent=None):
+        super().__init__(parent)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(idle_ms)
+        self._timer.timeout.connect(self.flush)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._version = 0
+        self._pending = set()
+        self._unwritten = {}
+        self._batchDone.connect(self._on_batch_done)
+
+    def write(self, path, text):
+        self._version += 1
+        self._unwritten[path] = (self._version, text)
+        self._pending.add(path)
+        self._timer.start()
+
+    def text(self, path):
+        """Return text queued for path that is not on disk yet, or None."""
+        unwritten = self._unwritten.get(path)
+        return unwritten[1] if unwritten is not None else None
+
+    def flush(self):
+        self._timer.stop()
+        if not self._pending:
+            return
+        batch = [(path, *self._unwritten[path]) for path in self._pending]
+        self._pending.clear()
+        self._executor.submit(self._write_batch, batch, time.perf_counter())
+
+    def discard(self, path):
+        """Drop any queued write for path, e.g. because the file is about to be deleted."""
+        self._pending.discard(path)
+        self._unwritten.pop(path, None)
+
+    def wait(self):
+        """Flush and block until everything queued so far is on disk."""
+        self.flush()
+        self._executor.submit(lambda: None).result()
+
+    def _write_batch(self, batch, submitted):
+        written = []
+        for path, version, text in batch:
+            if self._unwritten.get(path, (None,))[0] != version:
+                continue  # superseded or discarded since the batch was queued
+            try:
+                with profiler.section("autosave write"):
+                    atomic_write(path, text)
+            except OSError as e:
+                self.writeFailed.emit(path, str(e))
+                continue
+            written.append((path, version))
+        self._batchDone.emit(written)
+        self.flushed.emit(len(written), (time.perf_counter() - submitted) * 1000)
+
+    def _on_batch_done(self, written):
+        for path, version in written:
+            if self._unwritten.get(path, (None,))[0] == version:
+                del self._unwritten[path]
+        if written:
+            self.written.emit([path for path, version in written])
+
+
+def is_blank_mask(image):
+    """True if every pixel of a Grayscale8 mask is white, i.e. nothing is masked out."""
+    bits = image.constBits()
+    width = image.width()
+    bytes_per_line = image.bytesPerLine()
+    white = b"\xff" * width
+    for y in range(image.height()):
+        start = y * bytes_per_line
+        if bits[start:start + width] != white:
+            return False
+    return True
+
+
+class MaskSaver(QtCore.QObject):
+    """Encodes masks as 8-bit grayscale on a background thread.
+
+    A save that has been superseded by a newer one for the same file before it started is dropped.
+    Masks that are entirely white are deleted instead of written. mask is a QImage, or a SparseMask
+    snapshot for a proxied image, which is written without assembling it where the format allows.
+    """
+    maskSaved = QtCore.Signal(str, bool, float)
+    saveFailed = QtCore.Signal(str, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._version = 0
+        self._latest = {}
+
+    def save(self, path, mask):
+        self._version += 1
+        self._latest[path] = self._version
+        if isinstance(mask, QtGui.QImage):
+            # shallow copy; the canvas detaches from it on the next stroke
+            mask = QtGui.QImage(mask)
+        self._executor.submit(self._save, path, self._version, mask)
+
+    def wait(self):
+        self._executor.submit(lambda: None).result()
+
+    def _save(self, path, version, mask):
+        if self._latest.get(path) != version:
+            return
+        with profiler.section("mask save"):
+            self._save_mask(path, mask)
+
+    def _save_mask(self, path, mask):
+        start = time.perf_counter()
+        if isinstance(mask, QtGui.QImage):
+            mask = mask.convertToFormat(QtGui.QImage.Format.Format_Grayscale8)
+            blank = is_blank_mask(mask)
+            write = mask.save
+        else:
+            blank = mask.is_blank()
+            write = mask.write
+        try:
+            if blank:
+                if os.path.exists(path):
+                    os.remove(path)
+                self.maskSaved.emit(path, False, (time.perf_counter() - start) * 1000)
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+            if not write(tmp_path, os.path.splitext(path)[1][1:].upper() or "PNG"):
+                raise OSError("could not encode mask")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.saveFailed.emit(path, str(e))
+            return
+        self.maskSaved.emit(path, True, (time.perf_counter() - start) * 1000)
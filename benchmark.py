@@ -0,0 +1,417 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ASPECTS = [(1, 1), (3, 2), (2, 3), (16, 9)]
+VARIANTS = 8
+TAGS = ["1girl", "solo", "smile", "outdoors", "red hair", "blue hair", "hat", "sky", "tree", "long hair", "short hair", "dress"]
+
+
+def dataset_name(count, resolution, mask_density):
+    return f"n{count}-r{resolution}-m{mask_density:g}"
+
+
+def make_variant(resolution, aspect, rng):
+    """A smooth gradient with a few shapes, so files are small but decode at the full pixel count."""
+    width, height = (resolution, resolution * aspect[1] // aspect[0]) if aspect[0] >= aspect[1] else (resolution * aspect[0] // aspect[1], resolution)
+    y, x = np.mgrid[0:height, 0:width]
+    base = rng.integers(0, 256, 3)
+    pixels = np.stack([(x * 255 // max(1, width - 1) + base[0]) % 256,
+                       (y * 255 // max(1, height - 1) + base[1]) % 256,
+                       np.full_like(x, base[2])], axis=-1).astype(np.uint8)
+    image = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        draw.ellipse((x0, y0, x0 + width // 4, y0 + height // 4), fill=tuple(int(v) for v in rng.integers(0, 256, 3)))
+    mask = Image.new("L", (width, height), 255)
+    ImageDraw.Draw(mask).ellipse((width // 4, height // 4, width * 3 // 4, height * 3 // 4), fill=0)
+    return image, mask
+
+
+def make_dataset(root, count, resolution, mask_density, seed=0):
+    """Write count images (JPEG, with a caption and tags each) and masks for about mask_density of them.
+
+    Files are written from a handful of pre-encoded variants, so generating large datasets is I/O bound.
+    Returns the dataset directory; an existing complete dataset is reused.
+    """
+    path = os.path.join(root, dataset_name(count, resolution, mask_density))
+    done_marker = os.path.join(path, ".complete")
+    if os.path.exists(done_marker):
+        return path
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(os.path.join(path, "mask"))
+    rng = np.random.default_rng(seed)
+    encoded = []
+    for i in range(VARIANTS):
+        image, mask = make_variant(resolution, ASPECTS[i % len(ASPECTS)], rng)
+        image_file = os.path.join(path, ".variant.jpg")
+        mask_file = os.path.join(path, ".variant.mask.jpg")
+        image.save(image_file, quality=90)
+        mask.save(mask_file, quality=90)  # masks are saved in their image's format
+        with open(image_file, "rb") as f, open(mask_file, "rb") as g:
+            encoded.append((f.read(), g.read()))
+        os.remove(image_file)
+        os.remove(mask_file)
+    tag_rng = random.Random(seed)
+    for i in range(count):
+        image_data, mask_data = encoded[i % VARIANTS]
+        name = f"image_{i:06d}"
+        with open(os.path.join(path, name + ".jpg"), "wb") as f:
+            f.write(image_data)
+        with open(os.path.join(path, name + ".txt"), "w") as f:
+            f.write(f"a synthetic test image number {i}")
+        with open(os.path.join(path, name + ".tag"), "w") as f:
+            f.write(", ".join(tag_rng.sample(TAGS, 4)))
+        if tag_rng.random() < mask_density:
+            with open(os.path.join(path, "mask", name + ".jpg"), "wb") as f:
+                f.write(mask_data)
+    open(done_marker, "w").close()
+    return path
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "n": len(values),
+        "mean": round(float(values.mean()), 3),
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "max": round(float(values.max()), 3),
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(path, steps, strokes):
+    """Drive a MainWindow over the dataset at path and return its metrics. Runs in a fresh process."""
+    process_start = time.perf_counter()
+    from PySide6 import QtCore, QtGui, QtWidgets
+    from main import MainWindow
+    imported = time.perf_counter()
+
+    def on_message(mode, context, message):
+        # the offscreen platform warns on every window resize
+        if "propagateSizeHints" not in message:
+            print(message, file=sys.stderr)
+
+    QtCore.qInstallMessageHandler(on_message)
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([sys.argv[0]])
+    # keeps the benchmark out of the user's last session
+    app.setOrganizationName("image-data-tool-benchmark")
+    app.setApplicationName("image-data-tool-benchmark")
+    QtCore.QSettings().clear()
+    QtGui.QImageReader.setAllocationLimit(1024)
+
+    def wait_for(condition, what, timeout=120):
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"timed out waiting for {what}")
+            app.processEvents(QtCore.QEventLoop.ProcessEventsFlag.AllEvents, 5)
+
+    def ms(start):
+        return (time.perf_counter() - start) * 1000
+
+    loaded = set()
+    index_file = os.path.join(path, ".image_data_tool.sqlite")
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    # startup as run_app does it, from the start of this process (imports included) to the first image on screen
+    window = MainWindow()
+    window.prefetcher.imageLoaded.connect(lambda loaded_path, image: loaded.add(loaded_path))
+    window.resize(1280, 960)
+    window.show()
+    app.processEvents()
+    shown = time.perf_counter()
+    window.restore_session(path)
+
+    def current():
+        return window.images[window.current_image]
+
+    def show(step):
+        """Run step and return (ms spent in it, ms until the full-resolution image and its mask have been painted)."""
+        loaded.clear()
+        start = time.perf_counter()
+        step()
+        call = ms(start)
+        if not window.image_cache.contains(current()):
+            wait_for(lambda: current() in loaded, "an image to decode")
+        # the mask of a proxy is read on a worker thread, and cannot be painted on before it is in
+        wait_for(lambda: not window.image_view.isMaskLoading(), "a mask to load")
+        # paints are posted; this delivers the one the new image scheduled
+        app.processEvents()
+        return call, ms(start)
+
+    wait_for(lambda: window.images, "the first scan batch")
+    if not window.image_cache.contains(current()):
+        wait_for(lambda: current() in loaded, "the first image to decode")
+    app.processEvents()
+    metrics = {
+        "startup": {
+            "import_ms": round((imported - process_start) * 1000, 3),
+            "window_shown_ms": round((shown - process_start) * 1000, 3),
+            "first_image_ms": round(ms(process_start), 3),
+        },
+    }
+    wait_for(lambda: window.folder_scanner is None and window.tag_index is not None, "the startup scan")
+
+    for run in ("cold", "warm"):
+        if run == "cold":
+            index_file = os.path.join(path, ".image_data_tool.sqlite")
+            if os.path.exists(index_file):
+                os.remove(index_file)
+        start = time.perf_counter()
+        window.open_folder(path)
+        call = ms(start)
+        wait_for(lambda: window.images, "the first scan batch")
+        if not window.image_cache.contains(current()):
+            wait_for(lambda: current() in loaded, "the first image to decode")
+        app.processEvents()
+        first_image = ms(start)
+        wait_for(lambda: window.folder_scanner is None, "the folder scan")
+        scanned = ms(start)
+        wait_for(lambda: window.tag_index is not None, "the tag index")
+        metrics[f"open_{run}"] = {
+            "call_ms": round(call, 3),
+            "first_image_ms": round(first_image, 3),
+            "scan_ms": round(scanned, 3),
+            "tag_index_ms": round(ms(start), 3),
+            "images": len(window.all_images),
+        }
+
+    # navigation: each step waits until the full image has been painted, as a user paging through would
+    for name, step in (("next", window.next_image), ("prev", window.prev_image)):
+        calls = []
+        totals = []
+        hits = window.image_cache.hits
+        misses = window.image_cache.misses
+        for _ in range(min(steps, len(window.images))):
+            call, total = show(step)
+            calls.append(call)
+            totals.append(total)
+        metrics[f"navigate_{name}"] = {
+            "call_ms": summarize(calls),
+            "displayed_ms": summarize(totals),
+            "cache_hits": window.image_cache.hits - hits,
+            "cache_misses": window.image_cache.misses - misses,
+        }
+
+    # strokes: each mouse move is followed by the repaint it schedules
+    saved = []
+    window.mask_saver.maskSaved.connect(lambda mask_file, was_saved, save_ms: saved.append(save_ms))
+    viewport = window.image_view.viewport()
+    left = QtCore.Qt.MouseButton.LeftButton
+    no_button = QtCore.Qt.MouseButton.NoButton
+    no_modifier = QtCore.Qt.KeyboardModifier.NoModifier
+
+    def mouse(kind, pos, button, buttons):
+        local = QtCore.QPointF(pos)
+        event = QtGui.QMouseEvent(kind, local, QtCore.QPointF(viewport.mapToGlobal(local)), button, buttons, no_modifier)
+        QtWidgets.QApplication.sendEvent(viewport, event)
+
+    move_ms = []
+    release_ms = []
+    save_total_ms = []
+    center = viewport.rect().center()
+    for i in range(min(strokes, len(window.images))):
+        start_point = QtCore.QPoint(center.x() - 200, center.y() - 100 + (i % 10) * 20)
+        mouse(QtCore.QEvent.Type.MouseButtonPress, start_point, left, left)
+        app.processEvents()
+        for j in range(1, 41):
+            start = time.perf_counter()
+            mouse(QtCore.QEvent.Type.MouseMove, start_point + QtCore.QPoint(j * 10, (j % 5) * 4), no_button, left)
+            app.processEvents()
+            move_ms.append(ms(start))
+        count = len(saved)
+        start = time.perf_counter()
+        mouse(QtCore.QEvent.Type.MouseButtonRelease, start_point + QtCore.QPoint(400, 0), left, no_button)
+        release_ms.append(ms(start))
+        wait_for(lambda: len(saved) > count, "a mask save")
+        save_total_ms.append(ms(start))
+        show(window.next_image)
+    metrics["stroke"] = {
+        "move_to_paint_ms": summarize(move_ms),
+        "release_ms": summarize(release_ms),
+    }
+    metrics["mask_save"] = {
+        "encode_write_ms": summarize(saved),
+        "release_to_saved_ms": summarize(save_total_ms),
+    }
+
+    # autosave: the cost of a keystroke on the UI thread, and of the background write once flushed
+    flushed = []
+    window.autosave.flushed.connect(lambda count, flush_ms: flushed.append(flush_ms))
+    edit_ms = []
+    for i in range(min(steps, len(window.images))):
+        window.image_tags.setVisible(True)
+        text = window.image_tags.toPlainText()
+        for char in ", benchmark":
+            text += char
+            start = time.perf_counter()
+            window.image_tags.setPlainText(text)
+            edit_ms.append(ms(start))
+        count = len(flushed)
+        window.autosave.flush()
+        wait_for(lambda: len(flushed) > count, "an autosave flush")
+        show(window.next_image)
+    metrics["autosave"] = {
+        "keystroke_ms": summarize(edit_ms),
+        "flush_ms": summarize(flushed),
+    }
+
+    window.close()
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    return metrics
+
+
+def git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here, capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def run_benchmarks(args):
+    from PySide6 import __version__ as pyside_version
+
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), "image_data_tool_benchmark")
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "pyside": pyside_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "steps": args.steps,
+        "strokes": args.strokes,
+        "cases": [],
+    }
+    for count, resolution, mask_density in itertools.product(args.sizes, args.resolutions, args.mask_densities):
+        name = dataset_name(count, resolution, mask_density)
+        start = time.perf_counter()
+        path = make_dataset(data_dir, count, resolution, mask_density)
+        print(f"{name}: dataset ready in {time.perf_counter() - start:.1f}s, running...", file=sys.stderr)
+        # one process per case, so the peak RSS of one case does not hide another's
+        with tempfile.NamedTemporaryFile("r", suffix=".json", delete=False) as f:
+            case_output = f.name
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--case", path, "--case-output", case_output,
+                            "--steps", str(args.steps), "--strokes", str(args.strokes)],
+                           cwd=os.path.dirname(os.path.abspath(__file__)), check=True, stdout=sys.stderr)
+            with open(case_output) as f:
+                metrics = json.load(f)
+        finally:
+            os.remove(case_output)
+        results["cases"].append({"name": name, "images": count, "resolution": resolution, "mask_density": mask_density, **metrics})
+    if not args.keep_data and args.data_dir is None:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def flatten(metrics, prefix=""):
+    """Yield (dotted name, value) for every number in a case, using the p50 of distributions."""
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            if "p50" in value:
+                yield prefix + key + ".p50", value["p50"]
+            else:
+                yield from flatten(value, prefix + key + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(old, new):
+    """Print every metric of the cases both result files have, with the relative change."""
+    old_cases = {case["name"]: case for case in old["cases"]}
+    print(f"{(old.get('commit') or '?')[:10]} -> {(new.get('commit') or '?')[:10]}")
+    for case in new["cases"]:
+        if case["name"] not in old_cases:
+            continue
+        print(case["name"])
+        old_metrics = dict(flatten(old_cases[case["name"]]))
+        for name, value in flatten(case):
+            before = old_metrics.get(name)
+            if before is None or name in ("images", "resolution", "mask_density"):
+                continue
+            change = f"{(value - before) / before:+.1%}" if before else ""
+            print(f"  {name:42} {before:12.3f} {value:12.3f}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless benchmark of the image viewer: generates synthetic datasets and measures '
+                                                 'folder open time, navigation latency, stroke-to-paint latency, mask save time, '
+                                                 'autosave cost and peak RSS. Prints the results as JSON.')
+    parser.add_argument('--sizes', type=lambda s: [int(v) for v in s.split(',')], default=[100, 1000], help='Comma separated image counts.')
+    parser.add_argument('--resolutions', type=lambda s: [int(v) for v in s.split(',')], default=[1024, 4096], help='Comma separated long side lengths.')
+    parser.add_argument('--mask-densities', type=lambda s: [float(v) for v in s.split(',')], default=[0, 0.5], help='Comma separated fractions of images with a mask.')
+    parser.add_argument('--steps', type=int, default=30, help='Navigation and autosave steps per case.')
+    parser.add_argument('--strokes', type=int, default=10, help='Mask strokes per case, of 40 mouse moves each.')
+    parser.add_argument('--data-dir', type=str, help='Where generated datasets are kept and reused (default: a temporary directory, removed afterwards).')
+    parser.add_argument('--keep-data', action='store_true', help='Do not remove the default data directory afterwards.')
+    parser.add_argument('--output', '-o', type=str, help='Write the results to this file instead of stdout.')
+    parser.add_argument('--compare', type=str, metavar='OLD_JSON', help='Print the change of every metric in --output against an earlier results file.')
+    parser.add_argument('--no-run', action='store_true', help='With --compare: compare an existing --output file instead of running the benchmarks.')
+    parser.add_argument('--case', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--case-output', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        metrics = run_case(args.case, args.steps, args.strokes)
+        with open(args.case_output, "w") as f:
+            json.dump(metrics, f)
+        return
+
+    if args.compare and not args.output:
+        parser.error('--compare needs --output')
+    if args.no_run:
+        if not args.compare:
+            parser.error('--no-run needs --compare')
+        with open(args.output) as f:
+            results = json.load(f)
+    else:
+        results = run_benchmarks(args)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
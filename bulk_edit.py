@@ -0,0 +1,345 @@
+import argparse
+import difflib
+import json
+import os
+import re
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6 import QtCore, QtGui, QtWidgets
+
+from autosave import atomic_write
+from dataset_index import CAPTION_EXTS, MASK_DIR, TAG_EXTS, is_image_file
+
+JOURNAL_DIR = ".image_data_tool_edits"
+
+Change = namedtuple("Change", ["path", "old", "new"])
+
+
+class EditOperation:
+    """One bulk edit over caption and tag files.
+
+    kind is "replace" (find/replace in the text, literal or regex), or one of the tag-aware "rename_tag",
+    "add_tag" and "remove_tag", which split tag files on commas and compare whole tags (or, with regex,
+    tags fully matching the pattern) instead of substrings. Tag operations only touch tag files.
+    """
+    KINDS = ("replace", "rename_tag", "add_tag", "remove_tag")
+
+    def __init__(self, kind, find="", replace="", regex=False, ignore_case=False, captions=True, tags=True):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown operation {kind!r}")
+        if not find:
+            # an empty pattern matches between every character of every file
+            raise ValueError("no tag to add" if kind == "add_tag" else "nothing to find")
+        self.kind = kind
+        self.find = find
+        self.replace = replace
+        self.regex = regex
+        self.captions = captions and kind == "replace"
+        self.tags = tags or kind != "replace"
+        flags = re.IGNORECASE if ignore_case else 0
+        if kind == "add_tag":
+            self._pattern = None
+        elif kind == "replace":
+            self._pattern = re.compile(find if regex else re.escape(find), flags)
+        else:
+            self._pattern = re.compile(find if regex else re.escape(" ".join(find.split())), flags)
+
+    def extensions(self):
+        return (CAPTION_EXTS if self.captions else ()) + (TAG_EXTS if self.tags else ())
+
+    def apply(self, path, text):
+        """Return the edited text of the file at path."""
+        if self.kind == "replace":
+            return self._pattern.sub(self.replace if self.regex else lambda match: self.replace, text)
+        if not path.endswith(TAG_EXTS):
+            return text
+        tags = [tag.strip() for tag in text.split(",") if tag.strip()]
+        if self.kind == "add_tag":
+            new_tag = self.find.strip()
+            if any(_same_tag(tag, new_tag) for tag in tags):
+                return text
+            return ", ".join(tags + [new_tag])
+        matches = [self._pattern.fullmatch(" ".join(tag.split())) for tag in tags]
+        if not any(matches):
+            return text
+        if self.kind == "remove_tag":
+            return ", ".join(tag for tag, match in zip(tags, matches) if not match)
+        edited = []
+        for tag, match in zip(tags, matches):
+            tag = match.expand(self.replace) if match and self.regex else self.replace.strip() if match else tag
+            if tag and not any(_same_tag(tag, other) for other in edited):
+                edited.append(tag)
+        return ", ".join(edited)
+
+
+def _same_tag(a, b):
+    return " ".join(a.split()).lower() == " ".join(b.split()).lower()
+
+
+def annotation_files(images, extensions):
+    """The caption and tag files with the given extensions that belong to images, listing each directory once.
+
+    Images sharing a stem (a.png and a.jpg) share their files, which are returned once.
+    """
+    listings = {}
+    files = {}
+    for image in images:
+        directory, name = os.path.split(image)
+        names = listings.get(directory)
+        if names is None:
+            try:
+                names = listings[directory] = set(os.listdir(directory))
+            except OSError:
+                names = listings[directory] = set()
+        stem = os.path.splitext(name)[0]
+        files.update(dict.fromkeys(os.path.join(directory, stem + ext) for ext in extensions if stem + ext in names))
+    return list(files)
+
+
+def walk_images(root):
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if d != MASK_DIR and not d.startswith(".")]
+        yield from (os.path.join(directory, name) for name in files if is_image_file(name))
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _read_or_none(path):
+    try:
+        return _read(path)
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def plan(files, operation, workers=16):
+    """Return (the Changes the operation would make to files, paths that could not be read); nothing is written."""
+    changes = []
+    unreadable = []
+    with ThreadPoolExecutor(workers) as executor:
+        for path, text in zip(files, executor.map(_read_or_none, files)):
+            if text is None:
+                unreadable.append(path)
+                continue
+            new = operation.apply(path, text)
+            if new != text:
+                changes.append(Change(path, text, new))
+    return changes, unreadable
+
+
+def diff(changes, context=0):
+    """Unified diff of changes, for the dry-run preview."""
+    lines = []
+    for change in changes:
+        lines.extend(difflib.unified_diff(change.old.splitlines(), change.new.splitlines(), change.path, change.path, n=context, lineterm=""))
+    return "\n".join(lines)
+
+
+def apply(changes, root, workers=16):
+    """Write changes in parallel, each atomically, and record them in a journal under root for revert().
+
+    A file whose content changed since it was planned is skipped. Returns (journal path, written paths, skipped paths).
+    """
+    journal_dir = os.path.join(root, JOURNAL_DIR)
+    os.makedirs(journal_dir, exist_ok=True)
+    now = time.time_ns()
+    journal = os.path.join(journal_dir, time.strftime("%Y%m%d-%H%M%S", time.localtime(now // 10 ** 9)) + f"-{now % 10 ** 9:09d}.json")
+    # the journal is written first, so a crash mid-apply can still be reverted
+    atomic_write(journal, json.dumps([change._asdict() for change in changes]))
+    written, skipped = _write_all([(change.path, change.old, change.new) for change in changes], workers)
+    return journal, written, skipped
+
+
+def revert(journal, workers=16):
+    """Undo an applied journal, restoring each file that still holds the edited text. Returns (written, skipped)."""
+    with open(journal) as f:
+        changes = [Change(**change) for change in json.load(f)]
+    written, skipped = _write_all([(change.path, change.new, change.old) for change in changes], workers)
+    os.replace(journal, journal + ".reverted")
+    return written, skipped
+
+
+def journals(root):
+    """Applied, not yet reverted journals under root, newest first."""
+    journal_dir = os.path.join(root, JOURNAL_DIR)
+    if not os.path.isdir(journal_dir):
+        return []
+    return sorted((os.path.join(journal_dir, name) for name in os.listdir(journal_dir) if name.endswith(".json")), reverse=True)
+
+
+def _write_all(edits, workers):
+    def write(edit):
+        path, expected, text = edit
+        try:
+            if _read(path) != expected:
+                return False
+            atomic_write(path, text)
+        except (OSError, UnicodeDecodeError):
+            return False
+        return True
+
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(write, edits))
+    written = [edit[0] for edit, ok in zip(edits, results) if ok]
+    skipped = [edit[0] for edit, ok in zip(edits, results) if not ok]
+    return written, skipped
+
+
+class BulkEditDialog(QtWidgets.QDialog):
+    """Dialog driving an EditOperation over the dataset: preview the diff, then apply the previewed changes."""
+    applied = QtCore.Signal(list)
+
+    OPERATIONS = [
+        ("Find and replace text", "replace"),
+        ("Rename tag", "rename_tag"),
+        ("Add tag", "add_tag"),
+        ("Remove tag", "remove_tag"),
+    ]
+
+    def __init__(self, root, images, listed_images=None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Bulk Edit Captions and Tags")
+        self.resize(800, 600)
+        self.root = root
+        self.images = images
+        self.listed_images = listed_images
+        self.changes = []
+
+        self.operation = QtWidgets.QComboBox()
+        for label, kind in self.OPERATIONS:
+            self.operation.addItem(label, kind)
+        self.find = QtWidgets.QLineEdit()
+        self.replace = QtWidgets.QLineEdit()
+        self.regex = QtWidgets.QCheckBox("Regular expression")
+        self.ignore_case = QtWidgets.QCheckBox("Ignore case")
+        self.files = QtWidgets.QComboBox()
+        self.files.addItems(["Captions and tags", "Captions only", "Tags only"])
+        self.only_listed = QtWidgets.QCheckBox("Only the images currently listed")
+        self.only_listed.setEnabled(listed_images is not None)
+        self.only_listed.setChecked(listed_images is not None)
+
+        form = QtWidgets.QFormLayout()
+        form.addRow("Operation", self.operation)
+        form.addRow("Find", self.find)
+        form.addRow("Replace with", self.replace)
+        form.addRow("", self.regex)
+        form.addRow("", self.ignore_case)
+        form.addRow("Files", self.files)
+        form.addRow("", self.only_listed)
+
+        self.preview = QtWidgets.QPlainTextEdit()
+        self.preview.setReadOnly(True)
+        self.preview.setLineWrapMode(QtWidgets.QPlainTextEdit.LineWrapMode.NoWrap)
+        self.preview.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.SystemFont.FixedFont))
+        self.summary = QtWidgets.QLabel()
+
+        self.buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.StandardButton.Close)
+        self.preview_button = self.buttons.addButton("Preview", QtWidgets.QDialogButtonBox.ButtonRole.ActionRole)
+        self.apply_button = self.buttons.addButton("Apply", QtWidgets.QDialogButtonBox.ButtonRole.ApplyRole)
+        self.apply_button.setEnabled(False)
+        self.preview_button.clicked.connect(self.show_preview)
+        self.apply_button.clicked.connect(self.apply_changes)
+        self.buttons.rejected.connect(self.reject)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(form)
+        layout.addWidget(self.preview)
+        layout.addWidget(self.summary)
+        layout.addWidget(self.buttons)
+
+        for widget in (self.find, self.replace):
+            widget.textChanged.connect(self.invalidate_preview)
+        for widget in (self.operation, self.files):
+            widget.currentIndexChanged.connect(self.invalidate_preview)
+        for widget in (self.regex, self.ignore_case, self.only_listed):
+            widget.toggled.connect(self.invalidate_preview)
+        self.invalidate_preview()
+
+    def invalidate_preview(self):
+        kind = self.operation.currentData()
+        self.replace.setEnabled(kind in ("replace", "rename_tag"))
+        self.files.setEnabled(kind == "replace")
+        self.changes = []
+        self.apply_button.setEnabled(False)
+
+    def build_operation(self):
+        files = self.files.currentIndex()
+        return EditOperation(self.operation.currentData(), self.find.text(), self.replace.text(), self.regex.isChecked(),
+                             self.ignore_case.isChecked(), captions=files != 2, tags=files != 1)
+
+    def show_preview(self):
+        try:
+            operation = self.build_operation()
+        except re.error as e:
+            self.summary.setText(f"Invalid regular expression: {e}")
+            return
+        except ValueError as e:
+            self.summary.setText(str(e).capitalize())
+            return
+        images = self.listed_images if self.only_listed.isChecked() else self.images
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.CursorShape.WaitCursor)
+        try:
+            self.changes, unreadable = plan(annotation_files(images, operation.extensions()), operation)
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+        text = diff(self.changes)
+        # very large previews make the text edit crawl; the counts below still cover everything
+        self.preview.setPlainText(text if len(text) < 2000000 else text[:2000000] + "\n...")
+        self.summary.setText(f"{len(self.changes)} files would change" + (f", skipped {len(unreadable)} that could not be read" if unreadable else ""))
+        self.apply_button.setEnabled(bool(self.changes))
+
+    def apply_changes(self):
+        journal, written, skipped = apply(self.changes, self.root)
+        self.summary.setText(f"Changed {len(written)} files" + (f", skipped {len(skipped)} that changed since the preview" if skipped else ""))
+        self.changes = []
+        self.apply_button.setEnabled(False)
+        self.applied.emit(written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find/replace in captions and tags, or rename, add and remove tags, across a dataset. "
+                                                 "Shows a diff and changes nothing unless --apply is given.")
+    parser.add_argument("directory", help="The dataset root.")
+    parser.add_argument("operation", nargs="?", choices=EditOperation.KINDS, help="What to do.")
+    parser.add_argument("find", nargs="?", default="", help="Text, tag or pattern to find (the tag to add for add_tag).")
+    parser.add_argument("replace", nargs="?", default="", help="Replacement text or tag.")
+    parser.add_argument("--regex", "-r", action="store_true", help="find is a regular expression; replace may use \\1 groups.")
+    parser.add_argument("--ignore-case", "-i", action="store_true")
+    parser.add_argument("--only", choices=["captions", "tags"], help="For replace: only edit caption or tag files.")
+    parser.add_argument("--apply", action="store_true", help="Write the changes (a journal is kept for --revert).")
+    parser.add_argument("--revert", nargs="?", const="last", help="Revert the last applied edit, or the given journal file.")
+    args = parser.parse_args()
+
+    if args.revert:
+        available = journals(args.directory)
+        journal = available[0] if args.revert == "last" and available else args.revert
+        if journal == "last":
+            parser.error("nothing to revert")
+        written, skipped = revert(journal)
+        print(f"Reverted {len(written)} files" + (f", skipped {len(skipped)} changed since" if skipped else ""))
+        return
+    if not args.operation:
+        parser.error("an operation is required")
+
+    try:
+        operation = EditOperation(args.operation, args.find, args.replace, args.regex, args.ignore_case,
+                                  captions=args.only != "tags", tags=args.only != "captions")
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+    changes, unreadable = plan(annotation_files(walk_images(args.directory), operation.extensions()), operation)
+    print(diff(changes))
+    for path in unreadable:
+        print(f"Skipped {path}: could not be read")
+    print(f"{len(changes)} files would change" if not args.apply else f"{len(changes)} files to change")
+    if args.apply and changes:
+        journal, written, skipped = apply(changes, args.directory)
+        print(f"Wrote {len(written)} files" + (f", skipped {len(skipped)} changed since" if skipped else "") + f"; journal {journal}")
+
+
+if __name__ == "__main__":
+    main()
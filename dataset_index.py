@@ -0,0 +1,546 @@
+import os
+import posixpath
+import re
+import sqlite3
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6 import QtCore, QtGui
+
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+CAPTION_EXTS = ('.txt', '.caption')
+TAG_EXTS = ('.tag', '.tags')
+MASK_DIR = "mask"
+
+IndexEntry = namedtuple("IndexEntry", ["size", "mtime_ns", "width", "height", "caption_ext", "tag_ext", "has_mask"])
+
+
+def is_image_file(name):
+    return name.lower().endswith(IMAGE_EXTS)
+
+
+def natural_sort_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def read_image_size(path):
+    size = QtGui.QImageReader(path).size()
+    if not size.isValid():
+        return -1, -1
+    return size.width(), size.height()
+
+
+class DatasetIndex:
+    """On-disk index of a dataset tree, stored as SQLite in the dataset root.
+
+    Records file size, mtime, pixel dimensions (header-only read) and which caption, tag and mask
+    files exist for each image, keyed by path relative to the root. A scan compares every image's
+    size and mtime with the index and re-reads the header only of images that changed; a file
+    rewritten in place does not change its directory's mtime, so no directory is taken as-is.
+
+    Each thread must use its own DatasetIndex; they share the same database.
+    """
+    FILENAME = ".image_data_tool.sqlite"
+    VERSION = "2"
+
+    def __init__(self, folder):
+        self.folder = folder
+        db_path = os.path.join(folder, self.FILENAME)
+        try:
+            self._connect(db_path)
+        except sqlite3.DatabaseError:
+            # corrupt index, rebuild it; if the folder is read-only keep it for this session only
+            try:
+                os.remove(db_path)
+                self._connect(db_path)
+            except (OSError, sqlite3.Error):
+                self._connect(f"file:image_data_tool_{abs(hash(os.path.abspath(folder)))}?mode=memory&cache=shared")
+
+    def _connect(self, db_path):
+        self._db = sqlite3.connect(db_path, timeout=30, uri=db_path.startswith("file:"))
+        # no journal files, so the index itself does not touch the folder mtime on every write
+        self._db.execute("PRAGMA journal_mode=MEMORY")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if self._get_meta("version") != self.VERSION:
+            self._db.execute("DROP TABLE IF EXISTS images")
+            self._db.execute("DROP TABLE IF EXISTS dirs")
+            self._set_meta("version", self.VERSION)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime_ns INTEGER, "
+            "width INTEGER, height INTEGER, caption_ext TEXT, tag_ext TEXT, has_mask INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS images_dir ON images (dir)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, mask_mtime_ns INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, dhash INTEGER, phash INTEGER)")
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def path(self, rel):
+        return os.path.join(self.folder, *rel.split("/"))
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.folder).replace(os.sep, "/")
+
+    def get(self, path):
+        row = self._db.execute("SELECT * FROM images WHERE path = ?", (self.relpath(path),)).fetchone()
+        if row is None:
+            return None
+        return _entry_from_row(row)
+
+    def entries(self):
+        """Yield (path, IndexEntry) for every indexed image."""
+        for row in self._db.execute("SELECT * FROM images"):
+            yield self.path(row[0]), _entry_from_row(row)
+
+    def scan(self, batch_size=1000, sort_key=natural_sort_key, should_stop=None):
+        """Bring the index up to date with the tree, yielding image paths in batches as they are found.
+
+        Directories are walked depth-first with files before subdirectories, both ordered by sort_key,
+        so the order is stable between scans. mask/ and hidden directories are skipped.
+        """
+        known_dirs = {row[0]: row[1:] for row in self._db.execute("SELECT * FROM dirs")}
+        visited = set()
+        stack = [""]
+        while stack:
+            if should_stop is not None and should_stop():
+                return
+            rel_dir = stack.pop()
+            visited.add(rel_dir)
+            full_dir = self.path(rel_dir) if rel_dir else self.folder
+            listing = _list_dir(full_dir)
+            if listing is None:
+                continue
+            files, subdirs = listing
+            stack.extend(posixpath.join(rel_dir, name) for name in sorted(subdirs, key=sort_key, reverse=True))
+
+            mask_dir = os.path.join(full_dir, MASK_DIR)
+            mtimes = (_mtime_ns(full_dir), _mtime_ns(mask_dir))
+            names = sorted((name for name in files if is_image_file(name)), key=sort_key)
+            masks = set(os.listdir(mask_dir)) if os.path.isdir(mask_dir) else set()
+            old = {row[0]: _entry_from_row(row) for row in self._db.execute("SELECT * FROM images WHERE dir = ?", (rel_dir,))}
+            base = os.path.join(full_dir, "")
+            for i in range(0, len(names), batch_size):
+                self._update_entries(rel_dir, full_dir, names[i:i + batch_size], files, masks, old)
+                yield [base + name for name in names[i:i + batch_size]]
+            prefix = _rel_prefix(rel_dir)
+            present = set(prefix + name for name in names)
+            self._db.executemany("DELETE FROM images WHERE path = ?", [(rel,) for rel in old if rel not in present])
+            self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel_dir, *mtimes))
+            self._db.commit()
+
+        removed = [(rel_dir,) for rel_dir in known_dirs if rel_dir not in visited]
+        self._db.executemany("DELETE FROM images WHERE dir = ?", removed)
+        self._db.executemany("DELETE FROM dirs WHERE path = ?", removed)
+        self._db.commit()
+
+    def _update_entries(self, rel_dir, full_dir, names, files, masks, old):
+        prefix = _rel_prefix(rel_dir)
+        rows = {}
+        stale = []
+        for name in names:
+            st = files[name].stat()
+            stem = os.path.splitext(name)[0]
+            caption_ext = next((ext for ext in CAPTION_EXTS if stem + ext in files), "")
+            tag_ext = next((ext for ext in TAG_EXTS if stem + ext in files), "")
+            entry = old.get(prefix + name)
+            if entry is not None and entry.size == st.st_size and entry.mtime_ns == st.st_mtime_ns:
+                width, height = entry.width, entry.height
+            else:
+                width, height = -1, -1
+                stale.append(name)
+            rows[name] = IndexEntry(st.st_size, st.st_mtime_ns, width, height, caption_ext, tag_ext, name in masks)
+        if stale:
+            with ThreadPoolExecutor() as executor:
+                paths = [os.path.join(full_dir, name) for name in stale]
+                for name, (width, height) in zip(stale, executor.map(read_image_size, paths)):
+                    rows[name] = rows[name]._replace(width=width, height=height)
+        changed = [(prefix + name, rel_dir, *entry) for name, entry in rows.items() if old.get(prefix + name) != entry]
+        if changed:
+            self._db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", changed)
+            self._db.commit()
+        return {row[0]: IndexEntry(*row[2:]) for row in changed}
+
+    def refresh(self, rel_dirs, changed=(), ignored=None, sort_key=natural_sort_key):
+        """Bring only the given directories (relative paths) up to date, without walking the rest of the tree.
+
+        Only names are compared with the index, so a change in a large directory costs a listing:
+        images that appeared are read, and files are stat()ed only when they are in changed (paths
+        whose watch reported them rewritten in place). Subdirectories that appeared are indexed
+        recursively and ones that vanished are dropped. ignored maps paths the tool wrote itself to
+        their mtime_ns after writing (0 if deleted); changes that involve only those, still as written,
+        go into the index but are not reported.
+        Returns lists of image paths: "added", "removed", "modified" (the image file itself changed) and
+        "annotated" (a caption, tag or mask file appeared or vanished, or one in changed was written).
+        """
+        ignored = ignored or {}
+        known_dirs = {row[0] for row in self._db.execute("SELECT path FROM dirs")}
+        result = {"added": [], "removed": [], "modified": [], "annotated": []}
+        gone = []
+        stack = sorted(set(rel_dirs), key=sort_key, reverse=True)
+        visited = set()
+        while stack:
+            rel_dir = stack.pop()
+            if rel_dir in visited:
+                continue
+            visited.add(rel_dir)
+            full_dir = self.path(rel_dir) if rel_dir else self.folder
+            listing = _list_dir(full_dir)
+            if listing is None:
+                gone.append(rel_dir)
+                continue
+            files, subdirs = listing
+            subdirs = {posixpath.join(rel_dir, name) for name in subdirs}
+            stack.extend(sorted(subdirs - known_dirs, key=sort_key, reverse=True))
+            gone.extend(d for d in known_dirs if d and posixpath.dirname(d) == rel_dir and d not in subdirs)
+
+            mask_dir = os.path.join(full_dir, MASK_DIR)
+            masks = set(os.listdir(mask_dir)) if os.path.isdir(mask_dir) else set()
+            prefix = _rel_prefix(rel_dir)
+            base = os.path.join(full_dir, "")
+            names = {name for name in files if is_image_file(name)}
+            known = {row[0][len(prefix):]: (row[1], row[2], bool(row[3])) for row in self._db.execute(
+                "SELECT path, caption_ext, tag_ext, has_mask FROM images WHERE dir = ?", (rel_dir,))}
+
+            added = sorted(names.difference(known), key=sort_key)
+            if added:
+                self._update_entries(rel_dir, full_dir, added, files, masks, {})
+                result["added"].extend(base + name for name in added)
+            removed = sorted(set(known).difference(names), key=sort_key)
+            if removed:
+                self._db.executemany("DELETE FROM images WHERE path = ?", [(prefix + name,) for name in removed])
+                result["removed"].extend(base + name for name in removed)
+
+            # sidecars that appeared or vanished show in the listing alone
+            modified = set()
+            annotated = set()
+            updates = []
+            for name, state in known.items():
+                if name not in names:
+                    continue
+                stem = os.path.splitext(name)[0]
+                caption_ext = next((ext for ext in CAPTION_EXTS if stem + ext in files), "")
+                tag_ext = next((ext for ext in TAG_EXTS if stem + ext in files), "")
+                current = (caption_ext, tag_ext, name in masks)
+                if current == state:
+                    continue
+                updates.append((*current, prefix + name))
+                involved = {base + stem + ext for ext in (state[0], caption_ext, state[1], tag_ext) if ext}
+                if state[2] != current[2]:
+                    involved.add(os.path.join(mask_dir, name))
+                if not _all_ignored(involved, ignored):
+                    annotated.add(name)
+            if updates:
+                self._db.executemany("UPDATE images SET caption_ext = ?, tag_ext = ?, has_mask = ? WHERE path = ?", updates)
+
+            # files rewritten in place only show in their own watch
+            by_stem = None
+            for path in changed:
+                directory, name = os.path.split(path)
+                if directory == mask_dir:
+                    images = [name] if name in names and name in known else []
+                elif directory != full_dir:
+                    continue
+                elif name in names:
+                    if name in known and not _all_ignored([path], ignored):
+                        row = self._db.execute("SELECT * FROM images WHERE path = ?", (prefix + name,)).fetchone()
+                        if self._update_entries(rel_dir, full_dir, [name], files, masks, {row[0]: _entry_from_row(row)}):
+                            modified.add(name)
+                    continue
+                else:
+                    if by_stem is None:
+                        by_stem = {}
+                        for image in known:
+                            if image in names:
+                                by_stem.setdefault(os.path.splitext(image)[0], []).append(image)
+                    images = by_stem.get(os.path.splitext(name)[0], [])
+                if images and os.path.exists(path) and not _all_ignored([path], ignored):
+                    annotated.update(images)
+            result["modified"].extend(base + name for name in sorted(modified, key=sort_key))
+            result["annotated"].extend(base + name for name in sorted(annotated - modified, key=sort_key))
+            self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel_dir, _mtime_ns(full_dir), _mtime_ns(mask_dir)))
+            self._db.commit()
+
+        for rel_dir in gone:
+            # the directory and everything below it; "" is the root itself
+            prefix = rel_dir + "/" if rel_dir else ""
+            below = (rel_dir, len(prefix), prefix)
+            result["removed"].extend(self.path(row[0]) for row in self._db.execute(
+                "SELECT path FROM images WHERE dir = ? OR substr(dir, 1, ?) = ?", below))
+            self._db.execute("DELETE FROM images WHERE dir = ? OR substr(dir, 1, ?) = ?", below)
+            self._db.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", below)
+        self._db.commit()
+        return result
+
+    def dirs(self):
+        """Return the relative paths of every indexed directory, "" being the root."""
+        return [row[0] for row in self._db.execute("SELECT path FROM dirs")]
+
+    def update(self, path, **fields):
+        entry = self.get(path)
+        if entry is None:
+            return
+        entry = entry._replace(**fields)
+        rel = self.relpath(path)
+        self._db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (rel, posixpath.dirname(rel), *entry))
+        self._db.commit()
+
+    def remove(self, path):
+        self._db.execute("DELETE FROM images WHERE path = ?", (self.relpath(path),))
+        self._db.execute("DELETE FROM hashes WHERE path = ?", (self.relpath(path),))
+        self._db.commit()
+
+    def hashes(self):
+        """Return {path: (size, mtime_ns, dhash, phash)} for every image with stored perceptual hashes."""
+        return {self.path(row[0]): row[1:] for row in self._db.execute("SELECT * FROM hashes")}
+
+    def set_hashes(self, rows):
+        """Store (path, size, mtime_ns, dhash, phash) rows; hashes are signed 64-bit integers."""
+        self._db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", [(self.relpath(row[0]), *row[1:]) for row in rows])
+        self._db.commit()
+
+    def _get_meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+
+class FolderScanner(QtCore.QThread):
+    """Runs DatasetIndex.scan for a folder off the GUI thread, publishing image paths in batches."""
+    imagesFound = QtCore.Signal(list)
+
+    def __init__(self, folder, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+
+    def run(self):
+        index = DatasetIndex(self.folder)
+        try:
+            for paths in index.scan(should_stop=self.isInterruptionRequested):
+                if self.isInterruptionRequested():
+                    break
+                if paths:
+                    self.imagesFound.emit(paths)
+        finally:
+            index.close()
+
+
+def merge_images(images, added, sort_key=natural_sort_key):
+    """Insert the paths in added into the list images in place, in scan order.
+
+    New images go among the images of their directory; images of directories that had none yet
+    go at the end, so nothing that is already listed moves relative to its neighbours.
+    """
+    by_dir = {}
+    for path in added:
+        by_dir.setdefault(os.path.dirname(path), []).append(path)
+    for directory in sorted(by_dir, key=sort_key):
+        prefix = os.path.join(directory, "")
+        start = next((i for i, path in enumerate(images) if path.startswith(prefix)), None)
+        if start is None:
+            images.extend(sorted(by_dir[directory], key=lambda path: sort_key(os.path.basename(path))))
+            continue
+        # the directory's own images come first, then those of its subdirectories
+        end = start
+        while end < len(images) and images[end].startswith(prefix) and os.path.dirname(images[end]) == directory:
+            end += 1
+        for path in by_dir[directory]:
+            key = sort_key(os.path.basename(path))
+            lo, hi = start, end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if key < sort_key(os.path.basename(images[mid])):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            images.insert(lo, path)
+            end += 1
+
+
+class FolderWatcher(QtCore.QObject):
+    """Watches the directories of an indexed folder and brings the index up to date as files change.
+
+    Change notifications are collected for delay_ms, then only the directories they came from are
+    compared with the index by DatasetIndex.refresh on a worker thread, and the result is emitted as
+    changed(dict). Directory notifications do not cover files rewritten in place, so the files passed
+    to watchFiles (the image on screen and its sidecars) are watched individually as well.
+    Files the tool writes itself are passed to ignore(), so its own saves are not reported back.
+    """
+    changed = QtCore.Signal(dict)
+    IGNORE_SECONDS = 10
+
+    def __init__(self, delay_ms=300, parent=None):
+        super().__init__(parent)
+        self.folder = None
+        self._watcher = QtCore.QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self._on_directory_changed)
+        self._watcher.fileChanged.connect(self._on_file_changed)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay_ms)
+        self._timer.timeout.connect(self._refresh)
+        self._dirs = set()
+        self._files = []
+        self._dirty = set()
+        self._changed = set()
+        self._ignored = {}
+        self._refresher = None
+
+    def watch(self, folder, rel_dirs):
+        self.stop()
+        self.folder = folder
+        self._watch_dirs(rel_dirs)
+
+    def stop(self):
+        self.folder = None
+        self._timer.stop()
+        self._dirty.clear()
+        self._changed.clear()
+        self._ignored.clear()
+        if self._refresher is not None:
+            # its result is dropped: _on_refreshed only takes it from the current refresher
+            self._refresher.wait()
+            self._refresher = None
+        if self._dirs:
+            self._watcher.removePaths(list(self._dirs))
+        self._dirs = set()
+        self.watchFiles([])
+
+    def watchFiles(self, paths):
+        if self._files:
+            self._watcher.removePaths(self._files)
+        self._files = [path for path in paths if os.path.isfile(path)] if self.folder else []
+        if self._files:
+            self._watcher.addPaths(self._files)
+
+    def ignore(self, path):
+        """Do not report path, just written or deleted by the tool, unless it changes again within IGNORE_SECONDS."""
+        if self.folder is not None:
+            self._ignored[path] = (_mtime_ns(path), time.monotonic() + self.IGNORE_SECONDS)
+
+    def _watch_dirs(self, rel_dirs):
+        paths = []
+        for rel_dir in rel_dirs:
+            full_dir = os.path.join(self.folder, *rel_dir.split("/")) if rel_dir else self.folder
+            paths.append(full_dir)
+            if os.path.isdir(os.path.join(full_dir, MASK_DIR)):
+                paths.append(os.path.join(full_dir, MASK_DIR))
+        gone = [path for path in self._dirs - set(paths)]
+        new = [path for path in paths if path not in self._dirs]
+        if gone:
+            self._watcher.removePaths(gone)
+        if new:
+            self._watcher.addPaths(new)
+        self._dirs = set(paths)
+
+    def _on_directory_changed(self, path):
+        if self.folder is None:
+            return
+        if os.path.basename(path) == MASK_DIR:
+            path = os.path.dirname(path)
+        rel_dir = os.path.relpath(path, self.folder).replace(os.sep, "/")
+        self._dirty.add("" if rel_dir == "." else rel_dir)
+        # not restarted on every event, so a steady stream of changes is still applied every delay_ms
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _on_file_changed(self, path):
+        # replacing a file (as atomic saves do) ends its watch; keep watching the new one
+        if path in self._files and os.path.isfile(path):
+            self._watcher.addPath(path)
+        if self.folder is not None:
+            self._changed.add(path)
+        self._on_directory_changed(os.path.dirname(path))
+
+    def _refresh(self):
+        if not self._dirty or self._refresher is not None:
+            return
+        now = time.monotonic()
+        self._ignored = {path: ignore for path, ignore in self._ignored.items() if ignore[1] > now}
+        ignored = {path: ignore[0] for path, ignore in self._ignored.items()}
+        self._refresher = _Refresher(self.folder, list(self._dirty), list(self._changed), ignored, self)
+        self._dirty.clear()
+        self._changed.clear()
+        self._refresher.refreshed.connect(self._on_refreshed)
+        self._refresher.finished.connect(self._on_refresher_finished)
+        self._refresher.start()
+
+    def _on_refreshed(self, changes):
+        if self.sender() is not self._refresher:
+            return
+        self._watch_dirs(changes.pop("dirs"))
+        if any(changes.values()):
+            self.changed.emit(changes)
+
+    def _on_refresher_finished(self):
+        refresher = self.sender()
+        refresher.deleteLater()
+        if refresher is not self._refresher:
+            return
+        # cleared here rather than on refreshed, so a refresh that failed does not stop later ones
+        self._refresher = None
+        if self._dirty and not self._timer.isActive():
+            self._timer.start()
+
+
+class _Refresher(QtCore.QThread):
+    refreshed = QtCore.Signal(dict)
+
+    def __init__(self, folder, rel_dirs, changed, ignored, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.rel_dirs = rel_dirs
+        self.changed = changed
+        self.ignored = ignored
+
+    def run(self):
+        index = DatasetIndex(self.folder)
+        try:
+            changes = index.refresh(self.rel_dirs, self.changed, self.ignored)
+            changes["dirs"] = index.dirs()
+        finally:
+            index.close()
+        self.refreshed.emit(changes)
+
+
+def _list_dir(full_dir):
+    """Return ({name: DirEntry} of files, [subdirectory names]) without mask/ and hidden directories, or None."""
+    files = {}
+    subdirs = []
+    try:
+        with os.scandir(full_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    files[entry.name] = entry
+                elif entry.is_dir() and entry.name != MASK_DIR and not entry.name.startswith("."):
+                    subdirs.append(entry.name)
+    except OSError:
+        return None
+    return files, subdirs
+
+
+def _all_ignored(paths, ignored):
+    """True if every path was written by the tool itself and has not changed since."""
+    return all(path in ignored and _mtime_ns(path) == ignored[path] for path in paths)
+
+
+def _rel_prefix(rel_dir):
+    """What relative paths of files in rel_dir start with."""
+    return rel_dir + "/" if rel_dir else ""
+
+
+def _entry_from_row(row):
+    return IndexEntry(*row[2:-1], bool(row[-1]))
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
@@ -0,0 +1,395 @@
+import io
+import itertools
+import math
+import struct
+import threading
+import zlib
+
+from collections import OrderedDict
+
+from PySide6 import QtCore, QtGui
+
+from profiling import profiler
+
+
+def proxy_size(size, max_pixels):
+    """The size an image of size is displayed at when it has more than max_pixels pixels, else size itself."""
+    if not max_pixels or not size.isValid() or size.width() * size.height() <= max_pixels:
+        return QtCore.QSize(size)
+    scale = math.sqrt(max_pixels / (size.width() * size.height()))
+    return QtCore.QSize(max(1, int(size.width() * scale)), max(1, int(size.height() * scale)))
+
+
+def read_image(path, max_pixels=None):
+    """Decode path, downsampled to at most max_pixels pixels if it is larger (a proxy).
+
+    Formats that can decode at reduced size (JPEG) never hold the full image, and 8-bit PNGs are
+    decoded a band of rows at a time (see read_png_scaled); others are decoded in full once and
+    downsampled, so only the proxy is kept.
+    """
+    reader = QtGui.QImageReader(path)
+    size = proxy_size(reader.size(), max_pixels)
+    if size == reader.size():
+        return reader.read()
+    if reader.supportsOption(QtGui.QImageIOHandler.ImageOption.ScaledSize):
+        reader.setScaledSize(size)
+        return reader.read()
+    if reader.format() == b"png":
+        image = read_png_scaled(path, size)
+        if image is not None:
+            return image
+    image = reader.read()
+    if image.isNull():
+        return image
+    return image.scaled(size, QtCore.Qt.AspectRatioMode.IgnoreAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation)
+
+
+def read_png_scaled(path, size, band_bytes=16 * 1024 * 1024):
+    """Decode a PNG scaled to size, holding only about band_bytes of full-resolution rows at a time.
+
+    Each band of rows is area-averaged into the result as it is decoded. Returns None for PNGs a
+    PngBandReader cannot read, or if the file cannot be read.
+    """
+    try:
+        with PngBandReader(path) as png:
+            image = _scale_bands(png.bands(max(1, band_bytes // (png.width * 4))), png.width, png.height, size)
+    except (OSError, ValueError, zlib.error, struct.error):
+        return None
+    if image is None:
+        return None
+    pixels = image.tobytes()  # the QImage below only refers to it, until it is converted
+    if image.mode == "RGBA":
+        return QtGui.QImage(pixels, image.width, image.height, image.width * 4,
+                            QtGui.QImage.Format.Format_RGBA8888).convertToFormat(QtGui.QImage.Format.Format_ARGB32)
+    return QtGui.QImage(pixels, image.width, image.height, image.width * 3,
+                        QtGui.QImage.Format.Format_RGB888).convertToFormat(QtGui.QImage.Format.Format_RGB32)
+
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}  # by color type
+
+
+class PngBandReader:
+    """Decodes an 8-bit, non-interlaced PNG a band of rows at a time, in a single pass over the file.
+
+    The compressed data is inflated a band at a time, and Pillow undoes the row filters of each band,
+    handed to it as a small PNG of its own. Its first row is the last row of the band before, stored
+    unfiltered, since the filters of a row may refer to the row above it. Raises ValueError for other
+    PNGs.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._chunks = _png_chunks(self._file)
+            kind, header = next(self._chunks, (None, b""))
+            if kind != b"IHDR":
+                raise ValueError("not a PNG")
+            self.width, self.height, depth, self._color_type, _, _, interlace = struct.unpack(">IIBBBBB", header[:13])
+            if depth != 8 or interlace or self._color_type not in _PNG_CHANNELS:
+                raise ValueError("only 8-bit, non-interlaced PNGs can be read in bands")
+            self._extra = b""  # PLTE and tRNS, which every band needs to decode to the same colours
+            for kind, data in self._chunks:
+                if kind == b"IDAT":
+                    self._first_idat = data
+                    break
+                if kind in (b"PLTE", b"tRNS"):
+                    self._extra += _png_chunk(kind, data)
+            else:
+                raise ValueError("no image data")
+        except BaseException:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def bands(self, rows):
+        """Yield the image as Pillow images of rows rows (fewer for the last), in the mode Pillow gives the PNG."""
+        stride = self.width * _PNG_CHANNELS[self._color_type] + 1  # every row starts with its filter type
+        idat = itertools.chain([self._first_idat], (data for kind, data in self._chunks if kind == b"IDAT"))
+        previous = None
+        pending = bytearray()
+        inflate = zlib.decompressobj()
+        for data in idat:
+            while data:
+                pending += inflate.decompress(data, rows * stride)
+                data = inflate.unconsumed_tail
+                while len(pending) >= rows * stride:
+                    with memoryview(pending) as view:
+                        band = self._decode(view[:rows * stride], previous)
+                    del pending[:rows * stride]
+                    previous = band.crop((0, band.height - 1, self.width, band.height)).tobytes()
+                    yield band
+        if len(pending) % stride:
+            raise ValueError("truncated PNG")
+        if pending:
+            yield self._decode(pending, previous)
+
+    def _decode(self, data, previous):
+        from PIL import Image
+
+        rows = len(data) // (self.width * _PNG_CHANNELS[self._color_type] + 1)
+        deflate = zlib.compressobj(0)  # stored as is: this only wraps the rows for Pillow's decoder
+        idat = []
+        if previous is not None:
+            idat.append(deflate.compress(b"\0" + previous))  # filter type None
+            rows += 1
+        idat += [deflate.compress(data), deflate.flush()]
+        crc = zlib.crc32(b"IDAT")
+        for part in idat:
+            crc = zlib.crc32(part, crc)
+        header = struct.pack(">IIBBBBB", self.width, rows, 8, self._color_type, 0, 0, 0)
+        png = b"".join([_PNG_SIGNATURE, _png_chunk(b"IHDR", header), self._extra,
+                        struct.pack(">I4s", sum(map(len, idat)), b"IDAT"), *idat, struct.pack(">I", crc), _png_chunk(b"IEND", b"")])
+        band = Image.open(io.BytesIO(png))
+        band.load()
+        return band if previous is None else band.crop((0, 1, self.width, rows))
+
+
+def _png_chunks(f):
+    if f.read(8) != _PNG_SIGNATURE:
+        raise ValueError("not a PNG")
+    while True:
+        length, kind = struct.unpack(">I4s", f.read(8))
+        data = f.read(length)
+        f.read(4)  # CRC; zlib catches corrupt image data
+        if kind == b"IEND":
+            return
+        yield kind, data
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _scale_bands(bands, width, height, size):
+    """Area-average an image given as consecutive bands of rows to size, keeping at most one band and a few rows.
+
+    The result is RGBA if the bands have transparency, else RGB; None if the bands end early.
+    """
+    from PIL import Image
+
+    scale = height / size.height()
+    result = None
+    top = 0  # the image row of the first row of band
+    done = 0  # result rows written
+    carry = None  # rows of the previous band that result rows still to be written overlap
+    for band in bands:
+        mode = "RGBA" if "A" in band.mode or "transparency" in band.info else "RGB"
+        if band.mode != mode:
+            band = band.convert(mode)
+        if carry is not None:
+            joined = Image.new(band.mode, (width, carry.height + band.height))
+            joined.paste(carry, (0, 0))
+            joined.paste(band, (0, carry.height))
+            band = joined
+        if result is None:
+            result = Image.new(band.mode, (size.width(), size.height()))
+        bottom = top + band.height
+        end = size.height() if bottom >= height else min(size.height(), int(bottom / scale))
+        if end > done:
+            box = (0, done * scale - top, width, min(end * scale - top, band.height))
+            result.paste(band.resize((size.width(), end - done), Image.Resampling.BOX, box=box), (0, done))
+            done = end
+        keep = min(int(done * scale) - top, band.height)
+        carry = band.crop((0, keep, width, band.height)) if keep < band.height else None
+        top += keep
+    return result if done == size.height() else None
+
+
+def read_image_preview(path, max_side=1024):
+    """Decode a reduced-resolution copy of path, if the format can do so faster than a full decode."""
+    reader = QtGui.QImageReader(path)
+    if not reader.supportsOption(QtGui.QImageIOHandler.ImageOption.ScaledSize):
+        return None
+    size = reader.size()
+    if not size.isValid() or max(size.width(), size.height()) <= max_side:
+        return None
+    reader.setScaledSize(size.scaled(max_side, max_side, QtCore.Qt.AspectRatioMode.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        return None
+    return image
+
+
+class ImageCache:
+    """Thread-safe LRU cache of decoded QImages, bounded by total byte size."""
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        with self._lock:
+            image = self._images.get(path)
+            if image is None:
+                self.misses += 1
+                return None
+            self._images.move_to_end(path)
+            self.hits += 1
+            return image
+
+    def contains(self, path):
+        with self._lock:
+            return path in self._images
+
+    def put(self, path, image):
+        if image is None or image.isNull():
+            return
+        size = image.sizeInBytes()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._images.pop(path, None)
+            if old is not None:
+                self._bytes -= old.sizeInBytes()
+            self._images[path] = image
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._images:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= evicted.sizeInBytes()
+
+    def invalidate(self, path):
+        with self._lock:
+            image = self._images.pop(path, None)
+            if image is not None:
+                self._bytes -= image.sizeInBytes()
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def size_bytes(self):
+        return self._bytes
+
+
+class _DecodeSignals(QtCore.QObject):
+    previewReady = QtCore.Signal(str, QtGui.QImage)
+    finished = QtCore.Signal(str, QtGui.QImage)
+
+
+class _DecodeJob(QtCore.QRunnable):
+    def __init__(self, path, cache, preview=False, max_pixels=None):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.path = path
+        self.cache = cache
+        self.preview = preview
+        self.max_pixels = max_pixels
+        self.cancelled = False
+        self.signals = _DecodeSignals()
+
+    def run(self):
+        if self.cancelled:
+            return
+        if self.preview:
+            with profiler.section("decode preview"):
+                preview = read_image_preview(self.path)
+            if self.cancelled:
+                return
+            if preview is not None:
+                self.signals.previewReady.emit(self.path, preview)
+        with profiler.section("decode"):
+            image = read_image(self.path, self.max_pixels)
+        if self.cancelled:
+            return
+        self.cache.put(self.path, image)
+        self.signals.finished.emit(self.path, image)
+
+
+class ImagePrefetcher(QtCore.QObject):
+    """Decodes the images around the cursor on worker threads into an ImageCache.
+
+    Jobs for images that fall out of the prefetch window are cancelled. Images larger than
+    max_pixels are decoded as downsampled proxies (see read_image).
+    """
+    previewLoaded = QtCore.Signal(str, QtGui.QImage)
+    imageLoaded = QtCore.Signal(str, QtGui.QImage)
+
+    def __init__(self, cache, radius=3, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.radius = radius
+        self.max_pixels = None
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(max(1, min(4, QtCore.QThread.idealThreadCount() - 1)))
+        self._jobs = {}
+
+    def request(self, path):
+        """Return the cached image for path, or start decoding it with high priority and return None.
+
+        A reduced-resolution preview is emitted through previewLoaded when the format supports one,
+        followed by the full image through imageLoaded.
+        """
+        image = self.cache.get(path)
+        if image is not None:
+            return image
+        job = self._jobs.get(path)
+        if job is not None:
+            if job.preview or not self._pool.tryTake(job):
+                return None
+            del self._jobs[path]
+        self._start_job(path, preview=True, priority=1)
+        return None
+
+    def prefetch(self, paths, index):
+        if not paths:
+            self.cancel()
+            return
+        current = paths[index]
+        wanted = []
+        for offset in range(1, self.radius + 1):
+            for i in (index + offset, index - offset):
+                path = paths[i % len(paths)]
+                if path not in wanted and path != current:
+                    wanted.append(path)
+
+        for path in list(self._jobs):
+            if path not in wanted and path != current:
+                self._cancel_job(path)
+
+        for path in wanted:
+            if path in self._jobs or self.cache.contains(path):
+                continue
+            self._start_job(path)
+
+    def cancel(self):
+        for path in list(self._jobs):
+            self._cancel_job(path)
+
+    def invalidate(self, path):
+        self._cancel_job(path)
+        self.cache.invalidate(path)
+
+    def _start_job(self, path, preview=False, priority=0):
+        job = _DecodeJob(path, self.cache, preview, self.max_pixels)
+        job.signals.previewReady.connect(self.previewLoaded)
+        job.signals.finished.connect(self._on_job_finished)
+        self._jobs[path] = job
+        self._pool.start(job, priority)
+
+    def _cancel_job(self, path):
+        job = self._jobs.pop(path, None)
+        if job is None:
+            return
+        job.cancelled = True
+        self._pool.tryTake(job)
+
+    @QtCore.Slot(str, QtGui.QImage)
+    def _on_job_finished(self, path, image):
+        job = self._jobs.get(path)
+        if job is not None and job.signals is self.sender():
+            del self._jobs[path]
+        self.imageLoaded.emit(path, image)
@@ -0,0 +1,201 @@
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from PySide6 import QtCore
+
+from dataset_index import DatasetIndex
+
+
+HASH_BITS = 64
+_BIT_WEIGHTS = 1 << np.arange(HASH_BITS - 1, -1, -1, dtype=np.uint64)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def _pack_bits(bits):
+    """Pack an (N, 64) boolean array into N uint64 hashes, first bit most significant."""
+    return (bits.astype(np.uint64) * _BIT_WEIGHTS).sum(axis=1, dtype=np.uint64)
+
+
+def hash_images(paths):
+    """Return (dhash, phash) as signed 64-bit ints for each path, or None where it cannot be decoded.
+
+    Runs in a worker process. Decoding is per image (JPEGs are decoded at reduced size via draft), then
+    both hashes are computed for the whole batch at once with NumPy.
+    """
+    from PIL import Image
+
+    small = []
+    large = []
+    ok = []
+    for path in paths:
+        try:
+            with Image.open(path) as image:
+                image.draft("L", (64, 64))
+                image = image.convert("L")
+                small.append(np.asarray(image.resize((9, 8), Image.Resampling.BOX), dtype=np.int16))
+                large.append(np.asarray(image.resize((32, 32), Image.Resampling.BOX), dtype=np.float32))
+            ok.append(True)
+        except Exception:
+            ok.append(False)
+    if not small:
+        return [None] * len(paths)
+
+    small = np.stack(small)
+    dhashes = _pack_bits((small[:, :, 1:] > small[:, :, :-1]).reshape(len(small), -1))
+
+    # 2D DCT of every 32x32 image at once; the lowest 8x8 frequencies are compared to their median
+    coefficients = np.einsum("ij,njk,lk->nil", _DCT_32, np.stack(large), _DCT_32)[:, :8, :8].reshape(len(large), -1)
+    medians = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    phashes = _pack_bits(coefficients > medians)
+
+    results = iter(zip(dhashes.view(np.int64).tolist(), phashes.view(np.int64).tolist()))
+    return [next(results) if success else None for success in ok]
+
+
+def hamming(a, b):
+    return np.bitwise_count(np.bitwise_xor(a, b))
+
+
+def near_pairs(hashes, max_distance):
+    """Return (i, j) index arrays, i < j, of all uint64 hashes within max_distance bits of each other.
+
+    Multi-index hashing: the hashes are split into max_distance + 1 bit ranges, so by the pigeonhole
+    principle any two within max_distance agree exactly on at least one range. For each range the
+    hashes are sorted by it and only neighbours with equal values are compared, which keeps the work
+    close to linear in the number of hashes instead of quadratic.
+    """
+    count = len(hashes)
+    chunks = max_distance + 1
+    found_i = []
+    found_j = []
+    start = 0
+    for c in range(chunks):
+        width = HASH_BITS // chunks + (1 if c < HASH_BITS % chunks else 0)
+        values = (hashes >> np.uint64(start)) & np.uint64((1 << width) - 1)
+        start += width
+        order = np.argsort(values, kind="stable")
+        sorted_values = values[order]
+        sorted_hashes = hashes[order]
+        offset = 1
+        active = np.nonzero(sorted_values[:-1] == sorted_values[1:])[0]
+        while active.size:
+            close = active[hamming(sorted_hashes[active], sorted_hashes[active + offset]) <= max_distance]
+            a = order[close]
+            b = order[close + offset]
+            found_i.append(np.minimum(a, b))
+            found_j.append(np.maximum(a, b))
+            offset += 1
+            active = active[active + offset < count]
+            active = active[sorted_values[active] == sorted_values[active + offset]]
+    if not found_i:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    pairs = np.unique(np.stack([np.concatenate(found_i), np.concatenate(found_j)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def find_clusters(paths, dhashes, phashes, max_distance=4):
+    """Group paths into clusters of duplicates and near-duplicates, largest clusters first.
+
+    Two images are linked when both their dHash and pHash are within max_distance bits; clusters are
+    the connected components of those links. Identical hash pairs are collapsed before the search.
+    """
+    if not paths:
+        return []
+    keys = np.stack([np.asarray(dhashes, np.int64).view(np.uint64), np.asarray(phashes, np.int64).view(np.uint64)], axis=1)
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    i, j = near_pairs(unique_keys[:, 0], max_distance)
+    close = hamming(unique_keys[i, 1], unique_keys[j, 1]) <= max_distance
+    i, j = i[close], j[close]
+
+    parent = list(range(len(unique_keys)))
+
+    def root(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        ra, rb = root(a), root(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    clusters = {}
+    for path, key in zip(paths, inverse.tolist()):
+        clusters.setdefault(root(key), []).append(path)
+    return sorted((cluster for cluster in clusters.values() if len(cluster) > 1), key=len, reverse=True)
+
+
+class DuplicateFinder(QtCore.QThread):
+    """Hashes the images of a folder in a process pool and clusters the near-duplicates.
+
+    Hashes are stored in the folder's DatasetIndex together with the size and mtime they were computed
+    for, so only new and changed images are hashed again.
+    """
+    progress = QtCore.Signal(int, int)
+    clustersFound = QtCore.Signal(list)
+
+    def __init__(self, folder, images, max_distance=4, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.images = images
+        self.max_distance = max_distance
+
+    def run(self):
+        index = DatasetIndex(self.folder)
+        try:
+            stored = index.hashes()
+            current = dict(index.entries())
+            hashes = {}
+            stale = []
+            for path in self.images:
+                entry = current.get(path)
+                if entry is None:
+                    continue
+                row = stored.get(path)
+                if row is not None and row[:2] == (entry.size, entry.mtime_ns):
+                    hashes[path] = row[2:]
+                else:
+                    stale.append(path)
+            if stale and not self._hash(index, stale, current, hashes):
+                return
+        finally:
+            index.close()
+        paths = [path for path in self.images if path in hashes]
+        self.clustersFound.emit(find_clusters(paths, [hashes[p][0] for p in paths], [hashes[p][1] for p in paths], self.max_distance))
+
+    def _hash(self, index, stale, entries, hashes):
+        chunk_size = 256
+        chunks = [stale[i:i + chunk_size] for i in range(0, len(stale), chunk_size)]
+        done = 0
+        workers = max(1, min(8, (os.cpu_count() or 2) - 1))
+        # spawn, not fork: forking a process that runs Qt threads is unsafe
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for chunk, results in zip(chunks, executor.map(hash_images, chunks)):
+                if self.isInterruptionRequested():
+                    executor.shutdown(cancel_futures=True)
+                    return False
+                rows = []
+                for path, result in zip(chunk, results):
+                    if result is not None:
+                        hashes[path] = result
+                        rows.append((path, entries[path].size, entries[path].mtime_ns, *result))
+                index.set_hashes(rows)
+                done += len(chunk)
+                self.progress.emit(done, len(stale))
+        return True
@@ -1,17 +1,25 @@
+import argparse
 import os
 import sys
 
 from functools import partial
 
-from PySide6.QtCore import Qt
-from PySide6.QtCore import *
-from PySide6.QtGui import *
-import PySide6.QtGui
-from PySide6.QtWidgets import *
+# explicit names: a wildcard import of the Qt modules instantiates every binding and slows startup
+from PySide6.QtCore import QSettings, QSize, Qt, QTimer
+from PySide6.QtGui import QAction, QCloseEvent, QImageReader, QKeySequence, QMouseEvent
+from PySide6.QtWidgets import (QApplication, QDockWidget, QFileDialog, QHBoxLayout, QInputDialog, QLabel, QLineEdit, QMainWindow,
+                               QMenu, QMenuBar, QMessageBox, QPlainTextEdit, QPushButton, QSpacerItem, QStatusBar, QVBoxLayout, QWidget)
 
 import send2trash
 
+from autosave import AutosaveWriter, MaskSaver
+from bulk_edit import BulkEditDialog, journals, revert
+from dataset_index import CAPTION_EXTS, DatasetIndex, FolderScanner, FolderWatcher, MASK_DIR, TAG_EXTS, merge_images
+from image_cache import ImageCache, ImagePrefetcher
 from photo_view import PhotoView, MaskDrawPhotoView
+from profiling import profiler
+from tag_index import TagIndexBuilder, parse_tags, read_tags
+from thumbnails import ThumbnailBrowser, ThumbnailLoader, ThumbnailModel
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -41,6 +49,20 @@ class MainWindow(QMainWindow):
         self.trash_button.setStyleSheet("background-color: red")
         self.header_layout.addWidget(self.trash_button)
 
+        # Tag filter
+
+        self.filter_bar = QLineEdit()
+        self.filter_bar.setPlaceholderText("Filter by tags: 1girl, red hair | blue hair, -hat")
+        self.filter_bar.setClearButtonEnabled(True)
+        self.filter_bar.setEnabled(False)
+        self.filter_bar.textChanged.connect(lambda: self.filter_timer.start())
+        self.layout.addWidget(self.filter_bar)
+
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(150)
+        self.filter_timer.timeout.connect(self.apply_filter)
+
         # Mode selection
 
         # self.radio_button_layout = QHBoxLayout()
@@ -71,7 +93,23 @@ class MainWindow(QMainWindow):
         self.image_view.maskModified.connect(self.on_mask_modified)
         self.layout.addWidget(self.image_view)
 
+        # opaque, so refreshing it does not repaint the image underneath
+        self.performance_overlay = QLabel(self.image_view)
+        self.performance_overlay.setStyleSheet("background-color: rgb(20, 20, 20); color: rgb(180, 240, 180); font-family: monospace; padding: 4px")
+        self.performance_overlay.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.performance_overlay.move(8, 8)
+        self.performance_overlay.hide()
+        self.performance_timer = QTimer(self)
+        self.performance_timer.setInterval(500)
+        self.performance_timer.timeout.connect(self.update_performance_overlay)
+
         self.allow_autosave = True
+        self.autosave = AutosaveWriter(parent=self)
+        self.autosave.flushed.connect(self.on_autosave_flushed)
+        self.autosave.writeFailed.connect(self.on_autosave_failed)
+        self.mask_saver = MaskSaver(self)
+        self.mask_saver.maskSaved.connect(self.on_mask_saved)
+        self.mask_saver.saveFailed.connect(self.on_autosave_failed)
 
         # Image annotations
         
@@ -126,6 +164,10 @@ class MainWindow(QMainWindow):
         self.menu_bar = QMenuBar()
         self.setMenuBar(self.menu_bar)
 
+        # created up front so the first save message does not relayout (and fully repaint) the image view
+        self.status_bar = QStatusBar()
+        self.setStatusBar(self.status_bar)
+
         self.file_menu = QMenu("File", self)
         self.menu_bar.addMenu(self.file_menu)
         self.open_folder_action = QAction("Open Folder", self)
@@ -151,11 +193,142 @@ class MainWindow(QMainWindow):
         self.invert_mask_action.triggered.connect(self.image_view.invert_mask)
         self.mask_menu.addAction(self.invert_mask_action)
 
+        # Thumbnail browser
+
+        self.thumbnail_loader = ThumbnailLoader(parent=self)
+        self.thumbnail_loader.thumbnailFailed.connect(self.on_thumbnail_failed)
+        self.thumbnail_model = ThumbnailModel(self.thumbnail_loader, self)
+        self.thumbnail_browser = ThumbnailBrowser(self.thumbnail_model)
+        self.thumbnail_browser.imageSelected.connect(self.select_image)
+        self.thumbnail_dock = QDockWidget("Thumbnails", self)
+        self.thumbnail_dock.setWidget(self.thumbnail_browser)
+        self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, self.thumbnail_dock)
+
+        self.view_menu = QMenu("View", self)
+        self.menu_bar.addMenu(self.view_menu)
+        self.toggle_thumbnails_action = self.thumbnail_dock.toggleViewAction()
+        self.toggle_thumbnails_action.setShortcut(QKeySequence("Ctrl+T"))
+        self.view_menu.addAction(self.toggle_thumbnails_action)
+        self.view_menu.addSeparator()
+
+        self.performance_overlay_action = QAction("Performance Overlay", self)
+        self.performance_overlay_action.setCheckable(True)
+        self.performance_overlay_action.setShortcut(QKeySequence("Ctrl+Shift+P"))
+        self.performance_overlay_action.toggled.connect(self.set_performance_overlay)
+        self.view_menu.addAction(self.performance_overlay_action)
+
+        self.record_trace_action = QAction("Record Trace...", self)
+        self.record_trace_action.setCheckable(True)
+        self.record_trace_action.toggled.connect(self.set_trace_recording)
+        self.view_menu.addAction(self.record_trace_action)
+
+        self.proxy_budget_action = QAction("Proxy Pixel Budget...", self)
+        self.proxy_budget_action.triggered.connect(self.ask_proxy_megapixels)
+        self.view_menu.addAction(self.proxy_budget_action)
+
+        self.tools_menu = QMenu("Tools", self)
+        self.menu_bar.addMenu(self.tools_menu)
+
+        self.find_duplicates_action = QAction("Find Duplicates", self)
+        self.find_duplicates_action.setShortcut(QKeySequence("Ctrl+Shift+D"))
+        self.find_duplicates_action.triggered.connect(self.find_duplicates)
+        self.tools_menu.addAction(self.find_duplicates_action)
+
+        self.next_cluster_action = QAction("Next Duplicate Cluster", self)
+        self.next_cluster_action.setShortcut(QKeySequence("Ctrl+Down"))
+        self.next_cluster_action.triggered.connect(partial(self.step_duplicate_cluster, 1))
+        self.tools_menu.addAction(self.next_cluster_action)
+
+        self.prev_cluster_action = QAction("Previous Duplicate Cluster", self)
+        self.prev_cluster_action.setShortcut(QKeySequence("Ctrl+Up"))
+        self.prev_cluster_action.triggered.connect(partial(self.step_duplicate_cluster, -1))
+        self.tools_menu.addAction(self.prev_cluster_action)
+
+        self.exit_duplicates_action = QAction("Exit Duplicate Review", self)
+        self.exit_duplicates_action.triggered.connect(self.apply_filter)
+        self.tools_menu.addAction(self.exit_duplicates_action)
+
+        self.tools_menu.addSeparator()
+
+        self.bulk_edit_action = QAction("Bulk Edit Captions and Tags...", self)
+        self.bulk_edit_action.setShortcut(QKeySequence("Ctrl+Shift+H"))
+        self.bulk_edit_action.triggered.connect(self.bulk_edit)
+        self.tools_menu.addAction(self.bulk_edit_action)
+
+        self.revert_bulk_edit_action = QAction("Revert Last Bulk Edit", self)
+        self.revert_bulk_edit_action.triggered.connect(self.revert_bulk_edit)
+        self.tools_menu.addAction(self.revert_bulk_edit_action)
+
         self.images = []
+        self.all_images = self.images  # self.images is a filtered subset of this while a tag filter is active
         self.current_image = 0
+        self.dataset_index = None
+        self.tag_index = None
+        self.tag_index_builder = None
+        self.folder_scanner = None
+        self.duplicate_finder = None
+        self.duplicate_clusters = None  # while reviewing duplicates, self.images is these clusters back to back
+        self.duplicate_cluster_of = {}
+        self.set_duplicate_review(None)
+        self.current_image_size = QSize()
+
+        self.image_cache = ImageCache()
+        self.prefetcher = ImagePrefetcher(self.image_cache, parent=self)
+        self.prefetcher.previewLoaded.connect(self.on_preview_loaded)
+        self.prefetcher.imageLoaded.connect(self.on_image_loaded)
+        self.settings = QSettings()
+        self.set_proxy_megapixels(int(self.settings.value("view/proxy_megapixels", 24)))
+        geometry = self.settings.value("window/geometry")
+        if geometry is not None:
+            self.restoreGeometry(geometry)
+        self.start_image = None
+
+        self.folder_watcher = FolderWatcher(parent=self)
+        self.folder_watcher.changed.connect(self.on_folder_changed)
+        self.autosave.written.connect(self.on_autosave_written)
+
+        # IMAGE_DATA_TOOL_PROFILE and IMAGE_DATA_TOOL_TRACE switch these on at startup
+        self.performance_overlay_action.setChecked(profiler.enabled)
+        self.record_trace_action.setChecked(profiler.tracing)
 
         #self.select_mode("caption", self.caption_mode_button)  # reset to consistent state
-        self.open_folder("./example_dataset")
+
+    def restore_session(self, dataset=None, start=None):
+        """Open dataset (a folder, or an image in one) at start, or else the folder and image of the last session."""
+        if dataset and not os.path.exists(dataset):
+            self.statusBar().showMessage(f"{dataset} does not exist, opened the last session instead", 5000)
+            dataset = start = None
+        if not dataset:
+            folder = self.settings.value("session/folder")
+            if folder and os.path.isdir(folder):
+                dataset = folder
+                start = start or self.settings.value("session/image")
+            else:
+                dataset = "./example_dataset"
+        elif os.path.isfile(dataset):
+            start = start or os.path.abspath(dataset)
+            dataset = os.path.dirname(os.path.abspath(dataset))
+        self.open_folder(dataset, start)
+
+    def save_session(self):
+        if self.dataset_index is not None:
+            self.settings.setValue("session/folder", os.path.abspath(self.dataset_index.folder))
+            if self.images:
+                self.settings.setValue("session/image", os.path.relpath(self.images[self.current_image], self.dataset_index.folder))
+            else:
+                self.settings.remove("session/image")
+        self.settings.setValue("window/geometry", self.saveGeometry())
+
+    def closeEvent(self, event: QCloseEvent) -> None:
+        self.save_session()
+        self.autosave.wait()
+        self.mask_saver.wait()
+        self.image_view.waitForMaskLoads()
+        self.stop_workers()
+        self.folder_watcher.stop()
+        self.thumbnail_loader.shutdown()
+        profiler.stop_trace()
+        super().closeEvent(event)
 
     def mousePressEvent(self, event: QMouseEvent) -> None:
         if event.button() == Qt.MouseButton.BackButton:
@@ -168,16 +341,311 @@ class MainWindow(QMainWindow):
             return
         super().mousePressEvent(event)
 
-    def open_folder(self, path=None):
+    def open_folder(self, path=None, start=None):
+        """Open the dataset at path (asking for one if not given), showing start first: an index, or an image's path or file name."""
         folder_path = path if path else QFileDialog.getExistingDirectory(self, "Select Folder")
         if folder_path:
+            self.start_image = str(start) if start is not None else None
             self.images = []
+            self.all_images = self.images
             self.current_image = 0
-            for file_name in os.listdir(folder_path):
-                if file_name.endswith(('.png', '.jpg', '.jpeg')):
-                    self.images.append(os.path.join(folder_path, file_name))
+            self.tag_index = None
+            self.stop_workers()
+            self.set_duplicate_review(None)
+            self.filter_bar.setEnabled(False)
+            self.prefetcher.cancel()
+            self.image_cache.clear()
+            self.folder_watcher.stop()
+            if self.dataset_index is not None:
+                self.dataset_index.close()
+            self.dataset_index = DatasetIndex(folder_path)
+            self.thumbnail_loader.clear()
+            self.thumbnail_model.setImages(self.images, self.dataset_index)
+            self.image_view.setPhoto(None)
+            self.image_title.setText(f"{folder_path}\nScanning...")
+            self.folder_scanner = FolderScanner(folder_path, self)
+            self.folder_scanner.imagesFound.connect(self.on_images_found)
+            self.folder_scanner.finished.connect(self.on_folder_scan_finished)
+            self.folder_scanner.start()
+
+    def stop_workers(self):
+        """Interrupt the folder scan, tag index build and duplicate search, and wait until they have stopped."""
+        for thread in (self.folder_scanner, self.tag_index_builder, self.duplicate_finder):
+            if thread is not None:
+                thread.requestInterruption()
+                # all of them check for interruption between batches, so this is short
+                thread.wait()
+        self.folder_scanner = None
+        self.tag_index_builder = None
+        self.duplicate_finder = None
+
+    def on_images_found(self, paths):
+        if self.sender() is not self.folder_scanner:
+            return
+        first_batch = not self.all_images
+        self.all_images.extend(paths)
+        if self.images is not self.all_images:
+            return
+        self.thumbnail_model.imagesAppended(len(paths))
+        if self.start_image is not None:
+            # nothing is shown until the start image has been found
+            index = self.find_start_image(paths)
+            if index is None:
+                return
+            self.start_image = None
+            self.current_image = index
+            self.display_image()
+        elif first_batch:
+            self.display_image()
+        else:
+            self.display_title(self.current_image_size)
+
+    def find_start_image(self, paths):
+        """The index in all_images of start_image, if it is the index of a found image or among paths, just appended."""
+        if self.start_image.isdigit():
+            index = int(self.start_image)
+            return index if index < len(self.all_images) else None
+        target = os.path.normcase(os.path.abspath(os.path.join(self.dataset_index.folder, self.start_image)))
+        offset = len(self.all_images) - len(paths)
+        for i, path in enumerate(paths):
+            if os.path.normcase(os.path.abspath(path)) == target or os.path.basename(path) == self.start_image:
+                return offset + i
+        return None
+
+    def on_folder_scan_finished(self):
+        scanner = self.sender()
+        if scanner is self.folder_scanner:
+            self.folder_scanner = None
+            if self.start_image is not None:
+                self.statusBar().showMessage(f"{self.start_image} is not in {scanner.folder}", 5000)
+                self.start_image = None
+                if self.images:
+                    self.display_image()
+            self.folder_watcher.watch(scanner.folder, self.dataset_index.dirs())
+            if self.images:
+                self.folder_watcher.watchFiles(self.current_files())
+            self.tag_index_builder = TagIndexBuilder(scanner.folder, list(self.all_images), self)
+            self.tag_index_builder.built.connect(self.on_tag_index_built)
+            self.tag_index_builder.finished.connect(self.tag_index_builder.deleteLater)
+            self.tag_index_builder.start()
+        scanner.deleteLater()
+
+    def on_tag_index_built(self, tag_index):
+        if self.sender() is not self.tag_index_builder:
+            return
+        self.tag_index_builder = None
+        # the folder watcher may have added or removed images while it was being built
+        listed = set(self.all_images)
+        for path in [path for path in tag_index.ids if path not in listed]:
+            tag_index.remove(path)
+        for path in self.all_images:
+            if path not in tag_index.ids:
+                tag_index.set_tags(path, read_tags(self.tag_file(path)))
+        self.tag_index = tag_index
+        self.filter_bar.setEnabled(True)
+        if self.filter_bar.text():
+            self.apply_filter()
+
+    def apply_filter(self):
+        query = self.filter_bar.text().strip()
+        if query and self.tag_index is None:
+            return
+        self.set_duplicate_review(None)
+        self.show_images(self.tag_index.query(query) if query else self.all_images)
+        if not self.images:
+            self.image_view.setPhoto(None)
+            self.display_annotations()
+            self.image_title.setText(f"No images match \"{query}\"")
+
+    def show_images(self, images):
+        """Switch the browsed list to images (all_images or a subset of it), staying on the current file if it is in there."""
+        current = self.images[self.current_image] if self.images else None
+        self.images = images
+        self.current_image = 0
+        if current is not None:
+            try:
+                self.current_image = self.images.index(current)
+            except ValueError:
+                pass
+        self.thumbnail_model.setImages(self.images, self.dataset_index)
+        if self.images:
             self.display_image()
 
+    def on_folder_changed(self, changes):
+        """Apply images and sidecar files added, removed or changed by other programs, without a rescan."""
+        current = self.images[self.current_image] if self.images else None
+        removed = set(changes["removed"])
+        modified = set(changes["modified"])
+        for path in removed:
+            self.prefetcher.invalidate(path)
+            # a queued write would bring the caption or tags of a deleted image back
+            self.autosave.discard(os.path.splitext(path)[0] + ".txt")
+            self.autosave.discard(os.path.splitext(path)[0] + ".tag")
+            if self.tag_index is not None:
+                self.tag_index.remove(path)
+            cluster = self.duplicate_cluster_of.pop(path, None)
+            if cluster is not None:
+                cluster.remove(path)
+        for path in modified:
+            self.prefetcher.invalidate(path)
+
+        # rows are removed and inserted in place; resetting the model would relayout every thumbnail
+        query = self.filter_bar.text().strip()
+        filtered = self.images is not self.all_images and self.duplicate_clusters is None and query and self.tag_index is not None
+        removed_rows = [row for row, path in enumerate(self.images) if path in removed] if removed and not filtered else []
+        if removed:
+            if self.images is not self.all_images and not filtered:
+                self.images[:] = [path for path in self.images if path not in removed]
+            self.all_images[:] = [path for path in self.all_images if path not in removed]
+            self.thumbnail_model.imagesRemoved(removed_rows)
+        if changes["added"]:
+            merge_images(self.all_images, changes["added"])
+            if self.images is self.all_images:
+                added = set(changes["added"])
+                self.thumbnail_model.imagesInserted([row for row, path in enumerate(self.images) if path in added])
+        if self.tag_index is not None:
+            for path in changes["added"] + changes["annotated"]:
+                self.tag_index.set_tags(path, read_tags(self.tag_file(path)))
+        if filtered:
+            images = self.tag_index.query(query)
+            if images != self.images:
+                self.images = images
+                self.thumbnail_model.setImages(self.images, self.dataset_index)
+        if modified or changes["annotated"]:
+            # badges and thumbnails are read from the index on paint
+            self.thumbnail_browser.viewport().update()
+        if not self.images:
+            self.current_image = 0
+            self.image_view.setPhoto(None)
+            self.image_title.setText("No images")
+            return
+
+        try:
+            self.current_image = self.images.index(current)
+        except ValueError:
+            # the image on screen is gone; show the one that took its place
+            self.current_image = min(self.current_image, len(self.images) - 1)
+            self.display_image()
+            return
+        if current in modified:
+            self.display_image()
+            return
+        self.display_title(self.current_image_size)
+        self.thumbnail_browser.setCurrentRow(self.current_image)
+        if current in changes["annotated"] and self.annotations_changed():
+            self.display_annotations()
+
+    def annotations_changed(self):
+        """True if the caption or tag files of the current image differ from the editors and have no edits queued."""
+        path = self.images[self.current_image]
+        entry = self.dataset_index.get(path)
+        for ext, editor in ((entry.caption_ext, self.image_caption), (entry.tag_ext, self.image_tags)):
+            if not ext:
+                if not editor.isHidden():
+                    return True
+                continue
+            annotation_file = os.path.splitext(path)[0] + ext
+            if self.autosave.text(annotation_file) is not None:
+                return False  # being edited here; the queued write wins
+            try:
+                if editor.isHidden() or self.read_annotation(annotation_file) != editor.toPlainText():
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def current_files(self):
+        """The current image and any caption and tag files it may have."""
+        stem = os.path.splitext(self.images[self.current_image])[0]
+        return [self.images[self.current_image]] + [stem + ext for ext in CAPTION_EXTS + TAG_EXTS]
+
+    def tag_file(self, path):
+        entry = self.dataset_index.get(path)
+        return os.path.splitext(path)[0] + entry.tag_ext if entry is not None and entry.tag_ext else None
+
+    def find_duplicates(self):
+        if self.dataset_index is None or self.folder_scanner is not None or self.duplicate_finder is not None:
+            self.status_bar.showMessage("Wait for the folder scan to finish first" if self.folder_scanner else "Already searching", 3000)
+            return
+        # imported here: it pulls in numpy, which is slow to import at startup
+        from image_hash import DuplicateFinder
+        self.duplicate_finder = DuplicateFinder(self.dataset_index.folder, list(self.all_images), parent=self)
+        self.duplicate_finder.progress.connect(self.on_duplicate_progress)
+        self.duplicate_finder.clustersFound.connect(self.on_duplicates_found)
+        self.duplicate_finder.finished.connect(self.duplicate_finder.deleteLater)
+        self.duplicate_finder.start()
+        self.status_bar.showMessage("Searching for duplicates...")
+
+    def on_duplicate_progress(self, done, total):
+        if self.sender() is self.duplicate_finder:
+            self.status_bar.showMessage(f"Hashing images {done}/{total}")
+
+    def on_duplicates_found(self, clusters):
+        if self.sender() is not self.duplicate_finder:
+            return
+        self.duplicate_finder = None
+        if not clusters:
+            self.status_bar.showMessage("No duplicates found", 5000)
+            return
+        self.status_bar.showMessage(f"{len(clusters)} clusters of duplicates, {sum(len(c) for c in clusters)} images", 5000)
+        self.set_duplicate_review(clusters)
+        self.current_image = 0
+        self.images = []
+        self.show_images([path for cluster in clusters for path in cluster])
+
+    def set_duplicate_review(self, clusters):
+        self.duplicate_clusters = clusters
+        self.duplicate_cluster_of = {path: cluster for cluster in clusters or () for path in cluster}
+        for action in (self.next_cluster_action, self.prev_cluster_action, self.exit_duplicates_action):
+            action.setEnabled(clusters is not None)
+
+    def step_duplicate_cluster(self, step):
+        if not self.duplicate_clusters or not self.images:
+            return
+        clusters = [cluster for cluster in self.duplicate_clusters if cluster]
+        k = clusters.index(self.duplicate_cluster_of[self.images[self.current_image]])
+        self.current_image = self.images.index(clusters[(k + step) % len(clusters)][0])
+        self.display_image()
+
+    def bulk_edit(self):
+        if self.dataset_index is None:
+            return
+        # queued edits would land after, and undo, the bulk edit
+        self.autosave.wait()
+        listed = self.images if self.images is not self.all_images else None
+        dialog = BulkEditDialog(self.dataset_index.folder, list(self.all_images), listed and list(listed), self)
+        dialog.applied.connect(self.on_annotations_rewritten)
+        dialog.exec()
+        dialog.deleteLater()
+
+    def revert_bulk_edit(self):
+        if self.dataset_index is None:
+            return
+        available = journals(self.dataset_index.folder)
+        if not available:
+            self.status_bar.showMessage("No bulk edit to revert", 3000)
+            return
+        answer = QMessageBox.question(self, "Revert Bulk Edit", f"Revert the bulk edit {os.path.basename(available[0])}?")
+        if answer != QMessageBox.StandardButton.Yes:
+            return
+        self.autosave.wait()
+        written, skipped = revert(available[0])
+        self.on_annotations_rewritten(written)
+        self.status_bar.showMessage(f"Reverted {len(written)} files" + (f", skipped {len(skipped)} edited since" if skipped else ""), 5000)
+
+    def on_annotations_rewritten(self, paths):
+        """Bring the tag index and the shown caption and tags up to date after files were rewritten outside the editors."""
+        for path in paths:
+            self.folder_watcher.ignore(path)
+        if self.tag_index is not None:
+            images = {os.path.splitext(image)[0]: image for image in self.all_images}
+            for path in paths:
+                image = images.get(os.path.splitext(path)[0])
+                if image is not None and path.endswith(TAG_EXTS):
+                    with open(path) as f:
+                        self.tag_index.set_tags(image, parse_tags(f.read()))
+        self.display_annotations()
+
     def select_mode(self, mode, button):
         checked = button.isChecked()
         if not checked:
@@ -198,24 +666,70 @@ class MainWindow(QMainWindow):
     def display_image(self):
         if not self.images:
             return
+        self.autosave.flush()
         self.allow_autosave = False
-        pixmap = QPixmap(self.images[self.current_image])
+        entry = self.dataset_index.get(self.images[self.current_image])
+        image = self.prefetcher.request(self.images[self.current_image])
+        # the indexed header size lets the view and mask canvas take their full-resolution size immediately,
+        # and is the size of the photo when the decoded image is a proxy
+        size = QSize(entry.width, entry.height)
+        if image is not None:
+            self.image_view.setPhoto(image, size)
+            self.display_title(self.image_view.getPhotoSize())
+        else:
+            self.image_view.setPhoto(None, size)
+            self.display_title(size)
+
+        if entry.has_mask:
+            mask_file = os.path.join(os.path.dirname(self.images[self.current_image]), MASK_DIR, os.path.basename(self.images[self.current_image]))
+            self.image_view.loadMask(mask_file)
+        self.display_annotations()
+        self.allow_autosave = True
+        self.thumbnail_browser.setCurrentRow(self.current_image)
+        self.prefetcher.prefetch(self.images, self.current_image)
+        self.folder_watcher.watchFiles(self.current_files())
+
+    def update_index(self, path, **fields):
+        self.dataset_index.update(path, **fields)
+        # badges are read from the index on paint
+        self.thumbnail_browser.viewport().update()
+
+    def select_image(self, index):
+        if 0 <= index < len(self.images):
+            self.current_image = index
+            self.display_image()
+
+    def display_title(self, size):
+        self.current_image_size = size
         image_name = os.path.basename(self.images[self.current_image])
-        image_filesize_text = sizeof_fmt(os.path.getsize(self.images[self.current_image]))
-        if pixmap.isNull():
-            self.image_view.setPhoto(None)
+        image_filesize_text = sizeof_fmt(self.dataset_index.get(self.images[self.current_image]).size)
+        if not size.isValid() or size.isEmpty():
             self.image_title.setText(f"{image_name}\nError loading image    {image_filesize_text}")
         else:
-            self.image_view.setPhoto(pixmap)
-            aspect_text = aspect_fmt(pixmap.width(), pixmap.height())
-            size_text = f"{pixmap.width()}x{pixmap.height()}"
+            aspect_text = aspect_fmt(size.width(), size.height())
+            size_text = f"{size.width()}x{size.height()}"
+            if self.image_view.isProxy():
+                size_text += " (proxy)"
             self.image_title.setText(f"{image_name}    ({self.current_image + 1}/{len(self.images)})\n{size_text} {aspect_text}    {image_filesize_text}")
+        cluster = self.duplicate_cluster_of.get(self.images[self.current_image])
+        if cluster is not None:
+            clusters = [c for c in self.duplicate_clusters if c]
+            self.image_title.setText(f"{self.image_title.text()}\nDuplicate cluster {clusters.index(cluster) + 1}/{len(clusters)}, "
+                                     f"image {cluster.index(self.images[self.current_image]) + 1} of {len(cluster)}")
+
+    def on_preview_loaded(self, path, image):
+        if not self.images or path != self.images[self.current_image]:
+            return
+        self.image_view.updatePhoto(image)
 
-        mask_file = os.path.join(os.path.join(os.path.dirname(self.images[self.current_image]), "mask/"), os.path.basename(self.images[self.current_image]))
-        if os.path.exists(mask_file):
-            self.image_view.setMask(QPixmap(mask_file))
-        self.display_annotations()
-        self.allow_autosave = True
+    def on_image_loaded(self, path, image):
+        if not self.images or path != self.images[self.current_image]:
+            return
+        if image.isNull():
+            self.image_view.setPhoto(None)
+            self.display_title(image.size())
+        else:
+            self.image_view.updatePhoto(image)
 
     def display_annotations(self):
         if not self.images:
@@ -227,24 +741,26 @@ class MainWindow(QMainWindow):
         self.image_tags.setVisible(False)
         self.image_tags.setPlainText("")
         self.create_tags_button.setVisible(True)
-        for ext in (".txt", ".caption"):
-            caption_file = os.path.splitext(self.images[self.current_image])[0] + ext
-            if os.path.exists(caption_file):
-                with open(caption_file) as f:
-                    self.image_caption.setPlainText(f.read())
-                    self.image_caption.setVisible(True)
-                    self.create_caption_button.setVisible(False)
-                    break
-        for ext in (".tag", ".tags"):
-            caption_file = os.path.splitext(self.images[self.current_image])[0] + ext
-            if os.path.exists(caption_file):
-                with open(caption_file) as f:
-                    self.image_tags.setPlainText(f.read())
-                    self.image_tags.setVisible(True)
-                    self.create_tags_button.setVisible(False)
-                    break
+        entry = self.dataset_index.get(self.images[self.current_image])
+        if entry.caption_ext:
+            caption_file = os.path.splitext(self.images[self.current_image])[0] + entry.caption_ext
+            self.image_caption.setPlainText(self.read_annotation(caption_file))
+            self.image_caption.setVisible(True)
+            self.create_caption_button.setVisible(False)
+        if entry.tag_ext:
+            caption_file = os.path.splitext(self.images[self.current_image])[0] + entry.tag_ext
+            self.image_tags.setPlainText(self.read_annotation(caption_file))
+            self.image_tags.setVisible(True)
+            self.create_tags_button.setVisible(False)
         self.allow_autosave = True
 
+    def read_annotation(self, path):
+        text = self.autosave.text(path)
+        if text is None:
+            with profiler.section("read annotation"), open(path) as f:
+                text = f.read()
+        return text
+
     def set_image_index(self):
         index, ok = QInputDialog.getInt(self, "Set Current Image Index", "Index:", self.current_image, 0, len(self.images) - 1)
         if ok:
@@ -258,6 +774,8 @@ class MainWindow(QMainWindow):
         if not os.path.exists(caption_file):
             with open(caption_file, "w") as f:
                 f.write("")
+            self.folder_watcher.ignore(caption_file)
+        self.update_index(self.images[self.current_image], caption_ext=".txt")
         self.display_annotations()
     
     def on_caption_changed(self):
@@ -272,8 +790,9 @@ class MainWindow(QMainWindow):
         if not self.images or not self.allow_autosave:
             return
         caption_file = os.path.splitext(self.images[self.current_image])[0] + ".txt"
-        with open(caption_file, "w") as f:
-            f.write(self.image_caption.toPlainText())
+        self.autosave.write(caption_file, self.image_caption.toPlainText())
+        if self.dataset_index.get(self.images[self.current_image]).caption_ext != ".txt":
+            self.update_index(self.images[self.current_image], caption_ext=".txt")
     
     def create_tags(self):
         if not self.images:
@@ -282,28 +801,111 @@ class MainWindow(QMainWindow):
         if not os.path.exists(caption_file):
             with open(caption_file, "w") as f:
                 f.write("")
+            self.folder_watcher.ignore(caption_file)
+        self.update_index(self.images[self.current_image], tag_ext=".tag")
         self.display_annotations()
 
     def on_tags_changed(self):
         if not self.images or not self.allow_autosave:
             return
         caption_file = os.path.splitext(self.images[self.current_image])[0] + ".tag"
-        with open(caption_file, "w") as f:
-            f.write(self.image_tags.toPlainText())
+        self.autosave.write(caption_file, self.image_tags.toPlainText())
+        if self.tag_index is not None:
+            self.tag_index.set_tags(self.images[self.current_image], parse_tags(self.image_tags.toPlainText()))
+        if self.dataset_index.get(self.images[self.current_image]).tag_ext != ".tag":
+            self.update_index(self.images[self.current_image], tag_ext=".tag")
     
+    def set_performance_overlay(self, enabled):
+        profiler.enabled = enabled or profiler.tracing
+        self.performance_overlay.setVisible(enabled)
+        if enabled:
+            self.update_performance_overlay()
+            self.performance_timer.start()
+        elif not profiler.tracing:
+            self.performance_timer.stop()
+
+    def update_performance_overlay(self):
+        lookups = self.image_cache.hits + self.image_cache.misses
+        hit_rate = self.image_cache.hits / lookups if lookups else 0
+        profiler.counter("image cache", hit_rate=round(hit_rate, 3), mb=round(self.image_cache.size_bytes() / 2 ** 20, 1))
+        if not self.performance_overlay.isVisible():
+            return
+        # last duration of each section, and the worst since the previous refresh
+        lines = [f"{name:15} {last:7.1f} ms  max {worst:7.1f}" for name, (last, worst) in sorted(profiler.take_stats().items())]
+        lines.append(f"cache hit rate  {hit_rate:7.0%}     of {lookups}, {sizeof_fmt(self.image_cache.size_bytes())}")
+        usage = self.image_view.memoryUsage()
+        lines.append("memory          " + ", ".join(f"{part} {sizeof_fmt(nbytes)}" for part, nbytes in usage.items()))
+        lines.append(f"                {sizeof_fmt(sum(usage.values()) + self.image_cache.size_bytes())} in total")
+        if profiler.tracing:
+            lines.append("recording trace")
+        self.performance_overlay.setText("\n".join(lines))
+        self.performance_overlay.adjustSize()
+
+    def set_proxy_megapixels(self, megapixels):
+        """Show images over this many megapixels as downsampled proxies, from the next image shown.
+
+        Their masks are still painted and saved at full resolution (see MaskDrawPhotoView).
+        """
+        self.proxy_megapixels = megapixels
+        self.settings.setValue("view/proxy_megapixels", megapixels)
+        self.prefetcher.max_pixels = megapixels * 1000000
+        self.image_view.proxy_pixels = megapixels * 1000000
+        self.image_cache.clear()
+
+    def ask_proxy_megapixels(self):
+        megapixels, ok = QInputDialog.getInt(self, "Proxy Pixel Budget", "Show images over this many megapixels downsampled:",
+                                             self.proxy_megapixels, 1, 1000)
+        if ok:
+            self.set_proxy_megapixels(megapixels)
+            self.statusBar().showMessage(f"Images over {megapixels} MP are shown as proxies from the next image on", 5000)
+
+    def set_trace_recording(self, enabled):
+        if enabled:
+            if not profiler.tracing:
+                path, _ = QFileDialog.getSaveFileName(self, "Record Trace", "trace.json", "Chrome trace (*.json)")
+                if not path:
+                    self.record_trace_action.setChecked(False)
+                    return
+                profiler.start_trace(path)
+                self.statusBar().showMessage(f"Recording trace to {path}")
+            self.performance_timer.start()  # also samples the cache counters into the trace
+        else:
+            path = profiler.stop_trace()
+            self.set_performance_overlay(self.performance_overlay_action.isChecked())
+            if path:
+                self.statusBar().showMessage(f"Saved trace to {path}", 5000)
+
+    def on_autosave_flushed(self, count, ms):
+        if count:
+            self.statusBar().showMessage(f"Saved {count} file{'s' if count > 1 else ''} in {ms:.0f} ms", 2000)
+
+    def on_autosave_written(self, paths):
+        # the tool's own saves are not changes by other programs
+        for path in paths:
+            self.folder_watcher.ignore(path)
+
+    def on_thumbnail_failed(self, path, error):
+        print(f"Failed to make thumbnail for {path}: {error}")
+
+    def on_autosave_failed(self, path, error):
+        print(f"Failed to save {path}: {error}")
+        self.statusBar().showMessage(f"Failed to save {os.path.basename(path)}: {error}")
+
     def on_mask_modified(self):
         if not self.images or not self.allow_autosave:
             return
         image_dir = os.path.dirname(self.images[self.current_image])
-        mask_dir = os.path.join(image_dir, "mask/")
-        mask_file = os.path.join(mask_dir, os.path.basename(self.images[self.current_image]))
-        mask = self.image_view.getMask()
-        # check if mask is total transparency
-        # TODO so we can delete it if it's empty
-        #mask.toImage
-        if not os.path.exists(mask_dir):
-            os.makedirs(mask_dir)
-        mask.save(mask_file)
+        mask_file = os.path.join(image_dir, MASK_DIR, os.path.basename(self.images[self.current_image]))
+        # encoded off-thread; an all-white mask deletes the file instead
+        self.mask_saver.save(mask_file, self.image_view.getMask())
+
+    def on_mask_saved(self, mask_file, saved, ms):
+        image_file = os.path.join(os.path.dirname(os.path.dirname(mask_file)), os.path.basename(mask_file))
+        self.folder_watcher.ignore(mask_file)
+        entry = self.dataset_index.get(image_file)
+        if entry is not None and entry.has_mask != saved:
+            self.update_index(image_file, has_mask=saved)
+        self.statusBar().showMessage(f"{'Saved' if saved else 'Removed empty'} mask in {ms:.0f} ms", 2000)
 
     def next_image(self):
         if not self.images:
@@ -331,6 +933,10 @@ class MainWindow(QMainWindow):
             os.path.splitext(self.images[self.current_image])[0] + ".txt",
             os.path.splitext(self.images[self.current_image])[0] + ".tag",
         ]
+        for path in paths:
+            self.autosave.discard(path)
+        # let writes already in flight land before their files are trashed
+        self.autosave.wait()
         for path in paths:
             if not os.path.exists(path):
                 continue
@@ -338,7 +944,17 @@ class MainWindow(QMainWindow):
             print(f"Deleting {normalized_path}")
             
             send2trash.send2trash(normalized_path)
+        self.prefetcher.invalidate(self.images[self.current_image])
+        self.dataset_index.remove(self.images[self.current_image])
+        if self.tag_index is not None:
+            self.tag_index.remove(self.images[self.current_image])
+        if self.images is not self.all_images:
+            self.all_images.remove(self.images[self.current_image])
+        cluster = self.duplicate_cluster_of.pop(self.images[self.current_image], None)
+        if cluster is not None:
+            cluster.remove(self.images[self.current_image])
         self.images.pop(self.current_image)
+        self.thumbnail_model.imageRemoved(self.current_image)
         self.current_image = min(self.current_image, len(self.images) - 1)
         self.display_image()
 
@@ -368,13 +984,30 @@ def aspect_fmt(width, height) -> str:
     return aspect_text
 
 
+def parse_args(argv=None):
+    """Parse the tool's arguments; the ones it does not know are returned for Qt."""
+    parser = argparse.ArgumentParser(description="Browse an image dataset and edit its captions, tags and masks.")
+    parser.add_argument("dataset", nargs="?", help="The dataset folder, or an image in it to start at. Defaults to the folder of the last session.")
+    parser.add_argument("--start", help="The image to start at: its index (from 0), or its path or file name.")
+    args, qt_args = parser.parse_known_args(argv)
+    if args.dataset and not os.path.exists(args.dataset):
+        parser.error(f"{args.dataset} does not exist")
+    return args, qt_args
+
+
 def run_app():
+    args, qt_args = parse_args()
     QImageReader.setAllocationLimit(1024)
-    sys.argv += ["-platform", "windows:darkmode=2"]
-    app = QApplication(sys.argv)
+    if sys.platform == "win32":
+        qt_args += ["-platform", "windows:darkmode=2"]
+    app = QApplication([sys.argv[0], *qt_args])
+    app.setOrganizationName("image-data-tool")
+    app.setApplicationName("image-data-tool")
     app.setStyle("fusion")
     window = MainWindow()
     window.show()
+    # opened from the event loop, so the window is on screen before any dataset I/O; the first image decodes on a worker
+    QTimer.singleShot(0, partial(window.restore_session, args.dataset, args.start))
     app.exec()
 
 if __name__ == "__main__":
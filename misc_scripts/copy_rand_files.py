@@ -1,25 +1,168 @@
 import argparse
+import errno
+import math
 import os
-import shutil
 import random
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from dataset_groups import chunked, parse_tags, read_tags, walk_groups
+
+FICLONE = 0x40049409  # linux/fs.h
+
+
+def aspect_bucket(group):
+    try:
+        with Image.open(group.image) as image:
+            width, height = image.size
+    except Exception:
+        return "unreadable"
+    # buckets a quarter octave wide, so 1:1, 5:4, 3:2, 16:9, 2:1 ... land in distinct buckets
+    return f"{2 ** (round(math.log2(width / height) * 4) / 4):.2f}"
+
+
+def tag_bucket(group, tags):
+    group_tags = set(read_tags(group.tags))
+    return next((tag for tag in tags if tag in group_tags), "(other)")
+
+
+class Reservoir:
+    """Uniform sample of up to size items from a stream of unknown length (algorithm R)."""
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            j = self.rng.randrange(self.seen)
+            if j < self.size:
+                self.items[j] = item
+
+
+def allocate(counts, n, balanced=False):
+    """Split n samples across strata, proportionally to their counts or evenly, never exceeding a stratum's count."""
+    quotas = dict.fromkeys(counts, 0)
+    remaining = min(n, sum(counts.values()))
+    while remaining:
+        open_strata = [key for key in counts if quotas[key] < counts[key]]
+        weights = {key: 1 if balanced else counts[key] - quotas[key] for key in open_strata}
+        total = sum(weights.values())
+        shares = {key: remaining * weight / total for key, weight in weights.items()}
+        given = 0
+        for key in open_strata:
+            add = min(int(shares[key]), counts[key] - quotas[key])
+            quotas[key] += add
+            given += add
+        # hand out what rounding left over, largest remainder first
+        for key in sorted(open_strata, key=lambda key: shares[key] - int(shares[key]), reverse=True):
+            if given == remaining:
+                break
+            if quotas[key] < counts[key]:
+                quotas[key] += 1
+                given += 1
+        remaining -= given
+    return quotas
+
+
+def sample_groups(input_dir, n, stratify=None, tags=(), balanced=False, seed=None, workers=8):
+    """Stream the image groups under input_dir and return a sample of n of them.
+
+    Each stratum keeps its own reservoir of n groups, so memory is bounded by n per stratum however
+    large the tree is; the final sample is drawn from the reservoirs once the stream is exhausted.
+    """
+    rng = random.Random(seed)
+    reservoirs = {}
+    if stratify == "aspect":
+        key = aspect_bucket
+    elif stratify == "tag":
+        key = lambda group: tag_bucket(group, tags)
+    else:
+        key = lambda group: None
+    with ThreadPoolExecutor(workers) as executor:
+        for groups in chunked(walk_groups(input_dir), 256):
+            # header and tag reads are I/O bound, so they overlap on threads
+            for group, stratum in zip(groups, executor.map(key, groups) if stratify else map(key, groups)):
+                if stratum not in reservoirs:
+                    reservoirs[stratum] = Reservoir(n, rng)
+                reservoirs[stratum].add(group)
+    quotas = allocate({stratum: reservoir.seen for stratum, reservoir in reservoirs.items()}, n, balanced)
+    sample = []
+    for stratum, reservoir in sorted(reservoirs.items(), key=lambda item: str(item[0])):
+        picked = rng.sample(reservoir.items, quotas[stratum])
+        if stratify:
+            print(f"{stratum}: {len(picked)} of {reservoir.seen}")
+        sample.extend(picked)
+    return sample
+
+
+def reflink(src, dst):
+    import fcntl
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def place_file(src, dst, link):
+    """Copy src to dst, sharing storage via a reflink or hardlink when asked and possible; returns the method used."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)  # may be a link to src from an earlier run
+    if link == "reflink":
+        try:
+            reflink(src, dst)
+            return "reflink"
+        except (OSError, ImportError):
+            if os.path.exists(dst):
+                os.remove(dst)
+    elif link == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    shutil.copy2(src, dst)
+    return "copy"
+
 
 def main():
-    parser = argparse.ArgumentParser(description='Randomly copy N files from one directory to another.')
+    parser = argparse.ArgumentParser(description='Randomly copy N images, with their caption, tag and mask files, from one directory tree to another.')
     parser.add_argument('input_dir', type=str, help='The source directory.')
     parser.add_argument('output_dir', type=str, help='The destination directory.')
-    parser.add_argument('-n', type=int, help='The number of files to copy.')
+    parser.add_argument('-n', type=int, required=True, help='The number of images to copy.')
+    parser.add_argument('--stratify', choices=['tag', 'aspect'], help='Sample each tag or aspect ratio bucket in proportion to its size.')
+    parser.add_argument('--tags', type=str, default='', help='With --stratify tag: the comma separated tags defining the strata; an image goes to the first one it has.')
+    parser.add_argument('--balanced', action='store_true', help='With --stratify: take the same number from each stratum instead.')
+    parser.add_argument('--link', choices=['copy', 'reflink', 'hardlink'], default='reflink',
+                        help='reflink (default) shares storage copy-on-write where the filesystem supports it; hardlink shares the '
+                             'files themselves, so edits in the sample change the source. Both fall back to copying.')
+    parser.add_argument('--seed', type=int, help='Random seed, for a reproducible sample.')
+    parser.add_argument('--workers', '-j', type=int, default=8, help='Number of copy threads.')
 
     args = parser.parse_args()
+    tags = parse_tags(args.tags)
+    if args.stratify == 'tag' and not tags:
+        parser.error('--stratify tag needs --tags')
 
-    all_files = [f for f in os.listdir(args.input_dir) if os.path.isfile(os.path.join(args.input_dir, f))]
-
-    selected_files = random.sample(all_files, args.n)
-
-    if not os.path.exists(args.output_dir):
-        os.makedirs(args.output_dir)
+    selected = sample_groups(args.input_dir, args.n, args.stratify, tags, args.balanced, args.seed, args.workers)
 
-    for file in selected_files:
-        shutil.copy(os.path.join(args.input_dir, file), args.output_dir)
+    jobs = []
+    for group in selected:
+        for path in group.files():
+            jobs.append((path, os.path.join(args.output_dir, os.path.relpath(path, args.input_dir))))
+    with ThreadPoolExecutor(args.workers) as executor:
+        methods = list(executor.map(lambda job: place_file(*job, args.link), jobs))
+    summary = ', '.join(f"{methods.count(method)} {method}" for method in sorted(set(methods)))
+    print(f"Copied {len(selected)} images ({len(jobs)} files: {summary or 'none'}) to {args.output_dir}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+import os
+import re
+
+from collections import namedtuple
+
+
+# kept in sync with dataset_index.py, which the scripts don't import so they can run without Qt
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+CAPTION_EXTS = ('.txt', '.caption')
+TAG_EXTS = ('.tag', '.tags')
+MASK_DIR = "mask"
+
+
+class ImageGroup(namedtuple("ImageGroup", ["image", "captions", "tags", "masks"])):
+    """An image and the caption, tag and mask files that belong to it (full paths)."""
+    __slots__ = ()
+
+    def files(self):
+        return [self.image, *self.captions, *self.tags, *self.masks]
+
+
+def is_image_file(name):
+    return name.lower().endswith(IMAGE_EXTS)
+
+
+def natural_sort_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def parse_tags(text):
+    """Split a tag file's contents on commas into normalized, de-duplicated tags."""
+    tags = []
+    for tag in text.split(","):
+        tag = " ".join(tag.split()).lower()
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def read_tags(paths):
+    """Read and merge the tags of a group's tag files."""
+    tags = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                tags.extend(tag for tag in parse_tags(f.read()) if tag not in tags)
+        except OSError:
+            pass
+    return tags
+
+
+def walk_dirs(root):
+    """Yield (dir, file names, mask file names) for every directory under root, one directory at a time.
+
+    The order matches the tool's folder scan: depth-first, naturally sorted. mask/ and hidden
+    directories are not descended into; mask file names are those in the directory's mask/.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        files = set()
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file():
+                        files.add(entry.name)
+                    elif entry.is_dir() and entry.name != MASK_DIR and not entry.name.startswith("."):
+                        subdirs.append(entry.path)
+        except OSError as e:
+            print(f"Cannot scan {directory}: {e}")
+            continue
+        stack.extend(sorted(subdirs, key=lambda path: natural_sort_key(os.path.basename(path)), reverse=True))
+        mask_dir = os.path.join(directory, MASK_DIR)
+        try:
+            masks = set(os.listdir(mask_dir)) if os.path.isdir(mask_dir) else set()
+        except OSError:
+            masks = set()
+        yield directory, files, masks
+
+
+def groups_in_dir(directory, files, masks):
+    for name in sorted(files, key=natural_sort_key):
+        if not is_image_file(name):
+            continue
+        stem = os.path.splitext(name)[0]
+        yield ImageGroup(
+            os.path.join(directory, name),
+            [os.path.join(directory, stem + ext) for ext in CAPTION_EXTS if stem + ext in files],
+            [os.path.join(directory, stem + ext) for ext in TAG_EXTS if stem + ext in files],
+            [os.path.join(directory, MASK_DIR, name)] if name in masks else [],
+        )
+
+
+def walk_groups(root):
+    """Stream the ImageGroups under root without building a list of the whole tree first."""
+    for directory, files, masks in walk_dirs(root):
+        yield from groups_in_dir(directory, files, masks)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
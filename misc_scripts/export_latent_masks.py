@@ -0,0 +1,148 @@
+import argparse
+import math
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from dataset_groups import chunked, walk_groups
+
+INDEX_DTYPE = np.dtype([
+    ("offset", np.int64),         # byte offset of the mask in masks.u8
+    ("height", np.int32),         # latent mask size, i.e. bucket size / downscale
+    ("width", np.int32),
+    ("bucket_height", np.int32),  # the aspect bucket the image is trained at
+    ("bucket_width", np.int32),
+    ("mean", np.float32),         # mean weight, 0 = fully masked out, 1 = fully kept
+    ("kept", np.float32),         # fraction of latent pixels fully kept (255)
+    ("masked", np.float32),       # fraction of latent pixels fully masked out (0)
+])
+
+
+def make_buckets(resolution, min_size, max_size, step):
+    """Aspect buckets of about resolution^2 pixels with sides that are multiples of step, as (width, height)."""
+    max_area = resolution * resolution
+    buckets = set()
+    width = min_size
+    while width <= max_size:
+        height = min(max_size, (max_area // width) // step * step)
+        if height >= min_size:
+            buckets.add((width, height))
+            buckets.add((height, width))
+        width += step
+    return np.array(sorted(buckets))
+
+
+def select_bucket(buckets, width, height):
+    errors = np.abs(np.log(buckets[:, 0] / buckets[:, 1]) - math.log(width / height))
+    return tuple(int(v) for v in buckets[np.argmin(errors)])
+
+
+def latent_mask(mask, bucket, downscale):
+    """Resize a grayscale mask to cover bucket, center crop it, and box-filter it down by downscale."""
+    bucket_width, bucket_height = bucket
+    scale = max(bucket_width / mask.width, bucket_height / mask.height)
+    width = max(bucket_width, round(mask.width * scale))
+    height = max(bucket_height, round(mask.height * scale))
+    left = (width - bucket_width) // 2
+    top = (height - bucket_height) // 2
+    resized = mask.resize((width, height), Image.Resampling.BILINEAR).crop((left, top, left + bucket_width, top + bucket_height))
+    pixels = np.asarray(resized, dtype=np.float32)
+    blocks = pixels.reshape(bucket_height // downscale, downscale, bucket_width // downscale, downscale)
+    return np.round(blocks.mean(axis=(1, 3))).astype(np.uint8)
+
+
+def process_masks(paths, buckets, downscale):
+    """Runs in a worker process; returns (latent mask bytes, index fields) per mask path, or None on failure."""
+    results = []
+    for path in paths:
+        try:
+            with Image.open(path) as mask:
+                mask = mask.convert("L")
+        except Exception as e:
+            print(f"Failed to read {path}: {e}")
+            results.append(None)
+            continue
+        bucket = select_bucket(buckets, mask.width, mask.height)
+        latent = latent_mask(mask, bucket, downscale)
+        stats = (latent.mean() / 255, np.count_nonzero(latent == 255) / latent.size, np.count_nonzero(latent == 0) / latent.size)
+        results.append((latent.tobytes(), latent.shape, bucket, stats))
+    return results
+
+
+def load(output_dir):
+    """Return (paths, index, masks) for an export; masks is a read-only memmap, and mask i is
+    masks[index[i]['offset']:][:height * width].reshape(height, width)."""
+    with open(os.path.join(output_dir, "paths.txt"), encoding="utf-8") as f:
+        paths = f.read().splitlines()
+    index = np.load(os.path.join(output_dir, "index.npy"))
+    masks = np.memmap(os.path.join(output_dir, "masks.u8"), dtype=np.uint8, mode="r")
+    return paths, index, masks
+
+
+def export(directory, output_dir, resolution, min_size, max_size, step, downscale, workers=None):
+    start = time.perf_counter()
+    buckets = make_buckets(resolution, min_size, max_size, step)
+    if np.any(buckets % downscale):
+        raise ValueError("bucket sides must be multiples of the downscale factor")
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = []
+    rows = []
+    offset = 0
+    chunks = chunked(((group.image, group.masks[0]) for group in walk_groups(directory) if group.masks), 64)
+    with ProcessPoolExecutor(workers) as executor, open(os.path.join(output_dir, "masks.u8.tmp"), "wb") as out:
+        # chunks are submitted a few at a time so the walk and the workers overlap and memory stays bounded
+        pending = []
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(process_masks, [mask for _, mask in chunk], buckets, downscale)))
+            if len(pending) < (workers or os.cpu_count() or 1) * 2:
+                continue
+            chunk, future = pending.pop(0)
+            offset = _write_results(chunk, future.result(), directory, out, offset, paths, rows)
+        for chunk, future in pending:
+            offset = _write_results(chunk, future.result(), directory, out, offset, paths, rows)
+
+    index = np.array(rows, dtype=INDEX_DTYPE)
+    os.replace(os.path.join(output_dir, "masks.u8.tmp"), os.path.join(output_dir, "masks.u8"))
+    np.save(os.path.join(output_dir, "index.npy"), index)
+    with open(os.path.join(output_dir, "paths.txt"), "w", encoding="utf-8") as f:
+        f.writelines(path + "\n" for path in paths)
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(rows)} masks, {offset / 1e6:.1f} MB in {elapsed:.1f}s ({len(rows) / max(elapsed, 1e-9):.0f} masks/s)")
+    if len(rows):
+        print(f"mean weight {index['mean'].mean():.3f}, {index['kept'].mean():.1%} of latent pixels kept, "
+              f"{index['masked'].mean():.1%} masked out; {np.count_nonzero(index['masked'] > 0.9)} masks are over 90% masked out")
+
+
+def _write_results(chunk, results, directory, out, offset, paths, rows):
+    for (image, _), result in zip(chunk, results):
+        if result is None:
+            continue
+        data, (height, width), (bucket_width, bucket_height), (mean, kept, masked) = result
+        out.write(data)
+        paths.append(os.path.relpath(image, directory).replace(os.sep, "/"))
+        rows.append((offset, height, width, bucket_height, bucket_width, mean, kept, masked))
+        offset += len(data)
+    return offset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Downsample every mask/ file to latent resolution (its aspect bucket / 8) '
+                                                 'and pack them into one memory-mappable uint8 file (masks.u8) with an index '
+                                                 '(index.npy, paths.txt) and per-mask coverage statistics.')
+    parser.add_argument('directory', help='The dataset root.')
+    parser.add_argument('output_dir', help='Where masks.u8, index.npy and paths.txt are written.')
+    parser.add_argument('--resolution', type=int, default=1024, help='Training resolution; buckets hold about resolution^2 pixels.')
+    parser.add_argument('--min-bucket', type=int, default=256, help='Smallest bucket side.')
+    parser.add_argument('--max-bucket', type=int, default=2048, help='Largest bucket side.')
+    parser.add_argument('--bucket-step', type=int, default=64, help='Bucket sides are multiples of this.')
+    parser.add_argument('--downscale', type=int, default=8, help='VAE downscale factor.')
+    parser.add_argument('--workers', '-j', type=int, help='Number of worker processes.')
+    args = parser.parse_args()
+
+    export(args.directory, args.output_dir, args.resolution, args.min_bucket, args.max_bucket, args.bucket_step, args.downscale, args.workers)
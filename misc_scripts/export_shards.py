@@ -0,0 +1,212 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import posixpath
+import sqlite3
+import tarfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dataset_groups import walk_groups
+
+INDEX_FILENAME = "index.sqlite"
+
+
+class Sample:
+    """One image group as it goes into a shard: its WebDataset key, source files and a change fingerprint."""
+
+    def __init__(self, root, group):
+        self.group = group
+        self.path = os.path.relpath(group.image, root).replace(os.sep, "/")
+        directory, name = posixpath.split(posixpath.splitext(self.path)[0])
+        # WebDataset splits the key from the extension at the first dot of the file name
+        self.key = posixpath.join(directory, name.replace(".", "_"))
+        self.members = [(os.path.splitext(group.image)[1][1:].lower(), group.image)]
+        if group.captions:
+            self.members.append(("txt", group.captions[0]))
+        if group.tags:
+            self.members.append(("tag", group.tags[0]))
+        if group.masks:
+            self.members.append(("mask" + os.path.splitext(group.masks[0])[1].lower(), group.masks[0]))
+        stats = [os.stat(path) for _, path in self.members]
+        self.size = sum(st.st_size for st in stats)
+        self.fingerprint = ";".join(f"{ext}:{st.st_size}:{st.st_mtime_ns}" for (ext, _), st in zip(self.members, stats))
+
+
+def shard_name(number):
+    return f"shard-{number:06d}.tar"
+
+
+def write_shard(output_dir, name, samples):
+    """Write samples to one tar shard; returns ([(key, ext, data offset, size)] for the sample index, samples written).
+
+    The shard is written under a temporary name and renamed into place, so readers never see a partial shard.
+    A sample whose files can no longer be opened is left out whole.
+    """
+    path = os.path.join(output_dir, name)
+    tmp_path = os.path.join(output_dir, f".{name}.tmp")
+    entries = []
+    written = []
+    with tarfile.open(tmp_path, "w") as tar:
+        for sample in samples:
+            with contextlib.ExitStack() as stack:
+                try:
+                    files = [(ext, stack.enter_context(open(source, "rb"))) for ext, source in sample.members]
+                except OSError as e:
+                    print(f"Skipped {sample.path}: {e}")
+                    continue
+                written.append(sample)
+                json_data = json.dumps({"path": sample.path}).encode()
+                for ext, f in files + [("json", None)]:
+                    info = tarfile.TarInfo(f"{sample.key}.{ext}")
+                    info.mode = 0o644
+                    if f is None:
+                        info.size = len(json_data)
+                        info.mtime = int(time.time())
+                        tar.addfile(info, io.BytesIO(json_data))
+                    else:
+                        st = os.fstat(f.fileno())
+                        info.size = st.st_size
+                        info.mtime = int(st.st_mtime)  # a fractional mtime would add a pax header to every member
+                        tar.addfile(info, f)
+                    # tar.offset is now past the padded data, so the data starts a whole number of blocks back
+                    blocks = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+                    entries.append((sample.key, ext, tar.offset - blocks * tarfile.BLOCKSIZE, info.size))
+    os.replace(tmp_path, path)
+    return entries, written
+
+
+def read_member(output_dir, key, ext):
+    """Random access: return the bytes of one member of an exported sample using the index."""
+    db = sqlite3.connect(os.path.join(output_dir, INDEX_FILENAME))
+    try:
+        row = db.execute("SELECT shard, offset, size FROM members JOIN samples USING (key) WHERE key = ? AND ext = ?", (key, ext)).fetchone()
+    finally:
+        db.close()
+    if row is None:
+        raise KeyError(f"{key}.{ext}")
+    shard, offset, size = row
+    with open(os.path.join(output_dir, shard), "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def open_index(output_dir):
+    db = sqlite3.connect(os.path.join(output_dir, INDEX_FILENAME))
+    db.execute("CREATE TABLE IF NOT EXISTS samples (key TEXT PRIMARY KEY, path TEXT, shard TEXT, position INTEGER, fingerprint TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS members (key TEXT, ext TEXT, offset INTEGER, size INTEGER, PRIMARY KEY (key, ext))")
+    db.execute("CREATE INDEX IF NOT EXISTS samples_shard ON samples (shard)")
+    return db
+
+
+def plan_shards(samples, old, existing_shards, shard_bytes):
+    """Assign samples to shards; returns ({shard: [samples]}, set of shards that must be (re)written).
+
+    Unchanged samples stay in the shard they were exported to, so a re-export only rewrites shards that
+    gained, lost or changed a sample. New samples are packed into new shards of up to shard_bytes.
+    """
+    shards = {}
+    dirty = set()
+    new = []
+    for sample in samples:
+        previous = old.get(sample.key)
+        if previous is not None and previous[0] in existing_shards:
+            shards.setdefault(previous[0], []).append(sample)
+            if previous[1] != sample.fingerprint:
+                dirty.add(previous[0])
+        else:
+            new.append(sample)
+    current = {sample.key for sample in samples}
+    dirty.update(shard for key, (shard, _) in old.items() if key not in current and shard in existing_shards)
+    dirty.update(shard for shard in existing_shards if shard not in shards)
+
+    number = max((int(name[6:12]) for name in existing_shards), default=-1) + 1
+    size = 0
+    for sample in new:
+        if size and size + sample.size > shard_bytes:
+            number += 1
+            size = 0
+        name = shard_name(number)
+        shards.setdefault(name, []).append(sample)
+        dirty.add(name)
+        size += sample.size
+    return shards, dirty
+
+
+def export(directory, output_dir, shard_bytes, workers=None, full=False):
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    db = open_index(output_dir)
+    if full:
+        db.execute("DELETE FROM samples")
+        db.execute("DELETE FROM members")
+    existing_shards = {name for name in os.listdir(output_dir) if name.startswith("shard-") and name.endswith(".tar")}
+    if full:
+        for name in existing_shards:
+            os.remove(os.path.join(output_dir, name))
+        existing_shards = set()
+    old = {key: (shard, fingerprint) for key, shard, fingerprint in db.execute("SELECT key, shard, fingerprint FROM samples")}
+
+    samples = []
+    keys = set()
+    skipped = 0
+    for group in walk_groups(directory):
+        # files deleted or renamed since the walk listed them are skipped, not fatal to a long export
+        try:
+            sample = Sample(directory, group)
+        except OSError as e:
+            print(f"Skipped {group.image}: {e}")
+            skipped += 1
+            continue
+        while sample.key in keys:
+            sample.key += "_"
+        keys.add(sample.key)
+        samples.append(sample)
+
+    shards, dirty = plan_shards(samples, old, existing_shards, shard_bytes)
+    exported = len(samples)
+    written_bytes = 0
+    with ThreadPoolExecutor(workers or min(8, os.cpu_count() or 1)) as executor:
+        futures = {name: executor.submit(write_shard, output_dir, name, shards[name]) for name in sorted(dirty) if name in shards}
+        for name in sorted(dirty - set(shards)):
+            os.remove(os.path.join(output_dir, name))  # every sample it held is gone
+        for name, future in futures.items():
+            entries, rows = future.result()
+            exported -= len(shards[name]) - len(rows)
+            skipped += len(shards[name]) - len(rows)
+            db.execute("DELETE FROM members WHERE key IN (SELECT key FROM samples WHERE shard = ?)", (name,))
+            db.execute("DELETE FROM samples WHERE shard = ?", (name,))
+            db.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)",
+                           [(sample.key, sample.path, name, position, sample.fingerprint) for position, sample in enumerate(rows)])
+            db.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?)", entries)
+            written_bytes += os.path.getsize(os.path.join(output_dir, name))
+    current = [(key,) for key in keys]
+    db.execute("CREATE TEMP TABLE current (key TEXT PRIMARY KEY)")
+    db.executemany("INSERT INTO current VALUES (?)", current)
+    db.execute("DELETE FROM members WHERE key NOT IN (SELECT key FROM current)")
+    db.execute("DELETE FROM samples WHERE key NOT IN (SELECT key FROM current)")
+    db.commit()
+    db.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{exported} samples in {len(shards)} shards; rewrote {len(futures)} shards "
+          f"({written_bytes / 1e6:.1f} MB) in {elapsed:.1f}s ({written_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
+          + (f"; skipped {skipped} whose files vanished or could not be read" if skipped else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a dataset tree as WebDataset-style tar shards. Each sample is the image '
+                                                 '(<key>.<ext>) with its caption (.txt), tags (.tag), mask (.mask.<ext>) and a .json '
+                                                 f'holding the source path. {INDEX_FILENAME} in the output directory maps each '
+                                                 'sample and member to its shard and byte offset for random access.')
+    parser.add_argument('directory', help='The dataset root.')
+    parser.add_argument('output_dir', help='Where the shards and index are written.')
+    parser.add_argument('--shard-size', type=float, default=1024, help='Target shard size in MB (default 1024).')
+    parser.add_argument('--workers', '-j', type=int, help='Number of shards written at once.')
+    parser.add_argument('--full', action='store_true', help='Ignore the previous export and rewrite every shard.')
+    args = parser.parse_args()
+
+    export(args.directory, args.output_dir, int(args.shard_size * 1e6), args.workers, args.full)
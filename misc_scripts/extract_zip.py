@@ -1,29 +1,209 @@
 import argparse
 import os
+import posixpath
+import shutil
+import tempfile
+import time
 import zipfile
+import zlib
 
-def extract_zip(input_dir, output_dir):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from dataset_groups import CAPTION_EXTS, IMAGE_EXTS, MASK_DIR, TAG_EXTS
+
+Member = namedtuple("Member", ["archive", "name", "size", "crc", "target"])
+
+
+def find_zips(input_dir):
     if input_dir.endswith(".zip"):
-        with zipfile.ZipFile(input_dir, 'r') as zip_ref:
-            zip_ref.extractall(output_dir)
-        return
+        return [input_dir]
+    zips = []
     for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith('.zip'):
-                zip_file = os.path.join(root, file)
-                try:
-                    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-                        zip_ref.extractall(output_dir)
-                except zipfile.BadZipFile:
-                    print("Bad zip file: " + zip_file)
-                    continue
+        zips.extend(os.path.join(root, file) for file in files if file.endswith('.zip'))
+    return sorted(zips)
+
+
+def group_key(name):
+    """Return (dir, stem, rest) for a member worth extracting, or None for junk.
+
+    Images and their caption and tag files share a stem; masks are images under a mask/ directory and
+    belong to the image of the same name next to that directory.
+    """
+    directory, base = posixpath.split(name)
+    stem, ext = posixpath.splitext(base)
+    ext = ext.lower()
+    if posixpath.basename(directory) == MASK_DIR and ext in IMAGE_EXTS:
+        return posixpath.dirname(directory), stem, posixpath.join(MASK_DIR, "{}" + ext)
+    if ext in IMAGE_EXTS + CAPTION_EXTS + TAG_EXTS:
+        return directory, stem, "{}" + ext
+    return None
+
+
+def list_members(archive):
+    """Read an archive's central directory and group the wanted members; no data is decompressed."""
+    groups = {}
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            name = posixpath.normpath(info.filename.replace("\\", "/")).lstrip("/")
+            if name.startswith("../") or name == ".." or any(part.startswith(".") for part in name.split("/")):
+                continue
+            key = group_key(name)
+            if key is None:
+                continue
+            directory, stem, rest = key
+            groups.setdefault((directory, stem), []).append((rest, info.filename, info.file_size, info.CRC))
+    return groups
+
+
+def is_case_insensitive(directory):
+    """Whether the file system of directory ignores case in file names, as macOS and Windows do by default."""
+    fd, probe = tempfile.mkstemp(prefix=".Case", dir=directory)
+    os.close(fd)
+    try:
+        return os.path.exists(os.path.join(directory, os.path.basename(probe).swapcase()))
+    finally:
+        os.remove(probe)
+
+
+def file_crc(path):
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+class Planner:
+    """Assigns output paths to member groups in a fixed order, so the result does not depend on timing.
+
+    A group keeps its name if each of its targets is free or already holds an identical file (same size
+    and CRC, e.g. from an earlier run, which is then skipped). Otherwise the whole group, sidecars and
+    mask included, is renamed to <stem>_1, <stem>_2, ... until it fits. Targets planned earlier in the
+    run count as existing files, compared ignoring case where the output file system does.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.claimed = {}
+        self.case_insensitive = is_case_insensitive(output_dir)
+
+    def _key(self, path):
+        return path.casefold() if self.case_insensitive else path
+
+    def _state(self, path, size, crc):
+        """'free', 'same' or 'taken' for writing a file with size and crc to path."""
+        claimed = self.claimed.get(self._key(path))
+        if claimed is not None:
+            return "same" if claimed == (size, crc) else "taken"
+        try:
+            if os.path.getsize(path) != size:
+                return "taken"
+        except OSError:
+            return "free"
+        return "same" if file_crc(path) == crc else "taken"
+
+    def plan(self, archive, directory, stem, entries):
+        # members of one group that map to the same target (x.png and x.PNG) are planned as groups of their own
+        layers = []
+        for entry in entries:
+            layer = next((layer for layer in layers if all(rest != entry[0] for rest, _, _, _ in layer)), None)
+            if layer is None:
+                layers.append([entry])
+            else:
+                layer.append(entry)
+        members = []
+        renamed = False
+        for layer in layers:
+            layer_members, layer_renamed = self._plan_group(archive, directory, stem, layer)
+            members.extend(layer_members)
+            renamed = renamed or layer_renamed
+        return members, renamed
+
+    def _plan_group(self, archive, directory, stem, entries):
+        n = 0
+        while True:
+            candidate = stem if n == 0 else f"{stem}_{n}"
+            rels = [posixpath.join(directory, rest.format(candidate)) for rest, _, _, _ in entries]
+            targets = [os.path.join(self.output_dir, *rel.split("/")) for rel in rels]
+            states = [self._state(target, size, crc) for target, (_, _, size, crc) in zip(targets, entries)]
+            if "taken" not in states:
+                break
+            n += 1
+        members = []
+        for target, state, (_, name, size, crc) in zip(targets, states, entries):
+            self.claimed[self._key(target)] = (size, crc)
+            members.append((Member(archive, name, size, crc, target), state == "same"))
+        return members, n > 0
+
+
+def extract_members(archive, members):
+    """Stream the given members of one archive to their targets; returns (files, bytes) written."""
+    written = 0
+    written_bytes = 0
+    with zipfile.ZipFile(archive) as zf:
+        for member in members:
+            os.makedirs(os.path.dirname(member.target), exist_ok=True)
+            tmp_path = os.path.join(os.path.dirname(member.target), f".{os.path.basename(member.target)}.tmp")
+            with zf.open(member.name) as src, open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(tmp_path, member.target)
+            written += 1
+            written_bytes += member.size
+    return written, written_bytes
+
+
+def extract_zip(input_dir, output_dir, workers=None):
+    start = time.perf_counter()
+    archives = find_zips(input_dir)
+    workers = workers or min(8, os.cpu_count() or 1)
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(workers) as executor:
+        listings = {}
+        for archive, future in [(archive, executor.submit(list_members, archive)) for archive in archives]:
+            try:
+                listings[archive] = future.result()
+            except (zipfile.BadZipFile, OSError) as e:
+                print(f"Bad zip file: {archive} ({e})")
+
+        planner = Planner(output_dir)
+        jobs = {}
+        skipped = renamed = 0
+        for archive in archives:
+            for (directory, stem), entries in sorted(listings.get(archive, {}).items()):
+                members, was_renamed = planner.plan(archive, directory, stem, sorted(entries))
+                renamed += was_renamed
+                for member, same in members:
+                    if same:
+                        skipped += 1
+                    else:
+                        jobs.setdefault(archive, []).append(member)
+
+        # zlib releases the GIL while inflating, so archives are decompressed in parallel on threads
+        futures = {archive: executor.submit(extract_members, archive, members) for archive, members in jobs.items()}
+        written = written_bytes = 0
+        for archive, future in futures.items():
+            try:
+                files, size = future.result()
+            except (zipfile.BadZipFile, OSError, zlib.error) as e:
+                print(f"Failed to extract {archive}: {e}")
+                continue
+            written += files
+            written_bytes += size
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(archives)} archives: {written} files extracted, {skipped} already present, {renamed} groups renamed")
+    print(f"{written_bytes / 1e6:.1f} MB in {elapsed:.1f}s ({written_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s, {written / max(elapsed, 1e-9):.0f} files/s)")
+
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Recursively extract all zip files into a flat output directory')
+    parser = argparse.ArgumentParser(description='Recursively extract the images, captions, tags and masks of all zip files into one output directory')
     parser.add_argument('input_dir', help='Input directory to search for zip files')
     parser.add_argument('output_dir', help='Output directory to extract zip files into')
+    parser.add_argument('--workers', '-j', type=int, help='Number of archives processed at once')
     args = parser.parse_args()
 
-    extract_zip(args.input_dir, args.output_dir)
+    extract_zip(args.input_dir, args.output_dir, args.workers)
@@ -1,53 +1,116 @@
-
-import glob
 import argparse
+import json
 import os
 
-def scan_directory(directory):
-    print("Scanning directory", directory)
-    for root, dirs, files in os.walk(directory):
-        print("Scanning", root)
-        for file in files:
-            yield os.path.join(root, file)
+import send2trash
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from dataset_groups import chunked, parse_tags, read_tags, walk_groups
+
+
+def evaluate(groups, whitelist, blacklist):
+    """Return (group, reason) for each tagged group that is missing a whitelisted tag or has a blacklisted one.
+
+    Groups without a tag file are left alone.
+    """
+    removals = []
+    for group in groups:
+        if not group.tags:
+            continue
+        tags = set(read_tags(group.tags))
+        missing = [tag for tag in whitelist if tag not in tags]
+        forbidden = [tag for tag in blacklist if tag in tags]
+        if missing or forbidden:
+            reason = "; ".join(filter(None, [
+                "missing " + ", ".join(missing) if missing else "",
+                "has " + ", ".join(forbidden) if forbidden else "",
+            ]))
+            removals.append((group, reason))
+    return removals
+
+
+def build_plan(directory, whitelist, blacklist, workers=None, chunk_size=256):
+    """Walk the tree and evaluate the filters in a process pool, returning the plan as a list of dicts.
+
+    Tag files are read by the workers; at most a few chunks per worker are in flight, so memory stays
+    flat however large the tree is.
+    """
+    plan = []
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        max_pending = workers * 4
+        pending = set()
+
+        def collect(done):
+            for future in done:
+                for group, reason in future.result():
+                    plan.append({"image": group.image, "files": group.files(), "reason": reason})
+
+        for groups in chunked(walk_groups(directory), chunk_size):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(evaluate, groups, whitelist, blacklist))
+        collect(wait(pending)[0])
+    plan.sort(key=lambda item: item["image"])
+    return plan
+
+
+def print_plan(plan):
+    for item in plan:
+        print(f"{item['image']}: {item['reason']}")
+        for path in item["files"][1:]:
+            print(f"    {path}")
+    print(f"{len(plan)} images, {sum(len(item['files']) for item in plan)} files to remove")
+
+
+def apply_plan(plan):
+    removed = 0
+    for item in plan:
+        for path in item["files"]:
+            if not os.path.exists(path):
+                continue
+            try:
+                send2trash.send2trash(os.path.normpath(path))
+                removed += 1
+            except OSError as e:
+                print(f"Could not trash {path}: {e}")
+    print(f"Moved {removed} files to the trash")
+
 
 def main():
-    parser = argparse.ArgumentParser(description='Recursively scans a folder for .tag files and deletes the corresponding image if the tag file contains certain tags.')
-    parser.add_argument('directory', type=str, help='The directory to scan.')
-    parser.add_argument('--whitelist', '-w', type=str, help='Required tags, separated by commas.')
-    parser.add_argument('--blacklist', '-b', type=str, help='Forbidden tags, separated by commas.')
-    parser.add_argument('--dry', '-d', action='store_true', help='Dry run. Does not delete anything.')
+    parser = argparse.ArgumentParser(description='Recursively scans a folder for tagged images and removes the images '
+                                                 '(with their caption, tag and mask files) that fail the tag filters. '
+                                                 'Nothing is removed unless --apply or --apply-plan is given.')
+    parser.add_argument('directory', type=str, nargs='?', help='The directory to scan.')
+    parser.add_argument('--whitelist', '-w', type=str, default='', help='Required tags, separated by commas.')
+    parser.add_argument('--blacklist', '-b', type=str, default='', help='Forbidden tags, separated by commas.')
+    parser.add_argument('--plan', '-p', type=str, help='Write the plan to this JSON file for review.')
+    parser.add_argument('--apply', action='store_true', help='Move the planned files to the trash.')
+    parser.add_argument('--apply-plan', type=str, help='Move the files of a previously written (and possibly edited) plan to the trash.')
+    parser.add_argument('--workers', '-j', type=int, help='Number of worker processes.')
     args = parser.parse_args()
 
-    # TODO FIX: THIS DELETES EVERYTHING
-    print("SCRIPT IS BROKEN")
-    return
+    if args.apply_plan:
+        with open(args.apply_plan) as f:
+            apply_plan(json.load(f))
+        return
+    if not args.directory:
+        parser.error('directory is required unless --apply-plan is given')
+    whitelist = parse_tags(args.whitelist)
+    blacklist = parse_tags(args.blacklist)
+    if not whitelist and not blacklist:
+        parser.error('no --whitelist or --blacklist tags given')
 
-    for file in scan_directory(args.directory):
-        if not os.path.exists(file) or file.endswith('.zip'):
-            continue
-        if not file.endswith(('.png', '.jpg', '.jpeg')):
-            discard_file(file)
-            continue
-        if file.endswith('.tag'):
-            tag_string = open(file, 'r').read()
-            if args.whitelist:
-                if not all(tag.strip() in tag_string for tag in args.whitelist.split(',')):
-                    discard_file(file, args.dry)
-                    continue
-            if args.blacklist:
-                if any(tag.strip() in tag_string for tag in args.blacklist.split(',')):
-                    discard_file(file, args.dry)
-                    continue
-
-def discard_file(file, dry):
-    base_name = os.path.splitext(file)[0]
-
-    for f in glob.glob(base_name + ".*"):
-        if not dry:
-            #os.remove(f)
-            print("Deleted", f)
-        else:
-            print("Would delete", f)
+    plan = build_plan(args.directory, whitelist, blacklist, args.workers)
+    print_plan(plan)
+    if args.plan:
+        with open(args.plan, 'w') as f:
+            json.dump(plan, f, indent=1)
+        print(f"Wrote plan to {args.plan}")
+    if args.apply:
+        apply_plan(plan)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
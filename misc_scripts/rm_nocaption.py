@@ -1,29 +1,140 @@
-import os
 import argparse
+import json
+import os
+import sys
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from PIL import Image
+
+from dataset_groups import CAPTION_EXTS, MASK_DIR, TAG_EXTS, is_image_file
+
+ISSUES = ('no_caption', 'caption_without_image', 'tags_without_image', 'mask_without_image', 'mask_size_mismatch')
+
 
 def parse_args():
-    parser = argparse.ArgumentParser(description='Delete files without an associated ".caption" file.')
-    parser.add_argument('--dir_path', type=str, help='The directory path.')
+    parser = argparse.ArgumentParser(description='Report images without a caption or tag file, captions, tags and masks '
+                                                 'without an image, and masks whose size differs from their image. '
+                                                 'Prints one JSON object per issue.')
+    parser.add_argument('dir_path', type=str, nargs='?', help='The root of the dataset tree.')
+    parser.add_argument('--dir_path', dest='dir_path_option', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--output', '-o', type=str, help='Write the JSON lines here instead of stdout.')
+    parser.add_argument('--no-mask-size', action='store_true', help='Skip comparing mask and image dimensions.')
+    parser.add_argument('--workers', '-j', type=int, help='Number of worker processes.')
     return parser.parse_args()
 
-TXT_EXTS = ('.caption', '.txt', '.tags', '.tag')
-
-def delete_files_without_caption(dir_path):
-    for filename in os.listdir(dir_path):
-        if not filename.endswith(TXT_EXTS):
-            found_txt = False
-            for ext in TXT_EXTS:
-                caption_filename = os.path.splitext(filename)[0] + ext
-                if os.path.exists(os.path.join(dir_path, caption_filename)):
-                    found_txt = True
-                    break
-            if not found_txt:
-                print(os.path.join(dir_path, filename))
-                #os.remove(os.path.join(dir_path, filename))
+
+def image_size(path):
+    try:
+        with Image.open(path) as image:
+            return image.size  # header only, pixels are not decoded
+    except Exception:
+        return None
+
+
+def compare_sizes(pairs):
+    """Return a mask_size_mismatch issue for each (mask, image) pair whose headers disagree."""
+    issues = []
+    for mask, image in pairs:
+        mask_size = image_size(mask)
+        size = image_size(image)
+        if mask_size != size:
+            issues.append({'issue': 'mask_size_mismatch', 'path': mask, 'mask_size': mask_size, 'image_size': size})
+    return issues
+
+
+def check_dir(directory):
+    """Scan one directory and its mask/ and return (issues, (mask, image) pairs to compare, subdirectories).
+
+    Everything is decided with set lookups over the two listings, without a stat or exists call per file.
+    """
+    files = set()
+    subdirs = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    files.add(entry.name)
+                elif entry.is_dir() and entry.name != MASK_DIR and not entry.name.startswith('.'):
+                    subdirs.append(entry.path)
+    except OSError as e:
+        return [{'issue': 'unreadable', 'path': directory, 'error': str(e)}], [], []
+    mask_dir = os.path.join(directory, MASK_DIR)
+    try:
+        masks = [name for name in os.listdir(mask_dir) if not name.startswith('.')]
+    except OSError:
+        masks = []
+
+    issues = []
+    image_stems = set()
+    images = set()
+    for name in files:
+        if is_image_file(name):
+            images.add(name)
+            image_stems.add(os.path.splitext(name)[0])
+    for name in sorted(files):
+        stem, ext = os.path.splitext(name)
+        if name in images:
+            if not any(stem + e in files for e in CAPTION_EXTS + TAG_EXTS):
+                issues.append({'issue': 'no_caption', 'path': os.path.join(directory, name)})
+        elif ext in CAPTION_EXTS and stem not in image_stems:
+            issues.append({'issue': 'caption_without_image', 'path': os.path.join(directory, name)})
+        elif ext in TAG_EXTS and stem not in image_stems:
+            issues.append({'issue': 'tags_without_image', 'path': os.path.join(directory, name)})
+    pairs = []
+    for name in sorted(masks):
+        path = os.path.join(mask_dir, name)
+        if name not in images:
+            issues.append({'issue': 'mask_without_image', 'path': path})
+        else:
+            pairs.append((path, os.path.join(directory, name)))
+    return issues, pairs, sorted(subdirs)
+
+
+def check_tree(root, output, check_mask_size=True, workers=None, chunk_size=500):
+    """Check every directory under root on a process pool, writing issues as JSON lines; returns counts per issue.
+
+    Directories are listed by the workers as they are discovered, and mask size comparisons are split
+    into chunks, so one huge directory does not serialize the run.
+    """
+    counts = dict.fromkeys(ISSUES, 0)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        pending = {executor.submit(check_dir, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if isinstance(result, tuple):
+                    issues, pairs, subdirs = result
+                    for subdir in subdirs:
+                        pending.add(executor.submit(check_dir, subdir))
+                    if check_mask_size:
+                        for i in range(0, len(pairs), chunk_size):
+                            pending.add(executor.submit(compare_sizes, pairs[i:i + chunk_size]))
+                else:
+                    issues = result
+                for issue in issues:
+                    counts[issue['issue']] = counts.get(issue['issue'], 0) + 1
+                    output.write(json.dumps(issue) + '\n')
+    return counts
+
 
 def main():
     args = parse_args()
-    delete_files_without_caption(args.dir_path)
+    root = args.dir_path or args.dir_path_option
+    if not root:
+        sys.exit('dir_path is required')
+    start = time.perf_counter()
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        counts = check_tree(root, output, not args.no_mask_size, args.workers)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    summary = ', '.join(f'{count} {issue}' for issue, count in counts.items() if count) or 'no issues'
+    print(f'{summary} ({time.perf_counter() - start:.1f}s)', file=sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -1,58 +1,203 @@
 import argparse
+import hashlib
+import json
 import os
+import random
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import requests
-import json
+
+from dataset_groups import walk_groups
+
+DEFAULT_BASE_URL = 'https://safebooru.donmai.us/posts'
+HEADERS = {'User-Agent': 'Mozilla/5.0 (iPad; CPU OS 12_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
 
 def extract_image_id(image_file):
-    return os.path.splitext(image_file)[0].split('_')[1]
+    return os.path.splitext(os.path.basename(image_file))[0].split('_')[1]
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class ResponseCache:
+    """On-disk cache of post lookups, keyed by base URL and image id.
+
+    Both found posts and definite misses (404) are stored, so a re-run never asks for the same id twice.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, base_url, image_id):
+        key = hashlib.sha1(f'{base_url}|{image_id}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, base_url, image_id):
+        try:
+            with open(self._path(base_url, image_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
-def process_image_file(directory, image_file):
-    tag_file = os.path.join(directory, f'{os.path.splitext(image_file)[0]}.tag')
-    if os.path.exists(tag_file):
-        return
+    def put(self, base_url, image_id, status, data):
+        path = self._path(base_url, image_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'status': status, 'data': data}, f)
+        os.replace(tmp_path, path)
 
-    base_url = 'https://safebooru.donmai.us/posts'
-    headers = {'User-Agent': 'Mozilla/5.0 (iPad; CPU OS 12_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'}
 
+class TagFetcher:
+    """Fetches post JSON with a bounded number of keep-alive connections, a shared rate limit and retries.
+
+    Each worker thread has its own requests.Session, so connections are reused across requests
+    instead of being opened per file.
+    """
+
+    def __init__(self, base_url, rate, cache, retries=4, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.bucket = TokenBucket(rate)
+        self.cache = cache
+        self.retries = retries
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.cache_hits = 0
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers.update(HEADERS)
+        return session
+
+    def fetch(self, image_id):
+        """Return the post JSON for image_id, or None if there is no such post."""
+        cached = self.cache.get(self.base_url, image_id)
+        if cached is not None:
+            with self._lock:
+                self.cache_hits += 1
+            return cached['data']
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            with self._lock:
+                self.requests += 1
+            try:
+                response = self._session().get(f'{self.base_url}/{image_id}.json', timeout=self.timeout)
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            if response.status_code == 200:
+                data = response.json()
+                self.cache.put(self.base_url, image_id, 200, data)
+                return data
+            if response.status_code == 404:
+                self.cache.put(self.base_url, image_id, 404, None)
+                return None
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                raise requests.HTTPError(f'status code {response.status_code}', response=response)
+            retry_after = response.headers.get('Retry-After', '')
+            time.sleep(float(retry_after) if retry_after.isdigit() else self._backoff(attempt))
+
+    def _backoff(self, attempt):
+        return min(60.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+
+
+def tags_from_post(data):
+    character = data['tag_string_character']
+    tags = ', '.join(data['tag_string_general'].split(' '))
+    return f'{character}, {tags}' if character != '' else tags
+
+
+def process_image_file(fetcher, image_file):
+    """Fetch and write the tag file for image_file; returns a status string for the summary."""
     try:
         image_id = extract_image_id(image_file)
-    except:
+    except IndexError:
         print(f'Error extracting image id from file: {image_file}')
-        return
+        return 'skipped'
     if image_id == '':
         print(f'No image id found for file: {image_file}')
-        return
+        return 'skipped'
 
-    response = requests.get(f'{base_url}/{image_id}.json', headers=headers)
+    try:
+        data = fetcher.fetch(image_id)
+    except (requests.RequestException, ValueError) as e:
+        print(f'Error fetching tags for image: {image_id}, {e}')
+        return 'failed'
+    if data is None:
+        print(f'No post found for image: {image_id}')
+        return 'missing'
 
-    if not response.status_code == 200:
-        print(f'Error fetching tags for image: {image_id}, status code: {response.status_code}')
-        return
+    tag_file = os.path.splitext(image_file)[0] + '.tag'
+    with open(tag_file, 'w') as f:
+        f.write(tags_from_post(data))
+    return 'written'
 
-    data = json.loads(response.text)
 
-    character = data['tag_string_character']
-    tags = ', '.join(data['tag_string_general'].split(' '))
-    prompt = f'{character}, {tags}' if character != '' else tags
+def main(directory, base_url, concurrency, rate, retries, cache_dir):
+    fetcher = TagFetcher(base_url, rate, ResponseCache(cache_dir), retries)
+    counts = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = set()
 
-    with open(tag_file, 'w') as f:
-        f.write(prompt)
+        def collect(done):
+            for future in done:
+                status = future.result()
+                counts[status] = counts.get(status, 0) + 1
 
-def scan_directory(directory):
-    print("Scanning directory", directory)
-    for root, dirs, files in os.walk(directory):
-        if root.endswith("mask"):
-            continue
-        print("Scanning", root)
-        for file in files:
-            yield root, file
+        print("Scanning directory", directory)
+        for group in walk_groups(directory):
+            if group.tags:
+                continue
+            if len(pending) >= concurrency * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(process_image_file, fetcher, group.image))
+        collect(wait(pending)[0])
+    elapsed = time.perf_counter() - start
+    summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'nothing to do'
+    print(f'{summary} in {elapsed:.1f}s ({fetcher.requests} requests, {fetcher.cache_hits} cached)')
 
-def main(directory):
-    for directory, file in scan_directory(directory):
-        process_image_file(directory, file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Scrape tags for images.')
     parser.add_argument('directory', type=str, help='The directory containing the images.')
+    parser.add_argument('--base-url', type=str, default=DEFAULT_BASE_URL, help='Posts endpoint; <base-url>/<id>.json is fetched.')
+    parser.add_argument('--concurrency', '-c', type=int, default=8, help='Maximum number of requests in flight.')
+    parser.add_argument('--rate', '-r', type=float, default=8.0, help='Maximum requests per second.')
+    parser.add_argument('--retries', type=int, default=4, help='Retries for connection errors, 429 and 5xx responses.')
+    parser.add_argument('--cache-dir', type=str, default=os.path.expanduser('~/.cache/image-data-tool/posts'), help='Response cache directory.')
     args = parser.parse_args()
     main(**args.__dict__)
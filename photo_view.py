@@ -1,10 +1,16 @@
 # Adapted from https://stackoverflow.com/a/74941896
 
 import math
+import zlib
 
 from PySide6 import QtCore, QtGui, QtWidgets
 import PySide6.QtGui
 
+from image_cache import proxy_size
+from profiling import profiler
+from sparse_mask import SparseMask, load_mask, mask_from_image, state_nbytes
+from tiled_image import ImagePyramid, TiledImageItem
+
 
 class PhotoView(QtWidgets.QGraphicsView):
     photoClicked = QtCore.Signal(QtCore.QPointF)
@@ -14,8 +20,9 @@ class PhotoView(QtWidgets.QGraphicsView):
         self._zoom = 0
         self._drag_mode = QtWidgets.QGraphicsView.DragMode.ScrollHandDrag
         self._empty = True
+        self._photo_size = QtCore.QSize(0, 0)
         self._scene = QtWidgets.QGraphicsScene(self)
-        self._photo = QtWidgets.QGraphicsPixmapItem()
+        self._photo = TiledImageItem()
         self._scene.addItem(self._photo)
         self.setScene(self._scene)
         self.setTransformationAnchor(QtWidgets.QGraphicsView.ViewportAnchor.AnchorUnderMouse)
@@ -28,36 +35,63 @@ class PhotoView(QtWidgets.QGraphicsView):
         return not self._empty
 
     def fitInView(self, scale=True):
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
-        rect = rect.marginsAdded(QtCore.QMarginsF(rect.width() * 0.05, rect.height() * 0.05, rect.width() * 0.05, rect.height() * 0.05))
-        if not rect.isNull():
-            self.setSceneRect(rect)
-            if self.hasPhoto():
-                unity = self.transform().mapRect(QtCore.QRectF(0, 0, 1, 1))
-                self.scale(1 / unity.width(), 1 / unity.height())
-                viewrect = self.viewport().rect()
-                scenerect = self.transform().mapRect(rect)
-                factor = min(viewrect.width() / scenerect.width(),
-                             viewrect.height() / scenerect.height())
-                self.scale(factor, factor)
-            self._zoom = 0
-            self._on_zoom_changed()
+        with profiler.section("fitInView"):
+            rect = QtCore.QRectF(QtCore.QPointF(0, 0), QtCore.QSizeF(self._photo_size))
+            rect = rect.marginsAdded(QtCore.QMarginsF(rect.width() * 0.05, rect.height() * 0.05, rect.width() * 0.05, rect.height() * 0.05))
+            if not rect.isNull():
+                self.setSceneRect(rect)
+                if self.hasPhoto():
+                    unity = self.transform().mapRect(QtCore.QRectF(0, 0, 1, 1))
+                    self.scale(1 / unity.width(), 1 / unity.height())
+                    viewrect = self.viewport().rect()
+                    scenerect = self.transform().mapRect(rect)
+                    factor = min(viewrect.width() / scenerect.width(),
+                                 viewrect.height() / scenerect.height())
+                    self.scale(factor, factor)
+                self._zoom = 0
+                self._on_zoom_changed()
+
+    def setPhoto(self, image=None, size=None):
+        """Show image (a QImage or QPixmap) as a photo of the given full-resolution size.
 
-    def setPhoto(self, pixmap=None):
+        image may be a reduced-resolution preview (or None while loading, if size is known);
+        the scene always uses full-resolution coordinates. Use updatePhoto to swap in the full image.
+        """
         self._zoom = 0
-        if pixmap and not pixmap.isNull():
+        image = _to_image(image)
+        if image is None:
+            if size is not None and size.isValid():
+                image = QtGui.QImage(1, 1, QtGui.QImage.Format.Format_RGB32)
+                image.fill(self.backgroundBrush().color().lighter(150))
+        if image is not None:
             self._empty = False
             self._drag_mode = QtWidgets.QGraphicsView.DragMode.ScrollHandDrag
-            self._photo.setPixmap(pixmap)
+            self._photo_size = size if size is not None and size.isValid() else image.size()
+            self._set_photo_image(image)
         else:
             self._empty = True
             self._drag_mode = QtWidgets.QGraphicsView.DragMode.NoDrag
-            self._photo.setPixmap(QtGui.QPixmap())
+            self._photo_size = QtCore.QSize(0, 0)
+            self._photo.setImage(None)
+            self._photo.setTransform(QtGui.QTransform())
         self.fitInView()
+
+    def updatePhoto(self, image):
+        """Replace the displayed image with another resolution of the same photo, keeping zoom and pan."""
+        image = _to_image(image)
+        if not self.hasPhoto() or image is None:
+            return
+        self._set_photo_image(image)
+
+    def _set_photo_image(self, image):
+        self._photo.setImage(image)
+        self._photo.setTransform(QtGui.QTransform.fromScale(
+            self._photo_size.width() / image.width(),
+            self._photo_size.height() / image.height()))
     
     def getPhotoSize(self):
         if self.hasPhoto():
-            return self._photo.pixmap().size()
+            return QtCore.QSize(self._photo_size)
         return QtCore.QSize(0, 0)
 
     def wheelEvent(self, event):
@@ -80,7 +114,7 @@ class PhotoView(QtWidgets.QGraphicsView):
     def toggleDragMode(self):
         if self._drag_mode != QtWidgets.QGraphicsView.DragMode.NoDrag:
             self._drag_mode = QtWidgets.QGraphicsView.DragMode.NoDrag
-        elif not self._photo.pixmap().isNull():
+        elif not self._photo.isNull():
             self._drag_mode = QtWidgets.QGraphicsView.DragMode.ScrollHandDrag
 
     def mousePressEvent(self, event):
@@ -124,63 +158,80 @@ class PhotoView(QtWidgets.QGraphicsView):
             self._photo.setTransformationMode(QtCore.Qt.TransformationMode.FastTransformation)
 
 
+def _to_image(image):
+    if image is None or image.isNull():
+        return None
+    if isinstance(image, QtGui.QPixmap):
+        return image.toImage()
+    return image
+
+
 class MaskDrawPhotoView(PhotoView):
+    """PhotoView with a mask painted over it.
+
+    Photos over proxy_pixels are shown as proxies, and the mask canvas is kept at the proxy size
+    too; strokes are then also painted into a SparseMask at full resolution, which is what
+    getMask() returns and what gets saved. Their mask files are read on a worker thread, and the
+    mask cannot be edited until it is loaded.
+    """
     maskModified = QtCore.Signal()
 
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.canvas = QtGui.QPixmap()
+        self.canvas = QtGui.QImage()
         self.drawing = False
         self.brushSize = 32
         self.brushColor = QtCore.Qt.GlobalColor.black
         self.last_point = QtCore.QPoint()
         self.history = []
         self.history_index = 0
-        self.max_history = 20
+        self.max_history_bytes = 64 * 1024 * 1024
+        self._stroke_before = {}
+        self.proxy_pixels = None
+        self._full_mask = None
+        self._full_before = {}
+        self._canvas_transform = QtGui.QTransform()
+        self._mask_loader = None
+        self._cursor_pos = None
+        self._cursor_rect = QtCore.QRect()
         self.draw_enabled = True
 
     def mousePressEvent(self, event):
-        if self.draw_enabled:
+        if self.draw_enabled and not self.isMaskLoading():
             if event.button() in (QtCore.Qt.MouseButton.LeftButton, QtCore.Qt.MouseButton.RightButton):
                 self.drawing = True
 
-                painter = QtGui.QPainter(self.canvas)
                 color = self.brushColor
                 if event.button() == QtCore.Qt.MouseButton.RightButton:
                     color = QtCore.Qt.GlobalColor.white
-                    #painter.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_Clear)
                 pos = self.mapToScene(event.pos())
-                pen = QtGui.QPen(color, self.brushSize, QtCore.Qt.PenStyle.SolidLine, QtCore.Qt.PenCapStyle.RoundCap, QtCore.Qt.PenJoinStyle.RoundJoin)
-                painter.setPen(pen)
-                painter.drawPoint(pos)
-                painter.end()
+                rect = self._paint_stroke(pos, pos, color)
                 self.last_point = pos
 
-                self.viewport().update()
+                self.viewport().update(self._viewport_rect(rect))
         
         super().mousePressEvent(event)
 
     def mouseMoveEvent(self, event):
         if self.draw_enabled:
+            dirty = QtGui.QRegion(self._cursor_rect)
             if self.drawing and event.buttons() & (QtCore.Qt.MouseButton.LeftButton | QtCore.Qt.MouseButton.RightButton):
-                painter = QtGui.QPainter(self.canvas)
                 color = self.brushColor
                 if event.buttons() & QtCore.Qt.MouseButton.RightButton:
                     color = QtCore.Qt.GlobalColor.white
-                    #painter.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_Clear)
-                pen = QtGui.QPen(color, self.brushSize, QtCore.Qt.PenStyle.SolidLine, QtCore.Qt.PenCapStyle.RoundCap, QtCore.Qt.PenJoinStyle.RoundJoin)
                 pos = self.mapToScene(event.pos())
-                painter.setPen(pen)
-                painter.drawLine(self.last_point, pos)
-                painter.end()
+                rect = self._paint_stroke(self.last_point, pos, color)
                 self.last_point = pos
-            
-            self.viewport().update()
+                dirty = dirty.united(self._viewport_rect(rect))
+
+            self._cursor_pos = event.position()
+            self._cursor_rect = self._brush_cursor_rect(self._cursor_pos)
+            self.viewport().update(dirty.united(self._cursor_rect))
 
         super().mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event):
-        if self.draw_enabled:
+        if self.draw_enabled and self.drawing:
             if event.button() in (QtCore.Qt.MouseButton.LeftButton, QtCore.Qt.MouseButton.RightButton):
                 self.drawing = False
                 self.last_point = QtCore.QPoint()
@@ -201,15 +252,21 @@ class MaskDrawPhotoView(PhotoView):
         super().wheelEvent(event)
     
     def paintEvent(self, event) -> None:
+        with profiler.section("frame"):
+            self._paint(event)
+
+    def _paint(self, event):
         super().paintEvent(event)
 
         # draw mask
         painter = QtGui.QPainter(self.viewport())
-        painter.setTransform(self.viewportTransform())
+        # the canvas may be a proxy, smaller than the scene by _canvas_transform
+        painter.setTransform(self._canvas_transform.inverted()[0] * self.viewportTransform())
         painter.setOpacity(0.9)
         painter.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_Multiply)
         #painter.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_Darken)
-        painter.drawPixmap(self.canvas.rect(), self.canvas)
+        exposed = self._canvas_transform.mapRect(self.mapToScene(event.rect()).boundingRect())
+        self._mask_pyramid.draw(painter, exposed, self.transform().m11() / self._canvas_transform.m11())
         painter.end()
 
         # draw a transparent circle around the cursor
@@ -218,8 +275,17 @@ class MaskDrawPhotoView(PhotoView):
             painter.setCompositionMode(QtGui.QPainter.CompositionMode.RasterOp_NotSourceXorDestination)
             draw_width = self.brushSize * self.transform().m11()
             painter.setPen(QtGui.QPen(QtGui.QColor(255, 255, 255, 63), draw_width, QtCore.Qt.PenStyle.SolidLine, QtCore.Qt.PenCapStyle.RoundCap, QtCore.Qt.PenJoinStyle.RoundJoin))
-            painter.drawPoint(self.mapFromGlobal(QtGui.QCursor.pos()))
+            cursor_pos = self._cursor_pos
+            if cursor_pos is None:
+                cursor_pos = QtCore.QPointF(self.viewport().mapFromGlobal(QtGui.QCursor.pos()))
+            painter.drawPoint(cursor_pos)
             painter.end()
+            self._cursor_rect = self._brush_cursor_rect(cursor_pos)
+
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        # the scroll blits the old cursor circle along with the scene
+        self.viewport().update(self._cursor_rect.translated(dx, dy))
 
     def keyPressEvent(self, event):
         if self.draw_enabled:
@@ -233,53 +299,264 @@ class MaskDrawPhotoView(PhotoView):
 
         super().keyPressEvent(event)
     
+    def _viewport_rect(self, scene_rect):
+        return self.mapFromScene(QtCore.QRectF(scene_rect)).boundingRect().adjusted(-2, -2, 2, 2)
+
+    def _brush_cursor_rect(self, pos):
+        radius = self.brushSize * self.transform().m11() / 2 + 2
+        return QtCore.QRectF(pos.x() - radius, pos.y() - radius, 2 * radius, 2 * radius).toAlignedRect()
+
+    def _stroke_rect(self, p1, p2):
+        margin = self.brushSize / 2 + 2
+        rect = QtCore.QRectF(p1, p2).normalized()
+        return rect.adjusted(-margin, -margin, margin, margin).toAlignedRect()
+
+    def _paint_stroke(self, p1, p2, color):
+        """Paint a brush stroke from p1 to p2 (scene coordinates) into the mask and return the scene rect it covers."""
+        pen = QtGui.QPen(color, self.brushSize, QtCore.Qt.PenStyle.SolidLine, QtCore.Qt.PenCapStyle.RoundCap, QtCore.Qt.PenJoinStyle.RoundJoin)
+
+        def draw(painter):
+            painter.setPen(pen)
+            if p1 == p2:
+                painter.drawPoint(p1)
+            else:
+                painter.drawLine(p1, p2)
+
+        rect = self._stroke_rect(p1, p2)
+        canvas_rect = rect
+        if self._full_mask is not None:
+            canvas_rect = self._canvas_transform.mapRect(QtCore.QRectF(rect)).toAlignedRect().adjusted(-1, -1, 1, 1)
+            for key in self._full_mask.keys(rect):
+                if key not in self._full_before:
+                    self._full_before[key] = self._full_mask.state(key)
+            self._full_mask.paint(rect, draw)
+        self._save_stroke_before(canvas_rect)
+        painter = QtGui.QPainter(self.canvas)
+        painter.setTransform(self._canvas_transform)
+        draw(painter)
+        painter.end()
+        self._mask_pyramid.invalidate(canvas_rect)
+        return rect
+
+    @property
+    def canvas(self):
+        return self._mask_pyramid.levels[0]
+
+    @canvas.setter
+    def canvas(self, image):
+        self._mask_pyramid = ImagePyramid(image)
+
+    def _save_stroke_before(self, rect):
+        # keep the untouched content of each history tile the stroke is about to paint over
+        size = _MaskEdit.TILE_SIZE
+        rect = rect.intersected(self.canvas.rect())
+        if rect.isEmpty():
+            return
+        for ty in range(rect.top() // size, rect.bottom() // size + 1):
+            for tx in range(rect.left() // size, rect.right() // size + 1):
+                if (tx, ty) not in self._stroke_before:
+                    tile = QtCore.QRect(tx * size, ty * size, size, size).intersected(self.canvas.rect())
+                    self._stroke_before[(tx, ty)] = (tile, self.canvas.copy(tile))
+
     def undo(self):
         if self.history_index > 0:
             self.history_index -= 1
-            self.canvas = self.history[self.history_index].copy()
+            self.history[self.history_index].undo(self)
             self.maskModified.emit()
             self.viewport().update()
 
     def redo(self):
-        if self.history_index < len(self.history) - 1:
+        if self.history_index < len(self.history):
+            self.history[self.history_index].redo(self)
             self.history_index += 1
-            self.canvas = self.history[self.history_index].copy()
             self.maskModified.emit()
             self.viewport().update()
 
-    def record_history(self):
-        self.history = self.history[:self.history_index+1]
-        self.history.append(self.canvas.copy())
-        if len(self.history) > self.max_history:
-            self.history = self.history[-self.max_history:]
-        self.history_index = len(self.history) - 1
+    def record_history(self, edit=None):
+        if edit is None:
+            if not self._stroke_before:
+                return
+            full_tiles = [(key, before, self._full_mask.state(key)) for key, before in self._full_before.items()]
+            edit = _MaskEdit([(rect, before, self.canvas.copy(rect)) for rect, before in self._stroke_before.values()], full_tiles)
+            self._stroke_before = {}
+            self._full_before = {}
+        self.history = self.history[:self.history_index]
+        self.history.append(edit)
+        total = sum(e.nbytes for e in self.history)
+        while total > self.max_history_bytes and len(self.history) > 1:
+            total -= self.history.pop(0).nbytes
+        self.history_index = len(self.history)
+
+    def clear_history(self):
+        self.history = []
+        self.history_index = 0
+        self._stroke_before = {}
+        self._full_before = {}
+
+    def setPhoto(self, pixmap=None, size=None):
+        super().setPhoto(pixmap, size)
+        self._reset_canvas()
+        self.clear_history()
+        self.viewport().update()
 
-    def setPhoto(self, pixmap=None):
-        super().setPhoto(pixmap)
-        self.canvas = QtGui.QPixmap(pixmap.size())
+    def _reset_canvas(self):
+        """Start a blank mask for the photo, with a proxy canvas and a SparseMask if it is over proxy_pixels."""
+        self._mask_loader = None  # a mask file still being read is for what was shown before
+        size = self.getPhotoSize()
+        canvas_size = proxy_size(size, self.proxy_pixels)
+        if canvas_size != size:
+            self._full_mask = SparseMask(size)
+            self._canvas_transform = QtGui.QTransform.fromScale(canvas_size.width() / size.width(), canvas_size.height() / size.height())
+        else:
+            self._full_mask = None
+            self._canvas_transform = QtGui.QTransform()
+        self.canvas = QtGui.QImage(canvas_size, QtGui.QImage.Format.Format_RGB32)
         self.canvas.fill(QtCore.Qt.GlobalColor.white)
-        self.history = [self.canvas.copy()]
-        self.viewport().update()
+
+    def isProxy(self):
+        return self._full_mask is not None
     
     def setMask(self, mask):
-        if mask is None:
-            mask = QtGui.QPixmap(self._photo.pixmap().size())
-            mask.fill(QtCore.Qt.GlobalColor.white)
-        self.canvas = mask
-        self.history = [self.canvas.copy()]
+        mask = _to_image(mask)
+        self._reset_canvas()
+        if mask is not None:
+            if self._full_mask is None:
+                self.canvas = mask.convertToFormat(QtGui.QImage.Format.Format_RGB32)
+            else:
+                self._full_mask, self.canvas = mask_from_image(mask, self.getPhotoSize(), self.canvas.size())
+        self.clear_history()
+        self.viewport().update()
+
+    def loadMask(self, path):
+        """Show the mask file at path; for a proxy, the file is read into the SparseMask on a worker thread."""
+        if not self.isProxy():
+            with profiler.section("read mask"):
+                self.setMask(QtGui.QImage(path))
+            return
+        self._reset_canvas()
+        self.clear_history()
+        self.viewport().update()
+        self._mask_loader = _MaskLoader(path, self.getPhotoSize(), self.canvas.size(), self)
+        self._mask_loader.loaded.connect(self._on_mask_loaded)
+        self._mask_loader.finished.connect(self._mask_loader.deleteLater)
+        self._mask_loader.start()
+
+    def _on_mask_loaded(self, loaded):
+        if self.sender() is not self._mask_loader:
+            return
+        self._mask_loader = None
+        if loaded is not None:
+            self._full_mask, self.canvas = loaded
         self.viewport().update()
+
+    def isMaskLoading(self):
+        return self._mask_loader is not None
+
+    def waitForMaskLoads(self):
+        """Block until the mask files being read, including ones no longer shown, have been read."""
+        for loader in self.findChildren(_MaskLoader):
+            loader.wait()
     
     def getMask(self):
+        """The mask at the photo's full resolution: the canvas, or a snapshot of the SparseMask for a proxy."""
+        if self._full_mask is not None:
+            return self._full_mask.snapshot()
         return self.canvas
+
+    def memoryUsage(self):
+        """Bytes held for the shown photo, by part."""
+        usage = {
+            "photo": self._photo.nbytes(),
+            "mask": self._mask_pyramid.nbytes(),
+            "history": sum(edit.nbytes for edit in self.history),
+        }
+        if self._full_mask is not None:
+            usage["full mask"] = sum(self._full_mask.nbytes())
+        return usage
     
     def invert_mask(self):
+        if self.isMaskLoading():
+            return
+        self._invert_canvas()
+        self.viewport().update()
+        # inverting is its own inverse, so history only needs to remember that it happened
+        self.record_history(_InvertEdit())
+
+    def _invert_canvas(self):
         painter = QtGui.QPainter(self.canvas)
         painter.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_Difference)
         painter.fillRect(self.canvas.rect(), QtCore.Qt.GlobalColor.white)
         painter.end()
-        self.viewport().update()
-        self.record_history()
+        self._mask_pyramid.invalidate(self.canvas.rect())
+        if self._full_mask is not None:
+            self._full_mask.invert()
     
     def setDrawEnabled(self, enabled):
         self.draw_enabled = enabled
         self.viewport().update()
+
+
+class _MaskLoader(QtCore.QThread):
+    """Runs load_mask off the GUI thread."""
+    loaded = QtCore.Signal(object)
+
+    def __init__(self, path, size, canvas_size, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.size = size
+        self.canvas_size = canvas_size
+
+    def run(self):
+        with profiler.section("read mask"):
+            loaded = load_mask(self.path, self.size, self.canvas_size)
+        self.loaded.emit(loaded)
+
+
+class _MaskEdit:
+    """Undo step for a brush stroke: the zlib-compressed before/after pixels of the tiles it touched.
+
+    full_tiles are the before/after SparseMask states of the stroke, for a proxy.
+    """
+    TILE_SIZE = 256
+
+    def __init__(self, tiles, full_tiles=()):
+        self.tiles = [(rect, _pack_image(before), _pack_image(after)) for rect, before, after in tiles]
+        self.full_tiles = list(full_tiles)
+        self.nbytes = sum(len(before[-1]) + len(after[-1]) for _, before, after in self.tiles)
+        self.nbytes += sum(state_nbytes(before) + state_nbytes(after) for _, before, after in self.full_tiles)
+
+    def undo(self, view):
+        self._apply(view, 1)
+
+    def redo(self, view):
+        self._apply(view, 2)
+
+    def _apply(self, view, which):
+        painter = QtGui.QPainter(view.canvas)
+        painter.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_Source)
+        for tile in self.tiles:
+            painter.drawImage(tile[0].topLeft(), _unpack_image(tile[which]))
+        painter.end()
+        for tile in self.tiles:
+            view._mask_pyramid.invalidate(tile[0])
+        for tile in self.full_tiles:
+            view._full_mask.restore(tile[0], tile[which])
+
+
+class _InvertEdit:
+    nbytes = 0
+
+    def undo(self, view):
+        view._invert_canvas()
+
+    def redo(self, view):
+        view._invert_canvas()
+
+
+def _pack_image(image):
+    return image.width(), image.height(), image.bytesPerLine(), image.format(), zlib.compress(image.constBits().tobytes(), 1)
+
+
+def _unpack_image(packed):
+    width, height, bytes_per_line, format, data = packed
+    return QtGui.QImage(zlib.decompress(data), width, height, bytes_per_line, format).copy()
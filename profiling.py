@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import nullcontext
+
+PROFILE_ENV = "IMAGE_DATA_TOOL_PROFILE"
+TRACE_ENV = "IMAGE_DATA_TOOL_TRACE"
+
+_NULL_SECTION = nullcontext()
+
+
+class _Section:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Profiler:
+    """Timing hooks for the hot paths: decode, layout, paint, sidecar reads and saves.
+
+    Disabled, section() returns a shared no-op context manager, so the hooks cost one attribute
+    check. Enabled, it keeps the last and worst duration per section (worst since the last
+    take_stats()), and while a trace is recording it also streams every section to a Chrome trace
+    file (JSON array format), which chrome://tracing and Perfetto load directly.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._last = {}
+        self._worst = {}
+        self._trace = None
+        self._trace_path = None
+        self._trace_empty = True
+        self._threads = set()
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+
+    def section(self, name):
+        if not self.enabled:
+            return _NULL_SECTION
+        return _Section(self, name)
+
+    def record(self, name, start, end):
+        ms = (end - start) * 1000
+        tid = threading.get_ident()
+        with self._lock:
+            self._last[name] = ms
+            self._worst[name] = max(ms, self._worst.get(name, 0))
+            if self._trace is not None:
+                if tid not in self._threads:
+                    self._threads.add(tid)
+                    self._write_event({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid,
+                                       "args": {"name": threading.current_thread().name}})
+                self._write_event({"name": name, "cat": "image-data-tool", "ph": "X", "pid": self._pid, "tid": tid,
+                                   "ts": round((start - self._origin) * 1e6, 1), "dur": round(ms * 1000, 1)})
+
+    def counter(self, name, **values):
+        """Add a counter sample (e.g. cache hit rate) to the trace, if one is recording."""
+        with self._lock:
+            if self._trace is not None:
+                self._write_event({"name": name, "ph": "C", "pid": self._pid,
+                                   "ts": round((time.perf_counter() - self._origin) * 1e6, 1), "args": values})
+
+    def take_stats(self):
+        """Return {section: (last ms, worst ms since the previous call)}."""
+        with self._lock:
+            stats = {name: (ms, self._worst.get(name, ms)) for name, ms in self._last.items()}
+            self._worst.clear()
+        return stats
+
+    def start_trace(self, path):
+        self.stop_trace()
+        trace = open(path, "w")
+        # events are appended as they happen; the closing bracket is optional in this format,
+        # so a trace cut short by a crash still loads
+        trace.write("[\n")
+        with self._lock:
+            self._trace = trace
+            self._trace_path = path
+            self._trace_empty = True
+            self._threads = set()
+        self.enabled = True
+
+    def stop_trace(self):
+        """Stop recording and return the path of the finished trace, or None."""
+        with self._lock:
+            trace, path = self._trace, self._trace_path
+            self._trace = None
+            self._trace_path = None
+        if trace is None:
+            return None
+        trace.write("\n]\n")
+        trace.close()
+        return path
+
+    @property
+    def tracing(self):
+        return self._trace is not None
+
+    def _write_event(self, event):
+        self._trace.write(("" if self._trace_empty else ",\n") + json.dumps(event, separators=(",", ":")))
+        self._trace_empty = False
+
+
+profiler = Profiler()
+if os.environ.get(PROFILE_ENV, "") not in ("", "0"):
+    profiler.enabled = True
+if os.environ.get(TRACE_ENV):
+    profiler.start_trace(os.environ[TRACE_ENV])
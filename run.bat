@@ -7,6 +7,6 @@ if not exist venv (
     call venv\Scripts\activate.bat
 )
 
-python main.py
+python main.py %*
 
 deactivate
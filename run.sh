@@ -10,6 +10,6 @@ else
     source venv/bin/activate
 fi
 
-python main.py
+python main.py "$@"
 
 deactivate
@@ -0,0 +1,280 @@
+import struct
+import zlib
+
+from collections import OrderedDict
+
+from PySide6 import QtCore, QtGui
+
+from image_cache import PngBandReader
+
+
+class SparseMask:
+    """Full-resolution mask of an image too large to hold at once, as a grid of 8-bit tiles.
+
+    Tiles that were never painted are not stored and read as the fill value (white, or black after
+    an invert). Up to max_bytes of recently painted tiles are kept decoded; the rest are kept zlib
+    compressed, which for masks is a small fraction of their size. A snapshot() shares the tiles
+    copy-on-write, so it can be written out on another thread while painting continues.
+    """
+    TILE_SIZE = 1024
+
+    def __init__(self, size, max_bytes=64 * 1024 * 1024):
+        self.width = size.width()
+        self.height = size.height()
+        self.max_bytes = max_bytes
+        self.fill = 255
+        self._open = OrderedDict()  # key -> decoded QImage, least recently used first
+        self._open_bytes = 0
+        self._packed = {}  # key -> _pack() tuple
+
+    def keys(self, rect):
+        """The keys of the tiles overlapping rect (full-resolution pixels)."""
+        rect = rect.intersected(QtCore.QRect(0, 0, self.width, self.height))
+        if rect.isEmpty():
+            return []
+        size = self.TILE_SIZE
+        return [(tx, ty) for ty in range(rect.top() // size, rect.bottom() // size + 1)
+                for tx in range(rect.left() // size, rect.right() // size + 1)]
+
+    def tile_rect(self, key):
+        tx, ty = key
+        size = self.TILE_SIZE
+        return QtCore.QRect(tx * size, ty * size, size, size).intersected(QtCore.QRect(0, 0, self.width, self.height))
+
+    def paint(self, rect, draw):
+        """Call draw(painter) on every tile overlapping rect, with the painter in full-resolution coordinates."""
+        for key in self.keys(rect):
+            tile_rect = self.tile_rect(key)
+            painter = QtGui.QPainter(self._tile(key))
+            painter.translate(-tile_rect.left(), -tile_rect.top())
+            draw(painter)
+            painter.end()
+        self._evict()
+
+    def state(self, key):
+        """The content of a tile, for undo history: a packed tile, or None if it is unpainted."""
+        image = self._open.get(key)
+        if image is not None:
+            return _pack(image)
+        return self._packed.get(key)
+
+    def restore(self, key, state):
+        image = self._open.pop(key, None)
+        if image is not None:
+            self._open_bytes -= image.sizeInBytes()
+        if state is None:
+            self._packed.pop(key, None)
+        else:
+            self._packed[key] = state
+
+    def invert(self):
+        self.fill = 255 - self.fill
+        for image in self._open.values():
+            image.invertPixels()
+        for key, packed in list(self._packed.items()):
+            image = _unpack(packed)
+            image.invertPixels()
+            self._packed[key] = _pack(image)
+
+    def set_strip(self, y, strip):
+        """Replace the tiles of the tile row starting at y with strip (Grayscale8, full width); white tiles are dropped."""
+        ty = y // self.TILE_SIZE
+        for tx in range((self.width + self.TILE_SIZE - 1) // self.TILE_SIZE):
+            rect = self.tile_rect((tx, ty))
+            tile = strip.copy(rect.translated(0, -y))
+            self.restore((tx, ty), None if _is_white(tile) else _pack(tile))
+
+    def snapshot(self):
+        copy = SparseMask(QtCore.QSize(self.width, self.height), self.max_bytes)
+        copy.fill = self.fill
+        copy._packed = dict(self._packed)
+        for key, image in self._open.items():
+            copy._open[key] = QtGui.QImage(image)  # shares the pixels until either side paints
+        copy._open_bytes = self._open_bytes
+        return copy
+
+    def is_blank(self):
+        """True if nothing is masked out, i.e. every pixel is white."""
+        if self.fill != 255:
+            return False
+        return all(_is_white(image) for image in self._open.values()) and all(packed[-1] for packed in self._packed.values())
+
+    def nbytes(self):
+        """(bytes of decoded tiles, bytes of compressed tiles)."""
+        return self._open_bytes, sum(state_nbytes(packed) for packed in self._packed.values())
+
+    def rows(self, ty):
+        """The pixels of tile row ty as an (height, width) uint8 array."""
+        import numpy as np
+        top = ty * self.TILE_SIZE
+        height = min(self.TILE_SIZE, self.height - top)
+        rows = np.full((height, self.width), self.fill, np.uint8)
+        for tx in range((self.width + self.TILE_SIZE - 1) // self.TILE_SIZE):
+            image = self._open.get((tx, ty))
+            if image is None:
+                packed = self._packed.get((tx, ty))
+                if packed is None:
+                    continue
+                image = _unpack(packed)
+            rows[:, tx * self.TILE_SIZE:tx * self.TILE_SIZE + image.width()] = _pixels(image)
+        return rows
+
+    def write(self, path, fmt):
+        """Write the mask to path as an 8-bit grayscale image in fmt (e.g. "PNG", "JPG").
+
+        PNG is encoded one tile row at a time, so the full-resolution mask never exists in memory;
+        other formats need the whole image for their encoder and assemble it first.
+        """
+        tile_rows = (self.height + self.TILE_SIZE - 1) // self.TILE_SIZE
+        if fmt.upper() == "PNG":
+            with open(path, "wb") as f:
+                _write_png(f, self.width, self.height, (self.rows(ty) for ty in range(tile_rows)))
+            return True
+        image = QtGui.QImage(self.width, self.height, QtGui.QImage.Format.Format_Grayscale8)
+        pixels = _pixels(image, writable=True)
+        for ty in range(tile_rows):
+            pixels[ty * self.TILE_SIZE:(ty + 1) * self.TILE_SIZE] = self.rows(ty)
+        return image.save(path, fmt)
+
+    def _tile(self, key):
+        image = self._open.get(key)
+        if image is not None:
+            self._open.move_to_end(key)
+            return image
+        packed = self._packed.pop(key, None)
+        if packed is not None:
+            image = _unpack(packed)
+        else:
+            rect = self.tile_rect(key)
+            image = QtGui.QImage(rect.size(), QtGui.QImage.Format.Format_Grayscale8)
+            image.fill(QtGui.QColor(self.fill, self.fill, self.fill))
+        self._open[key] = image
+        self._open_bytes += image.sizeInBytes()
+        return image
+
+    def _evict(self):
+        while self._open_bytes > self.max_bytes and len(self._open) > 1:
+            key, image = self._open.popitem(last=False)
+            self._open_bytes -= image.sizeInBytes()
+            self._packed[key] = _pack(image)
+
+
+def load_mask(path, size, proxy_size):
+    """Read a mask file for an image of size into a SparseMask, and an RGB32 copy of it scaled to proxy_size.
+
+    The file is decoded in a single pass: 8-bit PNGs, which is what masks are saved as, a tile row
+    at a time, other formats in full. A JPEG too large to decode in full within QImageReader's
+    allocation limit is decoded in as few bands as fit in it. Returns None if the file cannot be read.
+    """
+    try:
+        with PngBandReader(path) as png:
+            if QtCore.QSize(png.width, png.height) == size:
+                return _build(size, proxy_size, (_grayscale8(band) for band in png.bands(SparseMask.TILE_SIZE)))
+    except (OSError, ValueError, zlib.error, struct.error):
+        pass  # not a PNG that can be read in bands, or a corrupt one: decoded in full below
+    reader = QtGui.QImageReader(path)
+    file_size = reader.size()
+    image = reader.read()
+    if not image.isNull():
+        return mask_from_image(image, size, proxy_size)
+    limit = QtGui.QImageReader.allocationLimit() * 1024 * 1024
+    if file_size != size or not limit or not reader.supportsOption(QtGui.QImageIOHandler.ImageOption.ClipRect):
+        return None
+    # each band decodes the file from the top again, so they are made as tall as half the limit allows (at 4 bytes a pixel)
+    band_rows = max(1, limit // 2 // (4 * size.width()) // SparseMask.TILE_SIZE) * SparseMask.TILE_SIZE
+    return _build(size, proxy_size, _read_bands(path, size, band_rows))
+
+
+def mask_from_image(image, size, proxy_size):
+    """Like load_mask, for a mask image already in memory."""
+    if image.size() != size:
+        image = image.scaled(size, QtCore.Qt.AspectRatioMode.IgnoreAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation)
+    tile = SparseMask.TILE_SIZE
+    return _build(size, proxy_size, (image.copy(0, y, size.width(), min(tile, size.height() - y)) for y in range(0, size.height(), tile)))
+
+
+def _read_bands(path, size, band_rows):
+    """Yield the tile rows of an image file, decoding band_rows rows of it at a time."""
+    for top in range(0, size.height(), band_rows):
+        reader = QtGui.QImageReader(path)
+        reader.setClipRect(QtCore.QRect(0, top, size.width(), min(band_rows, size.height() - top)))
+        band = reader.read()
+        if band.isNull():
+            yield band
+            return
+        for y in range(0, band.height(), SparseMask.TILE_SIZE):
+            yield band.copy(0, y, band.width(), min(SparseMask.TILE_SIZE, band.height() - y))
+
+
+def state_nbytes(state):
+    """The size of a SparseMask.state()."""
+    return 0 if state is None else len(state[3])
+
+
+def _build(size, proxy_size, strips):
+    """Fill a SparseMask and its proxy from strips, the mask's tile rows top to bottom; None if they end early."""
+    mask = SparseMask(size)
+    proxy = QtGui.QImage(proxy_size, QtGui.QImage.Format.Format_RGB32)
+    proxy.fill(QtCore.Qt.GlobalColor.white)
+    painter = QtGui.QPainter(proxy)
+    painter.setRenderHint(QtGui.QPainter.RenderHint.SmoothPixmapTransform)
+    painter.scale(proxy_size.width() / size.width(), proxy_size.height() / size.height())
+    y = 0
+    try:
+        for strip in strips:
+            if strip.isNull() or y >= size.height():
+                return None
+            strip = strip.convertToFormat(QtGui.QImage.Format.Format_Grayscale8)
+            mask.set_strip(y, strip)
+            painter.drawImage(QtCore.QRectF(0, y, strip.width(), strip.height()), strip)
+            y += strip.height()
+    finally:
+        painter.end()
+    return (mask, proxy) if y == size.height() else None
+
+
+def _grayscale8(image):
+    """A Pillow image as a Grayscale8 QImage."""
+    pixels = (image if image.mode == "L" else image.convert("L")).tobytes()
+    return QtGui.QImage(pixels, image.width, image.height, image.width, QtGui.QImage.Format.Format_Grayscale8).copy()
+
+
+def _pixels(image, writable=False):
+    """A (height, width) uint8 view of a Grayscale8 image's pixels, without the row padding."""
+    # numpy is imported where it is used, so it stays off the startup path when no image is a proxy
+    import numpy as np
+    bits = image.bits() if writable else image.constBits()
+    return np.frombuffer(bits, np.uint8, image.bytesPerLine() * image.height()).reshape(
+        image.height(), image.bytesPerLine())[:, :image.width()]
+
+
+def _is_white(image):
+    return bool(_pixels(image).min() == 255)
+
+
+def _pack(image):
+    return image.width(), image.height(), image.bytesPerLine(), zlib.compress(image.constBits().tobytes(), 1), _is_white(image)
+
+
+def _unpack(packed):
+    width, height, bytes_per_line, data, _ = packed
+    return QtGui.QImage(zlib.decompress(data), width, height, bytes_per_line, QtGui.QImage.Format.Format_Grayscale8).copy()
+
+
+def _write_png(f, width, height, strips):
+    """Stream an 8-bit grayscale PNG from (rows, width) uint8 arrays, using no row filters."""
+    import numpy as np
+    def chunk(kind, data):
+        f.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+    f.write(b"\x89PNG\r\n\x1a\n")
+    chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+    compressor = zlib.compressobj(3)
+    for rows in strips:
+        filtered = np.zeros((rows.shape[0], width + 1), np.uint8)  # a leading 0 per row: filter type None
+        filtered[:, 1:] = rows
+        data = compressor.compress(filtered.tobytes())
+        if data:
+            chunk(b"IDAT", data)
+    chunk(b"IDAT", compressor.flush())
+    chunk(b"IEND", b"")
@@ -0,0 +1,148 @@
+import os
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6 import QtCore
+
+from dataset_index import DatasetIndex
+
+
+def parse_tags(text):
+    """Split a tag file's contents on commas into normalized, de-duplicated tags."""
+    tags = []
+    for tag in text.split(","):
+        tag = " ".join(tag.split()).lower()
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def parse_query(text):
+    """Parse a filter query into (negated, alternatives) clauses.
+
+    Clauses are separated by commas and must all hold (AND); "|" separates alternatives within a
+    clause (OR); a leading "-" or "!" negates a clause (NOT). For example: "1girl, red hair | blue hair, -hat".
+    """
+    clauses = []
+    for clause in text.split(","):
+        clause = clause.strip()
+        negated = clause.startswith(("-", "!"))
+        if negated:
+            clause = clause[1:]
+        alternatives = [tag for tag in (" ".join(t.split()).lower() for t in clause.split("|")) if tag]
+        if alternatives:
+            clauses.append((negated, alternatives))
+    return clauses
+
+
+class TagIndex:
+    """Inverted index from tag to the images whose tag file contains it.
+
+    Images get integer ids in the order they were added, so query results come back in dataset order.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.ids = {}
+        self.postings = defaultdict(set)
+        self._tags_of = []
+
+    def set_tags(self, path, tags):
+        image_id = self.ids.get(path)
+        if image_id is None:
+            image_id = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+            self._tags_of.append(())
+        for tag in self._tags_of[image_id]:
+            self._discard(tag, image_id)
+        for tag in tags:
+            self.postings[tag].add(image_id)
+        self._tags_of[image_id] = tuple(tags)
+
+    def remove(self, path):
+        image_id = self.ids.pop(path, None)
+        if image_id is None:
+            return
+        for tag in self._tags_of[image_id]:
+            self._discard(tag, image_id)
+        self._tags_of[image_id] = ()
+        self.paths[image_id] = None
+
+    def tags(self, path):
+        image_id = self.ids.get(path)
+        return self._tags_of[image_id] if image_id is not None else ()
+
+    def query(self, text):
+        """Return the paths matching a parse_query query, in the order they were indexed."""
+        clauses = parse_query(text)
+        positive = []
+        negative = set()
+        for negated, alternatives in clauses:
+            matches = set().union(*(self.postings.get(tag, ()) for tag in alternatives))
+            if negated:
+                negative |= matches
+            else:
+                positive.append(matches)
+        if positive:
+            positive.sort(key=len)
+            result = positive[0].intersection(*positive[1:])
+        else:
+            result = set(self.ids.values())
+        result -= negative
+        return [self.paths[image_id] for image_id in sorted(result)]
+
+    def _discard(self, tag, image_id):
+        posting = self.postings.get(tag)
+        if posting is not None:
+            posting.discard(image_id)
+            if not posting:
+                del self.postings[tag]
+
+
+def read_tags(path):
+    if path is None:
+        return []
+    try:
+        with open(path) as f:
+            return parse_tags(f.read())
+    except OSError:
+        return []
+
+
+def _read_tags_chunk(paths):
+    return [read_tags(path) for path in paths]
+
+
+class TagIndexBuilder(QtCore.QThread):
+    """Builds a TagIndex for a list of images off the GUI thread, reading tag files in parallel."""
+    built = QtCore.Signal(object)
+
+    def __init__(self, folder, images, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.images = images
+
+    def run(self):
+        index = DatasetIndex(self.folder)
+        try:
+            tag_exts = {path: entry.tag_ext for path, entry in index.entries()}
+        finally:
+            index.close()
+        tag_files = []
+        for path in self.images:
+            tag_ext = tag_exts.get(path)
+            tag_files.append(os.path.splitext(path)[0] + tag_ext if tag_ext else None)
+
+        # file reads release the GIL, so threads overlap the I/O latency of many small files
+        chunk_size = 1000
+        chunks = [tag_files[i:i + chunk_size] for i in range(0, len(tag_files), chunk_size)]
+        tag_index = TagIndex()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for start, tags_chunk in zip(range(0, len(tag_files), chunk_size), executor.map(_read_tags_chunk, chunks)):
+                if self.isInterruptionRequested():
+                    executor.shutdown(cancel_futures=True)
+                    return
+                for path, tags in zip(self.images[start:start + chunk_size], tags_chunk):
+                    tag_index.set_tags(path, tags)
+        self.built.emit(tag_index)
@@ -0,0 +1,290 @@
+import hashlib
+import multiprocessing
+import os
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PySide6 import QtCore, QtGui, QtWidgets
+
+
+THUMBNAIL_SIZE = 128
+
+
+def thumbnail_cache_dir():
+    location = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.StandardLocation.CacheLocation)
+    return os.path.join(location or os.path.expanduser("~/.cache/image-data-tool"), "thumbnails")
+
+
+def thumbnail_path(cache_dir, path, mtime_ns, size):
+    key = hashlib.sha1(f"{os.path.abspath(path)}|{mtime_ns}|{size}".encode()).hexdigest()
+    return os.path.join(cache_dir, key[:2], key + ".jpg")
+
+
+def make_thumbnail(src, dst, max_side=THUMBNAIL_SIZE):
+    """Runs in a worker process; uses Pillow so the workers never touch Qt. Returns (dst, None) or (None, error)."""
+    from PIL import Image
+
+    try:
+        with Image.open(src) as image:
+            image.draft("RGB", (max_side * 2, max_side * 2))
+            image.thumbnail((max_side, max_side))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = f"{dst}.{os.getpid()}.tmp"
+            image.convert("RGB").save(tmp, "JPEG", quality=85)
+        os.replace(tmp, dst)
+    except Exception as e:
+        return None, str(e)
+    return dst, None
+
+
+class ThumbnailLoader(QtCore.QObject):
+    """Serves thumbnails from the on-disk cache, generating missing ones in a process pool.
+
+    Requests are served newest first, so the rows currently on screen are generated before the ones
+    that were scrolled past. Images that cannot be read are reported once through thumbnailFailed.
+    """
+    thumbnailReady = QtCore.Signal(str)
+    thumbnailFailed = QtCore.Signal(str, str)
+    _generated = QtCore.Signal(str, str, str)
+
+    def __init__(self, cache_dir=None, max_memory_items=1000, parent=None):
+        super().__init__(parent)
+        self.cache_dir = cache_dir or thumbnail_cache_dir()
+        self.max_memory_items = max_memory_items
+        self.max_queued = 512
+        self._pixmaps = OrderedDict()
+        self._queue = OrderedDict()
+        self._in_flight = set()
+        self._failed = set()
+        self._workers = max(1, min(8, (os.cpu_count() or 2) - 1))
+        self._executor = None
+        self._generated.connect(self._on_generated)
+
+    def get(self, path, mtime_ns, size):
+        """Return the thumbnail pixmap for path, or None after queueing its generation."""
+        pixmap = self._pixmaps.get(path)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(path)
+            return pixmap
+        if path in self._failed:
+            return None
+        dst = thumbnail_path(self.cache_dir, path, mtime_ns, size)
+        image = QtGui.QImage(dst)
+        if not image.isNull():
+            return self._remember(path, QtGui.QPixmap.fromImage(image))
+        if path not in self._in_flight:
+            self._queue[path] = dst
+            self._queue.move_to_end(path)
+            while len(self._queue) > self.max_queued:
+                self._queue.popitem(last=False)
+            self._submit()
+        return None
+
+    def clear(self):
+        self._pixmaps.clear()
+        self._queue.clear()
+        self._failed.clear()
+
+    def shutdown(self):
+        self._queue.clear()
+        if self._executor is not None:
+            # only the thumbnail each worker is on is left to finish; not waiting would leave the workers running
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _submit(self):
+        if self._executor is None:
+            # spawn, not fork: forking a process that runs Qt threads is unsafe
+            self._executor = ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context("spawn"))
+        while self._queue and len(self._in_flight) < self._workers * 2:
+            path, dst = self._queue.popitem(last=True)
+            self._in_flight.add(path)
+            future = self._executor.submit(make_thumbnail, path, dst)
+            future.add_done_callback(lambda f, path=path: self._generated.emit(path, *_thumbnail_result(f)))
+
+    def _on_generated(self, path, dst, error):
+        self._in_flight.discard(path)
+        image = QtGui.QImage(dst) if dst else QtGui.QImage()
+        if image.isNull():
+            self._failed.add(path)
+            if error:
+                self.thumbnailFailed.emit(path, error)
+        else:
+            self._remember(path, QtGui.QPixmap.fromImage(image))
+            self.thumbnailReady.emit(path)
+        if self._executor is not None:
+            self._submit()
+
+    def _remember(self, path, pixmap):
+        self._pixmaps[path] = pixmap
+        while len(self._pixmaps) > self.max_memory_items:
+            self._pixmaps.popitem(last=False)
+        return pixmap
+
+
+def _thumbnail_result(future):
+    """(dst, error) of a make_thumbnail future as strings, "" for none; a cancelled one is not an error."""
+    if future.cancelled():
+        return "", ""
+    if future.exception() is not None:
+        # e.g. the worker process died
+        return "", str(future.exception())
+    dst, error = future.result()
+    return dst or "", error or ""
+
+
+class ThumbnailModel(QtCore.QAbstractListModel):
+    """List model over MainWindow.images; thumbnails and index entries are only fetched for painted rows."""
+
+    def __init__(self, loader, parent=None):
+        super().__init__(parent)
+        self.loader = loader
+        self.loader.thumbnailReady.connect(self._on_thumbnail_ready)
+        self.images = []
+        self.dataset_index = None
+        self._rows = {}
+
+    def setImages(self, images, dataset_index):
+        self.beginResetModel()
+        self.images = images
+        self.dataset_index = dataset_index
+        self._rows = {}
+        self.endResetModel()
+
+    def imagesAppended(self, count):
+        """Call after count paths were appended to the shared images list."""
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.images) - count, len(self.images) - 1)
+        self._rows = {}
+        self.endInsertRows()
+
+    def imageRemoved(self, row):
+        """Call after the path at row was removed from the shared images list."""
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        self._rows = {}
+        self.endRemoveRows()
+
+    def imagesInserted(self, rows):
+        """Call after paths were inserted into the shared images list at rows, ascending row numbers in the new list."""
+        for first, last in _runs(rows):
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+            self._rows = {}
+            self.endInsertRows()
+
+    def imagesRemoved(self, rows):
+        """Call after the paths at rows, ascending row numbers in the old list, were removed from the shared images list."""
+        for first, last in reversed(_runs(rows)):
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            self._rows = {}
+            self.endRemoveRows()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.images)
+
+    def data(self, index, role=QtCore.Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.images):
+            return None
+        if role == QtCore.Qt.ItemDataRole.ToolTipRole:
+            return os.path.basename(self.images[index.row()])
+        if role == QtCore.Qt.ItemDataRole.DecorationRole:
+            return self.thumbnail(index.row())
+        return None
+
+    # The delegate calls these directly rather than going through QModelIndex.data(), which
+    # mishandles the refcount of None results in some PySide6 versions.
+
+    def thumbnail(self, row):
+        entry = self.entry(row)
+        if entry is None:
+            return None
+        return self.loader.get(self.images[row], entry.mtime_ns, entry.size)
+
+    def entry(self, row):
+        if self.dataset_index is None or row >= len(self.images):
+            return None
+        return self.dataset_index.get(self.images[row])
+
+    def _on_thumbnail_ready(self, path):
+        if not self._rows:
+            self._rows = {path: row for row, path in enumerate(self.images)}
+        row = self._rows.get(path)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [QtCore.Qt.ItemDataRole.DecorationRole])
+
+
+class ThumbnailDelegate(QtWidgets.QStyledItemDelegate):
+    """Draws a thumbnail with caption (C), tag (T) and mask (M) presence badges."""
+    CELL_SIZE = THUMBNAIL_SIZE + 12
+
+    def sizeHint(self, option, index):
+        return QtCore.QSize(self.CELL_SIZE, self.CELL_SIZE)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        rect = option.rect.adjusted(2, 2, -2, -2)
+        if option.state & QtWidgets.QStyle.StateFlag.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        pixmap = index.model().thumbnail(index.row())
+        if pixmap is not None:
+            target = QtCore.QRect(QtCore.QPoint(0, 0), pixmap.size().scaled(rect.size(), QtCore.Qt.AspectRatioMode.KeepAspectRatio))
+            target.moveCenter(rect.center())
+            painter.drawPixmap(target, pixmap)
+        else:
+            painter.fillRect(rect, QtGui.QColor(45, 45, 45))
+
+        entry = index.model().entry(index.row())
+        if entry is not None:
+            badges = [
+                ("C", entry.caption_ext, QtGui.QColor(60, 140, 220)),
+                ("T", entry.tag_ext, QtGui.QColor(220, 160, 40)),
+                ("M", entry.has_mask, QtGui.QColor(200, 60, 60)),
+            ]
+            badge = QtCore.QRect(rect.left() + 2, rect.bottom() - 16, 14, 14)
+            painter.setPen(QtCore.Qt.GlobalColor.white)
+            for text, present, color in badges:
+                if present:
+                    painter.fillRect(badge, color)
+                    painter.drawText(badge, QtCore.Qt.AlignmentFlag.AlignCenter, text)
+                    badge.translate(16, 0)
+        painter.restore()
+
+
+class ThumbnailBrowser(QtWidgets.QListView):
+    """Virtualized thumbnail grid; only the rows in view are ever asked for their data."""
+    imageSelected = QtCore.Signal(int)
+
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setItemDelegate(ThumbnailDelegate(self))
+        self.setViewMode(QtWidgets.QListView.ViewMode.IconMode)
+        self.setResizeMode(QtWidgets.QListView.ResizeMode.Adjust)
+        self.setMovement(QtWidgets.QListView.Movement.Static)
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QtWidgets.QListView.LayoutMode.Batched)
+        self.setBatchSize(1000)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.SingleSelection)
+        self.setFocusPolicy(QtCore.Qt.FocusPolicy.NoFocus)
+        self.setMinimumWidth(ThumbnailDelegate.CELL_SIZE * 2 + self.verticalScrollBar().sizeHint().width() + 8)
+        self.clicked.connect(lambda index: self.imageSelected.emit(index.row()))
+
+    def setCurrentRow(self, row):
+        index = self.model().index(row)
+        if index.isValid():
+            self.selectionModel().setCurrentIndex(index, QtCore.QItemSelectionModel.SelectionFlag.ClearAndSelect)
+            self.scrollTo(index)
+
+
+def _runs(rows):
+    """Group ascending row numbers into [(first, last)] runs of consecutive rows."""
+    runs = []
+    for row in rows:
+        if runs and runs[-1][1] == row - 1:
+            runs[-1] = (runs[-1][0], row)
+        else:
+            runs.append((row, row))
+    return runs
@@ -0,0 +1,166 @@
+import math
+
+from collections import OrderedDict
+
+from PySide6 import QtCore, QtGui, QtWidgets
+
+from profiling import profiler
+
+
+class ImagePyramid:
+    """Mip pyramid of a QImage, drawn as cached tiles at the level of detail matching the view scale.
+
+    Level 0 is the source image and each further level halves it. Levels and tiles are built lazily,
+    so only the parts of the image that are actually looked at are ever resampled.
+    """
+    TILE_SIZE = 512
+
+    def __init__(self, image, max_tile_bytes=128 * 1024 * 1024):
+        self.levels = [image]
+        self.max_tile_bytes = max_tile_bytes
+        self._tiles = OrderedDict()
+        self._tile_bytes = 0
+        size = max(image.width(), image.height())
+        self.level_count = 1
+        while size > self.TILE_SIZE:
+            size = (size + 1) // 2
+            self.level_count += 1
+
+    def width(self):
+        return self.levels[0].width()
+
+    def height(self):
+        return self.levels[0].height()
+
+    def level(self, k):
+        while len(self.levels) <= k:
+            prev = self.levels[-1]
+            with profiler.section("pyramid level"):
+                self.levels.append(prev.scaled(
+                    max(1, (prev.width() + 1) // 2), max(1, (prev.height() + 1) // 2),
+                    QtCore.Qt.AspectRatioMode.IgnoreAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation))
+        return self.levels[k]
+
+    def nbytes(self):
+        """Bytes held by the built levels and the cached tiles."""
+        return sum(level.sizeInBytes() for level in self.levels) + self._tile_bytes
+
+    def level_for_scale(self, scale):
+        if scale <= 0 or scale >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / scale))), self.level_count - 1)
+
+    def tile(self, k, tx, ty):
+        key = (k, tx, ty)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+        level = self.level(k)
+        rect = QtCore.QRect(tx * self.TILE_SIZE, ty * self.TILE_SIZE, self.TILE_SIZE, self.TILE_SIZE).intersected(level.rect())
+        with profiler.section("tile upload"):
+            pixmap = QtGui.QPixmap.fromImage(level.copy(rect))
+        self._tiles[key] = pixmap
+        self._tile_bytes += _pixmap_bytes(pixmap)
+        while self._tile_bytes > self.max_tile_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._tile_bytes -= _pixmap_bytes(evicted)
+        return pixmap
+
+    def draw(self, painter, exposed, scale):
+        """Draw the tiles covering exposed (in level 0 pixels) at the level matching scale (device px per level 0 px)."""
+        exposed = exposed.intersected(QtCore.QRectF(0, 0, self.width(), self.height()))
+        if exposed.isEmpty():
+            return
+        k = self.level_for_scale(scale)
+        level = self.level(k)
+        sx = self.width() / level.width()
+        sy = self.height() / level.height()
+        tile_w = self.TILE_SIZE * sx
+        tile_h = self.TILE_SIZE * sy
+        x0 = int(exposed.left() // tile_w)
+        x1 = int(math.ceil(exposed.right() / tile_w))
+        y0 = int(exposed.top() // tile_h)
+        y1 = int(math.ceil(exposed.bottom() / tile_h))
+        for ty in range(y0, y1):
+            for tx in range(x0, x1):
+                pixmap = self.tile(k, tx, ty)
+                target = QtCore.QRectF(tx * tile_w, ty * tile_h, pixmap.width() * sx, pixmap.height() * sy)
+                painter.drawPixmap(target, pixmap, QtCore.QRectF(pixmap.rect()))
+
+    def invalidate(self, rect):
+        """Refresh the levels and tiles overlapping rect (in level 0 pixels) after the source image was painted on."""
+        rect = rect.intersected(self.levels[0].rect())
+        if rect.isEmpty():
+            return
+        src = QtCore.QRectF(rect)
+        for k in range(len(self.levels)):
+            if k > 0:
+                prev = self.levels[k - 1]
+                level = self.levels[k]
+                fx = level.width() / prev.width()
+                fy = level.height() / prev.height()
+                dst = QtCore.QRectF(src.left() * fx, src.top() * fy, src.width() * fx, src.height() * fy).toAlignedRect()
+                dst = dst.intersected(level.rect())
+                src = QtCore.QRectF(dst.left() / fx, dst.top() / fy, dst.width() / fx, dst.height() / fy)
+                painter = QtGui.QPainter(level)
+                painter.setCompositionMode(QtGui.QPainter.CompositionMode.CompositionMode_Source)
+                painter.setRenderHint(QtGui.QPainter.RenderHint.SmoothPixmapTransform)
+                painter.drawImage(QtCore.QRectF(dst), prev, src)
+                painter.end()
+                src = QtCore.QRectF(dst)
+            tiles = src.toAlignedRect()
+            for ty in range(tiles.top() // self.TILE_SIZE, tiles.bottom() // self.TILE_SIZE + 1):
+                for tx in range(tiles.left() // self.TILE_SIZE, tiles.right() // self.TILE_SIZE + 1):
+                    pixmap = self._tiles.pop((k, tx, ty), None)
+                    if pixmap is not None:
+                        self._tile_bytes -= _pixmap_bytes(pixmap)
+
+
+def _pixmap_bytes(pixmap):
+    return pixmap.width() * pixmap.height() * max(1, pixmap.depth() // 8)
+
+
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    """Graphics item that renders a QImage through an ImagePyramid, painting only the exposed tiles."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFlag(QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption, True)
+        self._pyramid = None
+        self._smooth = True
+
+    def setImage(self, image):
+        self.prepareGeometryChange()
+        if image is None or image.isNull():
+            self._pyramid = None
+        else:
+            self._pyramid = ImagePyramid(image)
+        self.update()
+
+    def image(self):
+        if self._pyramid is None:
+            return QtGui.QImage()
+        return self._pyramid.levels[0]
+
+    def isNull(self):
+        return self._pyramid is None
+
+    def nbytes(self):
+        return 0 if self._pyramid is None else self._pyramid.nbytes()
+
+    def setTransformationMode(self, mode):
+        self._smooth = mode == QtCore.Qt.TransformationMode.SmoothTransformation
+        self.update()
+
+    def boundingRect(self):
+        if self._pyramid is None:
+            return QtCore.QRectF()
+        return QtCore.QRectF(0, 0, self._pyramid.width(), self._pyramid.height())
+
+    def paint(self, painter, option, widget=None):
+        if self._pyramid is None:
+            return
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        painter.setRenderHint(QtGui.QPainter.RenderHint.SmoothPixmapTransform, self._smooth)
+        self._pyramid.draw(painter, option.exposedRect, scale)